@@ -1,11 +1,15 @@
-import sys
-import trio
-from typing import Union, Tuple, List
+from typing import Union, Tuple, List, Dict
 import numpy as np
 import re
-from operator import itemgetter, mul
-from functools import reduce, wraps
+from functools import wraps
 import os
+import collections
+import socket
+import threading
+import concurrent.futures
+from concurrent.futures import Future
+
+from alsdac import _sansio
 
 # arbitrary, but:
 # - must be in between 1024 and 65535
@@ -32,11 +36,21 @@ READ_ONLY = os.environ.get('ALSDAC_READ_ONLY', True)
 def set_server_address(host):
     global SERVER_ADDRESS
     SERVER_ADDRESS = host
+    _reset_client()
 
 
 def set_port(port):
     global PORT
     PORT = port
+    _reset_client()
+
+
+def _reset_client():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
 
 def stream_size(b):
     m = re.match(b'(?P<_0>\d*) Points by (?P<_1>\d*) channels(?P<_2>[\s\S]*)', b)
@@ -48,54 +62,162 @@ def stream_size(b):
 
 
 
-# FIXME: Make sends/receives happen from a threaded hot loop,
-
-def get(data: str, SEND_ENCODING=SEND_ENCODING, RECEIVE_ENCODING=RECEIVE_ENCODING) -> bytes:
-    """
-    Starts sender and receiver asynchronous sockets. The sender sends a tcp/ip command to the LabView host system. The
-    receiver waits to receive a response.
-
+class Client:
     """
-    raise IOError('Deprecation in progress...')
-    async def _get(data):
-        result = None
+    A persistent, pipelined connection to the LabVIEW server.
 
-        async def sender(client_sock, data):
-            # print("sender: started!")
-            # print("sender: sending {!r}".format(data))
-            print('sent:', data.strip())
-            await client_sock.send_all(bytes(data, SEND_ENCODING))
+    Requests are written from the calling thread while a background I/O thread
+    reads responses and hands each to the caller waiting on it, in order. Any
+    number of threads may share one Client.
 
-        async def receiver(client_sock:trio.SocketStream):
-            _data = []
-            _data.append(await client_sock.receive_some(BUFSIZE))
-
-            expcols, exprows, _ = stream_size(_data[0])
-
-            if exprows and expcols:
-                while not _data[-1].endswith(b'\r\n\r\n'):
-                    _data.append(await client_sock.receive_some(BUFSIZE))
-
-            _data = b''.join(_data)
-
-            if not data:
-                sys.exit()
-            nonlocal result
-            result = _data
-            if RECEIVE_ENCODING:
-                print('received:', str(_data, RECEIVE_ENCODING).strip())
+        with Client('131.243.73.36') as client:
+            pos = client.request(_sansio.GetMotorPosRequest('esp300axis2')).data
+    """
 
-        with trio.socket.socket() as client_sock:
-            await client_sock.connect((SERVER_ADDRESS, PORT))
-            client_sock = trio.SocketStream(client_sock)
-            async with trio.open_nursery() as nursery:
-                nursery.start_soon(sender, client_sock, data)
+    def __init__(self, host=None, port=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lvs = None
+        self._futures = collections.deque()  # one per request in flight, in send order
+        self._send_lock = threading.Lock()
+        self._lvs_lock = threading.Lock()  # the reader and writers both update LVS state
+        self._error = None
+
+    def connect(self):
+        with self._send_lock:
+            if self._sock is None:
+                self._connect()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host or SERVER_ADDRESS, self.port or PORT))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._sock = sock
+        self._lvs = _sansio.LVS(_sansio.Role.CLIENT, pipeline=True)
+        self._error = None
+        self._reader = threading.Thread(target=self._read_loop, args=(sock, self._lvs),
+                                        name='alsdac-client', daemon=True)
+        self._reader.start()
+
+    def close(self):
+        with self._send_lock:
+            sock = self._sock
+            if sock is None:
+                return
+            reader = self._reader
+            self._fail(sock, ConnectionError('the Client was closed'))
+        reader.join(timeout=1)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, cmd) -> Future:
+        """Send a request without waiting; the Future resolves to its response."""
+        return self.submit_many([cmd])[0]
+
+    def submit_many(self, cmds) -> List[Future]:
+        """Send several requests in a single write without waiting; returns a Future per request, in order."""
+        cmds = list(cmds)
+        futures = [Future() for _ in cmds]
+        with self._send_lock:
+            with self._lvs_lock:
+                # The reader drops the socket if the connection fails, so only look at it under the lock
+                if self._sock is None:
+                    self._connect()
+                sock = self._sock
+                payload = self._lvs.send_many(cmds)
+                self._futures.extend(futures)
+            try:
+                sock.sendall(payload)
+            except OSError as ex:
+                self._fail(sock, ex)
+            # Replies without an end marker can't have anything queued behind them,
+            # so those hold the send lock until they've arrived
+            if cmds and _sansio.Commands[_sansio.Role.SERVER][cmds[-1].FNC].FRAMING is _sansio.Framing.LINES:
+                concurrent.futures.wait(futures[-1:], timeout=self.timeout)
+        return futures
+
+    def request(self, cmd, timeout=None):
+        """Send a request and block until its response arrives."""
+        return self.submit(cmd).result(timeout if timeout is not None else self.timeout)
+
+    def request_many(self, cmds, timeout=None):
+        """Send several requests in a single write and block until all their responses arrive."""
+        timeout = timeout if timeout is not None else self.timeout
+        return [future.result(timeout) for future in self.submit_many(cmds)]
+
+    def get(self, data: str) -> bytes:
+        """Send a raw command string (e.g. 'GetMotorPos(m1)\\r\\n') and return the raw response bytes."""
+        fnc = data.partition('(')[0].strip()
+        cmd = _sansio.Commands[_sansio.Role.CLIENT][fnc].from_components(data)
+        return bytes(self.request(cmd))
+
+    def _read_loop(self, sock, lvs):
+        try:
+            while True:
+                data = sock.recv(BUFSIZE)
+                with self._lvs_lock:
+                    if sock is not self._sock:
+                        return  # closed; the futures in flight now belong to a newer connection
+                    lvs.receive_bytes(data)
+                    while self._futures:
+                        event = lvs.next_event()
+                        if event is _sansio.NEED_DATA:
+                            break
+                        self._futures.popleft().set_result(event)
+                if not data:
+                    raise ConnectionError('connection closed by the LabVIEW server')
+        except Exception as ex:
+            self._fail(sock, ex)
+
+    def _fail(self, sock, ex):
+        # Everything in flight is lost with the connection; the next request reconnects. A socket that has
+        # already been replaced has nothing left to fail
+        with self._lvs_lock:
+            if sock is not self._sock:
+                return
+            futures = list(self._futures)
+            self._futures.clear()
+            self._sock = None
+            try:
+                # Wakes the reader, which finds its socket detached and leaves the futures alone
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        for future in futures:
+            if not future.done():
+                future.set_exception(ex)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def client() -> Client:
+    """Return the module's shared Client, connecting on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = Client()
+    return _client
 
-                nursery.start_soon(receiver, client_sock)
 
-        return result
+def get(data: str, SEND_ENCODING=SEND_ENCODING, RECEIVE_ENCODING=RECEIVE_ENCODING) -> bytes:
+    """
+    Sends a tcp/ip command to the LabView host system over the shared persistent Client and returns the raw
+    response.
 
-    return trio.run(_get, data)
+    """
+    return client().get(data)
 
 
 def write_required(func):
@@ -142,8 +264,9 @@ def GetMotor(motorname: str):
     return pos, hex, datetime
     # TODO: fix datetime nonsense
 
-async def GetMotorPos_async(motorname:str, get) -> float:
-    return GetMotorPos(motorname, get=get)
+async def GetMotorPos_async(motorname: str, client) -> float:
+    """``client`` is an alsdac.trio or alsdac.asyncio AsyncClient."""
+    return (await client.request(_sansio.GetMotorPosRequest(motorname))).data
 
 
 def GetMotorPos(motorname: str, get=get) -> float:
@@ -160,26 +283,25 @@ def GetSoftLimits(motorname: str) -> Tuple[float, float]:
                      get(f'GetSoftLimits({motorname})\r\n').split(b' ')))[:2]
 
 
-def GetFlyingPositions(motorname: str) -> str:
-    return np.frombuffer(get(f'GetFlyingPositions({motorname})\r\n').strip(),
-                         dtype=np.single)
-    # TODO: confirm
+def GetFlyingPositions(motorname: str, out: np.ndarray = None) -> np.ndarray:
+    """The positions latched during the last fly scan, as float32; pass ``out`` to reuse a preallocated array."""
+    return client().request(_sansio.GetFlyingPositionsRequest(motorname)).read_into(out)
 
 
 def ListMotors() -> List[str]:
-    names = str(get('ListMotors\r\n'), ENCODING).strip().split('\r\n')
+    names = str(get('ListMotors\r\n'), RECEIVE_ENCODING).strip().split('\r\n')
     if names == ['']: names = []
     return names
 
 
 def ListPresets() -> List[str]:
-    names = str(get('ListPresets\r\n'), ENCODING).strip().split('\r\n')
+    names = str(get('ListPresets\r\n'), RECEIVE_ENCODING).strip().split('\r\n')
     if names == ['']: names = []
     return names
 
 
 def ListTrajectories() -> List[str]:
-    names = str(get('ListTrajectories\r\n'), ENCODING).strip().split('\r\n')
+    names = str(get('ListTrajectories\r\n'), RECEIVE_ENCODING).strip().split('\r\n')
     if names == ['']: names = []
     return names
 
@@ -193,8 +315,9 @@ def MoveMotor(motorname: str, pos: Union[float, int]) -> bool:
     return bool(get(f'MoveMotor({motorname}, {pos})\r\n'))
 
 @write_required
-async def MoveMotor_async(motorname: str, pos: Union[float, int], get) -> bool:
-    return MoveMotor(motorname, pos, get=get)
+async def MoveMotor_async(motorname: str, pos: Union[float, int], client) -> bool:
+    """``client`` is an alsdac.trio or alsdac.asyncio AsyncClient."""
+    return bool(bytes(await client.request(_sansio.MoveMotorRequest(motorname, pos))))
 
 @write_required
 def StopMotor(motorname: str):
@@ -225,9 +348,22 @@ def SetBreakpoints(motorname: str,
     )
 
 
-# def SetBreakpointRegions(motorname: str, first_bp: float, num_points: int):
-#     return get(f'SetBreakpoints({motorname}, {first_bp}, {num_points})\r\n')
-# TODO: Set multiple breakpoints in get call.
+@write_required
+def SetBreakpointRegions(motorname: str, regions):
+    """Set all of a motor's breakpoint regions, an (n, 3) array of (first_bp, bp_step, num_points), in one call."""
+    return get(_sansio.SetBreakpointRegionsRequest.from_regions(motorname, regions).str_payload)
+
+
+@write_required
+def SetBreakpointPositions(motorname: str, positions):
+    """
+    Set arbitrary breakpoint positions, sent as the fewest uniform regions that reproduce them.
+
+    Evenly spaced positions go as a plain SetBreakpoints; anything else needs a server with SetBreakpointRegions.
+    """
+    regions = _sansio.breakpoint_regions(positions)
+    return get(_sansio.set_breakpoints_request(motorname, regions).str_payload)
+
 
 @write_required
 def DisableBreakpoints(motorname: str) -> bool:
@@ -247,9 +383,17 @@ def SetMotorVelocity(motorname: str, vel: float) -> float:
     return float(get(f'GetMotorVelocity({motorname}, {vel})\r\n'))
 
 
-# def MoveAllMotors(motorname1, posn1, motorname2, pos2):
-#     return get(f'MoveAllMotors({motorname1}, {posn1}, {motorname2}, {posn2})\r\n')
-# TODO: Set multiple motornames/positions in get call.
+@write_required
+def MoveAllMotors(positions: Dict[str, Union[float, int]]) -> bool:
+    """Start every motor in ``positions`` (motor name -> position) moving with one command."""
+    return bool(get(_sansio.MoveAllMotorsRequest.from_positions(positions).str_payload))
+
+
+@write_required
+async def MoveAllMotors_async(positions: Dict[str, Union[float, int]], client) -> bool:
+    """``client`` is an alsdac.trio or alsdac.asyncio AsyncClient."""
+    return (await client.request(_sansio.MoveAllMotorsRequest.from_positions(positions))).data
+
 """
 AI/DIO Controls
 """
@@ -260,13 +404,13 @@ def GetFreerun(ainame) -> float:
 
 
 def ListAIs() -> List[str]:
-    names = str(get('ListAIs\r\n'), ENCODING).strip().split('\r\n')
+    names = str(get('ListAIs\r\n'), RECEIVE_ENCODING).strip().split('\r\n')
     if names == ['']: names = []
     return names
 
 
 def ListDIOs() -> List[str]:
-    names = str(get('ListDIOs\r\n'), ENCODING).strip().split('\r\n')
+    names = str(get('ListDIOs\r\n'), RECEIVE_ENCODING).strip().split('\r\n')
     if names == ['']: names = []
     return names
 
@@ -286,7 +430,7 @@ def GetInstrumentStatus(instrumentname) -> List[str]:
 
 
 def ListInstruments() -> List[str]:
-    names = str(get('ListInstruments\r\n'), ENCODING).strip().split('\r\n')
+    names = str(get('ListInstruments\r\n'), RECEIVE_ENCODING).strip().split('\r\n')
     if names == ['']: names=[]
     return names
 
@@ -301,18 +445,12 @@ def GetInstrumentAcquired1D(instrumentname):
 
 
 def GetInstrumentAcquired2D(instrumentname):
-    b=get(f'GetInstrumentAcquired2D({instrumentname})\r\n')
-    expcols, exprows, data = stream_size(b)
-    s=str(b, RECEIVE_ENCODING)
-    arr = np.fromstring(s.split('\r\n',maxsplit=1)[1].replace('\r\n', '\t'), count=expcols*exprows, sep='\t', dtype=int)
-    return arr.reshape((exprows, expcols))
+    return client().request(_sansio.GetInstrumentAcquired2DRequest(instrumentname)).data
+
 
 def GetInstrumentAcquired2DBinary(instrumentname):
-    b = get(f'GetInstrumentAcquired2DBinary({instrumentname})\r\n', RECEIVE_ENCODING='')
-    expcols, exprows, data = stream_size(b)
-    # s = str(b, RECEIVE_ENCODING)
+    return client().request(_sansio.GetInstrumentAcquired2DBinaryRequest(instrumentname)).data
 
-    return np.frombuffer(data, dtype=np.dtype('int32').newbyteorder('>')).reshape((exprows, expcols))
 
 def GetInstrumentAcquired3D(instrumentname):
     return str(get(f'GetInstrumentAcquired3D({instrumentname})\r\n'))
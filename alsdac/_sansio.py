@@ -1,7 +1,7 @@
+import collections
 import enum
 import numpy as np
 import re
-from operator import itemgetter
 
 
 class _SimpleReprEnum(enum.Enum):
@@ -19,12 +19,28 @@ class Direction(_SimpleReprEnum):
     REQUEST = enum.auto()
 
 
+class Framing(_SimpleReprEnum):
+    LINE = enum.auto()  # a single CRLF-terminated line
+    LINES = enum.auto()  # CRLF-terminated lines; ends where the received data ends on a CRLF
+    SIZED = enum.auto()  # 'N Points by M channels' header, then a body ending in a blank line
+
+
+class Event(_SimpleReprEnum):
+    NEED_DATA = enum.auto()
+
+
+NEED_DATA = Event.NEED_DATA
+
+
 Commands = {}
 Commands[Role.CLIENT] = {}
 Commands[Role.SERVER] = {}
 _commands = set()
 
 ENCODING = 'ascii'
+TERMINATOR = b'\r\n'
+TRAILER = b'\r\n\r\n'
+SIZE_HEADER = re.compile(rb'(\d+) Points by (\d+) channels\r\n')
 
 
 class _MetaDirectionalMessage(type):
@@ -48,28 +64,104 @@ class _MetaDirectionalMessage(type):
         return new_class
 
 
+class memoized_data:
+    """
+    Declares a Message's ``data``: parsed on first access, then kept in the
+    message's ``_data`` slot. Every caller gets the same object, so treat
+    parsed arrays as read-only.
+    """
+
+    def __init__(self, parse):
+        self.parse = parse
+        self.__doc__ = parse.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        data = instance._data
+        if data is _UNPARSED:
+            data = instance._data = self.parse(instance)
+        return data
+
+
+_UNPARSED = object()
+
+
 class Message(metaclass=_MetaDirectionalMessage):
-    __slots__ = ('str_payload')
+    # A message holds whichever of its raw frame and its decoded payload it was
+    # built from; the other is only produced if asked for
+    __slots__ = ('_raw', '_str', '_data')
     WRITE_REQUIRED = False
+    CACHEABLE = False  # idempotent readbacks whose responses may be shared briefly
     FNC = None
+    FRAMING = Framing.LINE
+    ITEMSIZE = None  # bytes per element of a binary SIZED body; None for ASCII
 
     def __init__(self, str_payload):
-        self.str_payload = str_payload
+        self._raw = None
+        self._str = str_payload
+        self._data = _UNPARSED
 
     @classmethod
-    def from_wire(cls, payload_buffers):
-        return cls.from_components(
-            str(b''.join(payload_buffers), ENCODING).strip())
+    def from_wire(cls, payload):
+        # Accepts one bytes-like frame (e.g. a memoryview from LVS.next_event)
+        # or a list of received buffers, and keeps it undecoded
+        if isinstance(payload, (list, tuple)):
+            payload = b''.join(payload)
+        instance = cls.__new__(cls)
+        instance._raw = payload
+        instance._str = None
+        instance._data = _UNPARSED
+        return instance
 
     @classmethod
     def from_components(cls, str_payload):
         # Bwahahahaha
         instance = cls.__new__(cls)
-        instance.str_payload = str_payload
+        instance._raw = None
+        instance._str = str_payload
+        instance._data = _UNPARSED
         return instance
 
+    @property
+    def str_payload(self):
+        if self._str is None:
+            self._str = self._decode()
+        return self._str
+
+    def _decode(self):
+        return str(self._raw, ENCODING).strip()
+
+    @property
+    def raw_payload(self):
+        """The frame as received or pre-encoded, terminator included; None if it hasn't been encoded yet."""
+        return self._raw
+
+    def _scalar(self):
+        # A one-value payload for float()/int(), which skip the surrounding
+        # whitespace themselves; no str is made from a received frame
+        raw = self._raw
+        if raw is None:
+            return self._str
+        return bytes(raw) if isinstance(raw, memoryview) else raw
+
+    @property
+    def args(self):
+        """The arguments of a request, parsed back out of its payload."""
+        _, _, args = self.str_payload.strip().partition('(')
+        args = args.rpartition(')')[0]
+        return [arg.strip() for arg in args.split(',')] if args else []
+
     def __bytes__(self):
-        return bytes(self.str_payload, ENCODING)
+        if self._raw is not None:
+            return bytes(self._raw)
+        payload = bytes(self.str_payload, ENCODING)
+        if self.DIRECTION is Direction.RESPONSE:
+            # Responses hold their payload stripped, as parsed from the wire;
+            # a SIZED response without its header is a single-line error reply
+            sized = self.FRAMING is Framing.SIZED and SIZE_HEADER.match(payload + TERMINATOR)
+            payload += TRAILER if sized else TERMINATOR
+        return payload
 
     def __repr__(self):
         return f'{self.__class__.__name__}: {self.str_payload!r}'
@@ -82,12 +174,31 @@ class _TwoParamRequestBase(Message):
         super().__init__(f'{self.FNC}({target}, {value})\r\n')
 
 
+# (FNC, target) -> (str payload, wire bytes) of every one-parameter request
+# built so far; polling re-sends the same few thousand commands over and over
+_encoded = {}
+MAX_ENCODED = 16384
+
+
+def _encode(fnc, target):
+    key = fnc, target
+    try:
+        return _encoded[key]
+    except KeyError:
+        if len(_encoded) >= MAX_ENCODED:
+            _encoded.clear()
+        payload = f'{fnc}({target})\r\n' if target is not None else f'{fnc}()\r\n'
+        encoded = _encoded[key] = payload, bytes(payload, ENCODING)
+        return encoded
+
+
 class _OneParamRequestBase(Message):
     __slots__ = ()
     FNC = ''
 
     def __init__(self, target):
-        super().__init__(f'{self.FNC}({target})\r\n')
+        self._str, self._raw = _encode(self.FNC, target)
+        self._data = _UNPARSED
 
 
 class _ZeroParamRequestBase(Message):
@@ -95,7 +206,59 @@ class _ZeroParamRequestBase(Message):
     FNC = ''
 
     def __init__(self):
-        super().__init__(f'{self.FNC}()\r\n')
+        self._str, self._raw = _encode(self.FNC, None)
+        self._data = _UNPARSED
+
+
+class _MultiParamRequestBase(Message):
+    __slots__ = ()
+    FNC = ''
+
+    def __init__(self, *params):
+        super().__init__(f'{self.FNC}({", ".join(map(str, params))})\r\n')
+
+
+class _BinaryResponseBase(Message):
+    """
+    A SIZED reply whose body is ``points x channels`` binary items of DTYPE.
+
+    Only the header is ever decoded as text; the body stays in the receive
+    buffer until asked for.
+    """
+    __slots__ = ()
+    FRAMING = Framing.SIZED
+    DTYPE = None
+
+    def _decode(self):
+        header_end = bytes(self._raw[:128]).find(TERMINATOR)
+        if header_end < 0:
+            header_end = len(self._raw)
+        return str(self._raw[:header_end], ENCODING).strip()
+
+    @property
+    def shape(self):
+        """(channels, points) as announced by the header."""
+        match = self._raw is not None and SIZE_HEADER.match(self._raw)
+        if not match:
+            raise ProtocolError(self.str_payload)
+        points, channels = map(int, match.groups())
+        return channels, points
+
+    def _body(self):
+        # A flat view of the body, still in wire byte order
+        channels, points = self.shape
+        header_end = SIZE_HEADER.match(self._raw).end()
+        return np.frombuffer(self._raw, dtype=self.DTYPE, count=points * channels, offset=header_end)
+
+    @classmethod
+    def from_array(cls, arr):
+        arr = np.asarray(arr)
+        exprows, expcols = arr.shape if arr.ndim == 2 else (1, arr.size)
+        header = f'{expcols} Points by {exprows} channels'
+        return cls.from_wire(b''.join((bytes(header, ENCODING), TERMINATOR,
+                                       np.ascontiguousarray(arr, dtype=cls.DTYPE).tobytes(),
+                                       TRAILER)))
+
 
 class AtPresetRequest(_OneParamRequestBase):
     __slots__ = ()
@@ -106,7 +269,7 @@ class AtPresetResponse(Message):
     __slots__ = ()
     FNC = 'AtPreset'
 
-    @property
+    @memoized_data
     def data(self):
         return bool(self.str_payload)
 
@@ -120,7 +283,7 @@ class AtTrajectoryResponse(Message):
     __slots__ = ()
     FNC = 'AtTrajectory'
 
-    @property
+    @memoized_data
     def data(self):
         return bool(self.str_payload)
 
@@ -134,7 +297,7 @@ class DisableBreakpointsResponse(Message):
     __slots__ = ()
     FNC = 'DisableBreakpoints'
 
-    @property
+    @memoized_data
     def data(self):
         return bool(self.str_payload)
 
@@ -149,6 +312,31 @@ class MoveMotorResponse(Message):
     FNC = 'MoveMotor'
 
 
+class MoveAllMotorsRequest(_MultiParamRequestBase):
+    """Starts several motors at once: MoveAllMotors(name1, pos1, name2, pos2, ...)."""
+    __slots__ = ()
+    FNC = 'MoveAllMotors'
+
+    @classmethod
+    def from_positions(cls, positions):
+        """Build from a mapping (or pairs) of motor name -> position."""
+        return cls(*(param for name_position in dict(positions).items() for param in name_position))
+
+    @property
+    def positions(self):
+        args = self.args
+        return {name: float(position) for name, position in zip(args[::2], args[1::2])}
+
+
+class MoveAllMotorsResponse(Message):
+    __slots__ = ()
+    FNC = 'MoveAllMotors'
+
+    @memoized_data
+    def data(self):
+        return bool(self.str_payload)
+
+
 class DisableMotorRequest(_OneParamRequestBase):
     __slots__ = ()
     FNC = 'DisableMotor'
@@ -158,7 +346,7 @@ class DisableMotorResponse(Message):
     __slots__ = ()
     FNC = 'DisableMotor'
 
-    @property
+    @memoized_data
     def data(self):
         return bool(self.str_payload)
 
@@ -172,7 +360,7 @@ class EnableMotorResponse(Message):
     __slots__ = ()
     FNC = 'EnableMotor'
 
-    @property
+    @memoized_data
     def data(self):
         return bool(self.str_payload)
 
@@ -183,17 +371,54 @@ class GetFlyingPositionsRequest(_OneParamRequestBase):
 
 
 class GetFlyingPositionsResponse(Message):
+    """
+    Positions latched at each breakpoint crossing.
+
+    Read as the baseline client read it: no size header, a body of native float32, and everything the server
+    sends up to a CRLF. TODO: confirm the format against the LabVIEW server; until then the reply is unframed, so
+    nothing is pipelined behind it.
+    """
     __slots__ = ()
     FNC = 'GetFlyingPositions'
-
-    @property
+    FRAMING = Framing.LINES
+    DTYPE = np.dtype(np.float32)
+
+    def _decode(self):
+        # The body is binary; this is only for error replies and logging
+        return str(self._raw, ENCODING, 'backslashreplace').strip()
+
+    def _body(self):
+        raw = self._raw
+        if raw is None or bytes(raw[:6]) == b'ERROR:':
+            raise ProtocolError(self.str_payload)
+        end = len(raw) - len(TERMINATOR) if bytes(raw[-len(TERMINATOR):]) == TERMINATOR else len(raw)
+        if end % self.DTYPE.itemsize:
+            raise ProtocolError(f'{end} bytes of {self.DTYPE} positions')
+        return np.frombuffer(raw, dtype=self.DTYPE, count=end // self.DTYPE.itemsize)
+
+    @memoized_data
     def data(self):
-        # TODO check
-        np.fromstring(self.str_payload, dtype=np.single)
+        return self.read_into()
+
+    def read_into(self, out=None):
+        """Copy the positions into ``out`` (allocated if None); return the filled part of ``out``."""
+        body = self._body()
+        if out is None:
+            return body.copy()
+        if len(out) < len(body):
+            raise ValueError(f'{len(body)} positions do not fit in {len(out)}')
+        out[:len(body)] = body
+        return out[:len(body)]
+
+    @classmethod
+    def from_array(cls, positions):
+        return cls.from_wire(np.ascontiguousarray(positions, dtype=cls.DTYPE).tobytes() + TERMINATOR)
 
 
 class ListResponse(Message):
-    @property
+    FRAMING = Framing.LINES
+
+    @memoized_data
     def data(self):
         names = self.str_payload.strip().split('\r\n')
         if names == ['']: names = []
@@ -241,15 +466,16 @@ class ListDIOsResponse(ListResponse):
 class GetFreerunRequest(_OneParamRequestBase):
     __slots__ = ()
     FNC = 'GetFreerun'
+    CACHEABLE = True
 
 
 class GetFreerunResponse(Message):
     __slots__ = ()
     FNC = 'GetFreerun'
 
-    @property
+    @memoized_data
     def data(self):
-        return float(self.str_payload)
+        return float(self._scalar())
 
 class StartInstrumentAcquireRequest(_TwoParamRequestBase):
     __slots__ = ()
@@ -267,8 +493,9 @@ class GetInstrumentAcquired1DRequest(_OneParamRequestBase):
 class GetInstrumentAcquired1DResponse(Message):
     __slots__ = ()
     FNC = 'GetInstrumentAcquired1D'
+    FRAMING = Framing.LINES
 
-    @property
+    @memoized_data
     def data(self):
         return self.str_payload
 
@@ -281,25 +508,40 @@ class GetInstrumentAcquired2DRequest(_OneParamRequestBase):
 class GetInstrumentAcquired2DResponse(Message):
     __slots__ = ()
     FNC = 'GetInstrumentAcquired2D'
+    FRAMING = Framing.SIZED
 
-    @property
+    @memoized_data
     def data(self):
-        def stream_size(b):
-            m = re.match(b'(?P<_0>\d*) Points by (?P<_1>\d*) channels', b)
-            if m:
-                map(itemgetter(1), sorted(m.groupdict().items()))
-                return map(int, m.groups())
-            return None, None
-
-        b = self.str_payload
-        header, _, img = b.partition('\r\n')
-        img.replace('\r\n', '\t')
-        expcols, exprows = stream_size(header)
+        header, _, img = self.str_payload.partition('\r\n')
+        expcols, exprows = map(int, re.match(r'(\d+) Points by (\d+) channels', header).groups())
+        # Whitespace separators also match the CRLF between rows
         arr = np.fromstring(img,
                             count=expcols * exprows, sep='\t',
                             dtype=int)
         return arr.reshape((exprows, expcols))
 
+    @classmethod
+    def from_array(cls, arr):
+        exprows, expcols = arr.shape
+        rows = '\r\n'.join('\t'.join(map(str, row)) for row in arr.tolist())
+        return cls.from_components(f'{expcols} Points by {exprows} channels\r\n{rows}')
+
+
+class GetInstrumentAcquired2DBinaryRequest(_OneParamRequestBase):
+    __slots__ = ()
+    FNC = 'GetInstrumentAcquired2DBinary'
+
+
+class GetInstrumentAcquired2DBinaryResponse(_BinaryResponseBase):
+    __slots__ = ()
+    FNC = 'GetInstrumentAcquired2DBinary'
+    ITEMSIZE = 4
+    DTYPE = np.dtype('>i4')
+
+    @memoized_data
+    def data(self):
+        return self._body().reshape(self.shape)
+
 
 class GetInstrumentAcquired3DRequest(_OneParamRequestBase):
     __slots__ = ()
@@ -309,8 +551,9 @@ class GetInstrumentAcquired3DRequest(_OneParamRequestBase):
 class GetInstrumentAcquired3DResponse(Message):
     __slots__ = ()
     FNC = 'GetInstrumentAcquired3D'
+    FRAMING = Framing.LINES
 
-    @property
+    @memoized_data
     def data(self):
         return self.str_payload
 
@@ -323,8 +566,9 @@ class GetInstrumentStatusRequest(_OneParamRequestBase):
 class GetInstrumentStatusResponse(Message):
     __slots__ = ()
     FNC = 'GetInstrumentStatus'
+    FRAMING = Framing.LINES
 
-    @property
+    @memoized_data
     def data(self):
         return self.str_payload.split('\r\n')
 
@@ -338,7 +582,7 @@ class GetMotorResponse(Message):
     __slots__ = ()
     FNC = 'GetMotor'
 
-    @property
+    @memoized_data
     def data(self):
         pos, hexv, datetime = self.str_payload.split(' ', 2)
         pos = float(pos)
@@ -349,15 +593,16 @@ class GetMotorResponse(Message):
 class GetMotorPosRequest(_OneParamRequestBase):
     __slots__ = ()
     FNC = 'GetMotorPos'
+    CACHEABLE = True
 
 
 class GetMotorPosResponse(Message):
     __slots__ = ()
     FNC = 'GetMotorPos'
 
-    @property
+    @memoized_data
     def data(self):
-        return float(self.str_payload)
+        return float(self._scalar())
 
 
 class GetMotorStatusRequest(_OneParamRequestBase):
@@ -369,7 +614,7 @@ class GetMotorStatusResponse(Message):
     __slots__ = ()
     FNC = 'GetMotorStatus'
 
-    @property
+    @memoized_data
     def data(self):
         return self.str_payload.startswith('Move finished')
 
@@ -383,7 +628,7 @@ class GetMotorVelocityResponse(Message):
     __slots__ = ()
     FNC = 'GetMotorVelocity'
 
-    @property
+    @memoized_data
     def data(self):
         return self.str_payload
 
@@ -397,7 +642,7 @@ class GetSoftLimitsResponse(Message):
     __slots__ = ()
     FNC = 'GetSoftLimits'
 
-    @property
+    @memoized_data
     def data(self):
         return self.str_payload
 
@@ -411,7 +656,7 @@ class HomeMotorResponse(Message):
     __slots__ = ()
     FNC = 'HomeMotor'
 
-    @property
+    @memoized_data
     def data(self):
         return self.str_payload
 
@@ -425,7 +670,7 @@ class MoveToTrajectoryResponse(Message):
     __slots__ = ()
     FNC = 'MoveToTrajectory'
 
-    @property
+    @memoized_data
     def data(self):
         return self.str_payload
 
@@ -439,11 +684,202 @@ class StopMotorResponse(Message):
     __slots__ = ()
     FNC = 'StopMotor'
 
+    @memoized_data
+    def data(self):
+        return self.str_payload
+
+
+class GetMotorStatRequest(_OneParamRequestBase):
+    __slots__ = ()
+    FNC = 'GetMotorStat'
+
+
+class GetMotorStatResponse(GetMotorStatusResponse):
+    __slots__ = ()
+    FNC = 'GetMotorStat'
+
+
+class GetOrigMotorVelocityRequest(_OneParamRequestBase):
+    __slots__ = ()
+    FNC = 'GetOrigMotorVelocity'
+
+
+class GetOrigMotorVelocityResponse(Message):
+    __slots__ = ()
+    FNC = 'GetOrigMotorVelocity'
+
+    @memoized_data
+    def data(self):
+        return float(self._scalar())
+
+
+class ListPresetsRequest(_ZeroParamRequestBase):
+    __slots__ = ()
+    FNC = 'ListPresets'
+
+
+class ListPresetsResponse(ListResponse):
+    __slots__ = ()
+    FNC = 'ListPresets'
+
+
+class ListTrajectoriesRequest(_ZeroParamRequestBase):
+    __slots__ = ()
+    FNC = 'ListTrajectories'
+
+
+class ListTrajectoriesResponse(ListResponse):
+    __slots__ = ()
+    FNC = 'ListTrajectories'
+
+
+class MoveToPresetRequest(_OneParamRequestBase):
+    __slots__ = ()
+    FNC = 'MoveToPreset'
+
+
+class MoveToPresetResponse(Message):
+    __slots__ = ()
+    FNC = 'MoveToPreset'
+
+    @memoized_data
+    def data(self):
+        return bool(self.str_payload)
+
+
+class NumberMotorsRequest(_ZeroParamRequestBase):
+    __slots__ = ()
+    FNC = 'NumberMotors'
+
+
+class NumberMotorsResponse(Message):
+    __slots__ = ()
+    FNC = 'NumberMotors'
+
+    @memoized_data
+    def data(self):
+        return int(self._scalar())
+
+
+class SetBreakpointsRequest(_MultiParamRequestBase):
+    __slots__ = ()
+    FNC = 'SetBreakpoints'
+
+
+class SetBreakpointsResponse(Message):
+    __slots__ = ()
+    FNC = 'SetBreakpoints'
+
+    @memoized_data
+    def data(self):
+        return self.str_payload
+
+
+def breakpoint_regions(positions, rtol=1e-9):
+    """
+    Compress breakpoint positions into as few uniform regions as possible.
+
+    Returns an (n, 3) array of (first, step, count) rows, each a run of
+    equally spaced positions; a single leftover position is a region of
+    step 0 and count 1. ``rtol`` (relative to the largest step) absorbs
+    floating point noise in the spacing.
+    """
+    positions = np.asarray(positions, dtype=float).ravel()
+    if not len(positions):
+        return np.empty((0, 3))
+    steps = np.diff(positions)
+    atol = rtol * (np.abs(steps).max() if len(steps) else 0)
+    # run_end[i]: index of the last step in the run of equal steps containing step i
+    breaks = np.flatnonzero(np.abs(np.diff(steps)) > atol)
+    run_ends = np.append(breaks, len(steps) - 1)
+    run_end = np.repeat(run_ends, np.diff(np.concatenate(([-1], run_ends))))
+
+    regions = []
+    start = 0
+    while start < len(positions):
+        if start == len(positions) - 1:
+            regions.append((positions[start], 0., 1))
+            break
+        end = run_end[start]
+        regions.append((positions[start], steps[start], end - start + 2))
+        start = end + 2
+    return np.array(regions, dtype=float)
+
+
+def breakpoint_positions(regions):
+    """The inverse of breakpoint_regions: expand (first, step, count) rows into positions."""
+    regions = np.asarray(regions, dtype=float).reshape(-1, 3)
+    counts = regions[:, 2].astype(int)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(regions[:, 0], counts) + np.repeat(regions[:, 1], counts) * offsets
+
+
+class SetBreakpointRegionsRequest(_MultiParamRequestBase):
+    """
+    Sets every breakpoint region of a motor in one command:
+    SetBreakpointRegions(motor, first1, step1, count1, first2, step2, count2, ...).
+    """
+    __slots__ = ()
+    FNC = 'SetBreakpointRegions'
+
+    @classmethod
+    def from_regions(cls, motorname, regions):
+        regions = np.asarray(regions, dtype=float).reshape(-1, 3)
+        params = [f'{first!r}, {step!r}, {int(count)}' for first, step, count in regions.tolist()]
+        return cls(motorname, *params)
+
+    @classmethod
+    def from_positions(cls, motorname, positions, rtol=1e-9):
+        return cls.from_regions(motorname, breakpoint_regions(positions, rtol))
+
     @property
+    def regions(self):
+        return np.array(self.args[1:], dtype=float).reshape(-1, 3)
+
+    @property
+    def positions(self):
+        return breakpoint_positions(self.regions)
+
+
+class SetBreakpointRegionsResponse(Message):
+    __slots__ = ()
+    FNC = 'SetBreakpointRegions'
+
+    @memoized_data
     def data(self):
         return self.str_payload
 
 
+def set_breakpoints_request(motorname, regions):
+    """
+    The request that sets a motor's breakpoints to ``regions`` (see breakpoint_regions).
+
+    No regions are sent as DisableBreakpoints and one as SetBreakpoints, which every server takes; only
+    breakpoints that need several regions are sent as SetBreakpointRegions, which not every server implements yet.
+    """
+    regions = np.asarray(regions, dtype=float).reshape(-1, 3)
+    if not len(regions):
+        return DisableBreakpointsRequest(motorname)
+    if len(regions) == 1:
+        first, step, count = regions[0].tolist()
+        return SetBreakpointsRequest(motorname, first, step, int(count))
+    return SetBreakpointRegionsRequest.from_regions(motorname, regions)
+
+
+class StartAcquireRequest(_TwoParamRequestBase):
+    __slots__ = ()
+    FNC = 'StartAcquire'
+
+
+class StartAcquireResponse(Message):
+    __slots__ = ()
+    FNC = 'StartAcquire'
+
+    @memoized_data
+    def data(self):
+        return bool(self.str_payload)
+
+
 class State(_SimpleReprEnum):
     IDLE = enum.auto()
     AWAIT_RESPONSE = enum.auto()
@@ -454,7 +890,7 @@ class ProtocolError(Exception):
 
 
 class LVS:
-    def __init__(self, our_role):
+    def __init__(self, our_role, pipeline=False):
         self.our_role = our_role
         if our_role is Role.CLIENT:
             self.their_role = Role.SERVER
@@ -463,28 +899,200 @@ class LVS:
 
         self.state = State.IDLE
 
-        self.active_resp = None
+        # With pipeline=True several requests may be in flight; their
+        # responses are matched to them in the order the requests were sent
+        self.pipeline = pipeline
+        self._pending = collections.deque()
+
+        # Receive-side framing state; see receive_bytes/next_event
+        self._buffer = bytearray()
+        self._scan_from = 0  # offset below which no terminator can start
+        self._body_start = None  # set once a SIZED header has been parsed
+        self._frame_end = None
+        self._closed = False
+        self.bytes_sent = 0
+        self.bytes_consumed = 0  # bytes of complete frames handed out by next_event
+
+    @property
+    def active_resp(self):
+        return self._pending[0] if self._pending else None
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def send_many(self, cmds):
+        """
+        send() several messages at once, returned as one buffer for a single write.
+
+        A client sends either all of the requests or, if any may not be sent, none.
+        """
+        if self.our_role is not Role.CLIENT:
+            return b''.join([self.send(cmd) for cmd in cmds])
+        responses = Commands[Role.SERVER]
+        resps = [responses[cmd.FNC] for cmd in cmds]
+        if not resps:
+            return b''
+        if not self.pipeline and (self._pending or len(resps) > 1):
+            raise ProtocolError(
+                'may not have more than one request in flight')
+        if self._pending and self._pending[-1].FRAMING is Framing.LINES:
+            raise ProtocolError(
+                'may not send while awaiting a response that has no end marker')
+        for cmd, resp in zip(cmds, resps[:-1]):
+            if resp.FRAMING is Framing.LINES:
+                raise ProtocolError(
+                    f'may not send anything behind {cmd.FNC}, whose response has no end marker')
+        self._pending.extend(resps)
+        self.state = State.AWAIT_RESPONSE
+        payload = b''.join([bytes(cmd) for cmd in cmds])
+        self.bytes_sent += len(payload)
+        return payload
 
     def send(self, cmd):
         if self.our_role is Role.CLIENT:
-            if self.state is not State.IDLE:
-                raise ProtocolError(
-                    'may not have more than one request in flight')
-            self.active_resp = Commands[Role.SERVER][cmd.FNC]
+            if self._pending:
+                if not self.pipeline:
+                    raise ProtocolError(
+                        'may not have more than one request in flight')
+                if self._pending[-1].FRAMING is Framing.LINES:
+                    raise ProtocolError(
+                        'may not send while awaiting a response that has no end marker')
+            self._pending.append(Commands[Role.SERVER][cmd.FNC])
 
             self.state = State.AWAIT_RESPONSE
-            return bytes(cmd)
+            payload = bytes(cmd)
+            self.bytes_sent += len(payload)
+            return payload
         else:
-            raise Exception
-
-    def recv(self, payload):
+            # Responses go out in the order their requests came in
+            if not self._pending:
+                raise ProtocolError(
+                    'Was not asked for anything')
+            if cmd.FNC != self._pending[0].FNC:
+                raise ProtocolError(
+                    f'expected a response to {self._pending[0].FNC}, not {cmd.FNC}')
+            self._pending.popleft()
+            if not self._pending:
+                self.state = State.IDLE
+            payload = bytes(cmd)
+            self.bytes_sent += len(payload)
+            return payload
+
+    def receive_bytes(self, data):
+        """
+        Feed bytes received from the peer. An empty ``data`` marks the end of
+        the stream.
+        """
+        if not data:
+            self._closed = True
+            return
+        self._buffer += data
+
+    def next_event(self):
+        """
+        Return the next complete message, or NEED_DATA if more bytes must be
+        fed through receive_bytes first.
+        """
         if self.our_role is Role.CLIENT:
             if self.state is not State.AWAIT_RESPONSE:
                 raise ProtocolError(
                     'Did not ask for anything')
-            ret = self.active_resp.from_wire(payload)
-            self.state = State.IDLE
-            self.active_resp = None
+            frame = self._next_frame(self._pending[0])
+            if frame is None:
+                if self._closed:
+                    raise ProtocolError(
+                        'connection closed before response was complete')
+                return NEED_DATA
+            ret = self._pending.popleft().from_wire(frame)
+            if not self._pending:
+                self.state = State.IDLE
             return ret
         else:
-            raise Exception
+            frame = self._next_frame(Message)
+            if frame is None:
+                if self._closed and self._buffer:
+                    raise ProtocolError(
+                        'connection closed before request was complete')
+                return NEED_DATA
+            fnc = str(frame, ENCODING).strip().partition('(')[0]
+            try:
+                request_cls = Commands[Role.CLIENT][fnc]
+            except KeyError:
+                raise ProtocolError(f'unknown command {fnc!r}')
+            ret = request_cls.from_wire(frame)
+            self._pending.append(request_cls)
+            self.state = State.AWAIT_RESPONSE
+            return ret
+
+    def recv(self, payload):
+        """Parse a response from a list of already-collected buffers."""
+        for data in payload:
+            self.receive_bytes(data)
+        ret = self.next_event()
+        if ret is NEED_DATA:
+            raise ProtocolError('incomplete response')
+        return ret
+
+    def _next_frame(self, msg_cls):
+        buffer = self._buffer
+        framing = msg_cls.FRAMING
+
+        if framing is Framing.LINES:
+            # Multi-line replies carry no length or end marker; they are
+            # complete once everything received so far ends on a CRLF
+            end = len(buffer) if buffer.endswith(TERMINATOR) else None
+
+        elif framing is Framing.SIZED:
+            end = self._sized_frame_end(msg_cls)
+
+        else:
+            end = self._find(TERMINATOR)
+
+        if end is None or end > len(buffer):
+            return None
+        return self._consume(end)
+
+    def _sized_frame_end(self, msg_cls):
+        if self._body_start is None:
+            line_end = self._find(TERMINATOR)
+            if line_end is None:
+                return None
+            match = SIZE_HEADER.match(self._buffer, 0, line_end)
+            if not match:  # a single-line (error) reply instead of a frame
+                return line_end
+            self._body_start = match.end()
+            if msg_cls.ITEMSIZE:
+                points, channels = map(int, match.groups())
+                self._frame_end = (self._body_start + points * channels * msg_cls.ITEMSIZE
+                                   + len(TRAILER))
+            else:
+                # the header's own CRLF may be the first half of an empty body's trailer
+                self._scan_from = self._body_start - len(TERMINATOR)
+        if self._frame_end is None:
+            self._frame_end = self._find(TRAILER)
+        return self._frame_end
+
+    def _find(self, terminator):
+        # Resume scanning where the last attempt left off, backing up enough
+        # to catch a terminator split across two receives
+        index = self._buffer.find(terminator, self._scan_from)
+        if index < 0:
+            self._scan_from = max(self._scan_from, len(self._buffer) - len(terminator) + 1)
+            return None
+        return index + len(terminator)
+
+    def _consume(self, end):
+        # Hand out the frame without copying it; the (usually empty) remainder
+        # moves to a fresh buffer so the one handed out is never resized. When
+        # the frame is all there is, the buffer itself is the frame.
+        buffer = self._buffer
+        self._scan_from = 0
+        self._body_start = None
+        self._frame_end = None
+        self.bytes_consumed += end
+        if end == len(buffer):
+            self._buffer = bytearray()
+            return buffer
+        self._buffer = bytearray(buffer[end:])
+        return memoryview(buffer)[:end]
@@ -0,0 +1,119 @@
+"""
+A native asyncio client for the LabVIEW server.
+
+    async with await alsdac.asyncio.AsyncClient.connect() as client:
+        pos = (await client.request(_sansio.GetMotorPosRequest('esp300axis2'))).data
+        positions = await asyncio.gather(*(client.request(_sansio.GetMotorPosRequest(name))
+                                           for name in ['esp300axis1', 'esp300axis2']))
+
+Requests from any number of tasks are pipelined over one connection. A cancelled request gives up its place
+without disturbing the others; its response is read and discarded when it arrives.
+"""
+import asyncio
+import collections
+import socket
+
+import alsdac
+from alsdac import _sansio
+
+
+class AsyncClient:
+    """One pipelined connection to the LabVIEW server, read by a background task."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._lvs = _sansio.LVS(_sansio.Role.CLIENT, pipeline=True)
+        self._futures = collections.deque()  # one per request in flight, in send order
+        self._send_lock = asyncio.Lock()
+        self._unframed = None  # the outstanding reply with no end marker, if any
+        self._unframed_read = asyncio.Event()
+        self._error = None
+        self._read_task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    @classmethod
+    async def connect(cls, host=None, port=None):
+        """Connect to the LabVIEW server (alsdac.SERVER_ADDRESS/PORT by default)."""
+        reader, writer = await asyncio.open_connection(host or alsdac.SERVER_ADDRESS, port or alsdac.PORT,
+                                                       limit=alsdac.BUFSIZE)
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return cls(reader, writer)
+
+    async def close(self):
+        self._read_task.cancel()
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+        self._fail(ConnectionError('client closed'))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def in_flight(self):
+        return len(self._futures)
+
+    async def request(self, cmd):
+        """Send a request and wait for its response."""
+        return (await self.gather(cmd))[0]
+
+    async def gather(self, *cmds):
+        """Send several requests in a single write; return their responses in the same order."""
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in cmds]
+        async with self._send_lock:
+            # Nothing may be queued behind a reply that has no end marker
+            if self._unframed is not None:
+                self._unframed_read.clear()
+                await self._unframed_read.wait()
+            if self._error is not None:
+                raise self._error
+            # write() buffers the whole payload at once, so cancellation can't split a request
+            self._writer.write(self._lvs.send_many(cmds))
+            self._futures.extend(futures)
+            if cmds and _sansio.Commands[_sansio.Role.SERVER][cmds[-1].FNC].FRAMING is _sansio.Framing.LINES:
+                self._unframed = futures[-1]
+            await self._writer.drain()
+        return [await future for future in futures]
+
+    async def get(self, data: str) -> bytes:
+        """Send a raw command string (e.g. 'GetMotorPos(m1)\\r\\n') and return the raw response bytes."""
+        fnc = data.partition('(')[0].strip()
+        cmd = _sansio.Commands[_sansio.Role.CLIENT][fnc].from_components(data)
+        return bytes(await self.request(cmd))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self._reader.read(alsdac.BUFSIZE)
+                self._lvs.receive_bytes(data)
+                while self._futures:
+                    event = self._lvs.next_event()
+                    if event is _sansio.NEED_DATA:
+                        break
+                    future = self._futures.popleft()
+                    if future is self._unframed:
+                        self._unframed = None
+                        self._unframed_read.set()
+                    if not future.done():  # cancelled callers leave theirs behind
+                        future.set_result(event)
+                if not data:
+                    raise ConnectionError('connection closed by the LabVIEW server')
+        except (OSError, _sansio.ProtocolError) as ex:
+            self._fail(ex)
+
+    def _fail(self, ex):
+        if self._error is None:
+            self._error = ex
+        self._unframed = None
+        self._unframed_read.set()
+        while self._futures:
+            future = self._futures.popleft()
+            if not future.done():
+                future.set_exception(ex)
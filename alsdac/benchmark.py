@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the wire protocol and IOC hot paths, run against alsdac.simulator.
+
+    python -m alsdac.benchmark --json results.json
+    python -m alsdac.benchmark --suites parse --max-size 1024
+
+Suites:
+    parse   framing + parsing cost of every _sansio response type as payloads grow
+    encode  request encoding, one at a time and batched into a single buffer
+    get     round-trip latency and throughput of Beamline.get
+    ca      Channel Access throughput of Instrument.read and Motor RBV (needs caproto)
+
+Each result is one record of {suite, case, params, metric: value}; --json writes them all, with the environment,
+so runs can be compared for regressions.
+"""
+import argparse
+import inspect
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+
+import numpy as np
+import trio
+
+import alsdac
+from alsdac import _sansio, simulator
+
+FRAME_SIZES = (64, 256, 1024, 2048, 4096)
+LIST_SIZES = (10, 100, 1000, 10000)
+
+# Representative payloads for responses whose size doesn't scale
+SCALAR_PAYLOADS = {'GetMotor': '1.2345 0x0 Jan 1 1904 12:00AM',
+                   'GetMotorStatus': 'Move finished',
+                   'GetSoftLimits': '-100.0 100.0',
+                   'HomeMotor': 'OK!0',
+                   'StopMotor': 'Motor Stopped',
+                   'MoveMotor': 'OK',
+                   'StartInstrumentAcquire': 'OK',
+                   'NumberMotors': '2'}
+
+
+def timeit(func, min_time=.2, min_runs=3, max_runs=10000):
+    """Call ``func`` repeatedly; return per-call times (s)."""
+    times = []
+    started = time.perf_counter()
+    while len(times) < max_runs and (len(times) < min_runs or time.perf_counter() - started < min_time):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def summarize(times):
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+            'runs': len(times)}
+
+
+def make_request(fnc):
+    request_cls = _sansio.Commands[_sansio.Role.CLIENT][fnc]
+    args = ('bench', 0)[:len(inspect.signature(request_cls.__init__).parameters) - 1]
+    return request_cls(*args)
+
+
+def parse_cases(max_size):
+    """Yield (response class, size, wire bytes) for every response type, at growing sizes where that applies."""
+    rng = np.random.default_rng(0)
+    for response_cls in sorted(_sansio.Commands[_sansio.Role.SERVER].values(), key=lambda cls: cls.__name__):
+        if response_cls.__name__.startswith('_'):
+            continue
+        if hasattr(response_cls, 'from_array'):
+            for size in FRAME_SIZES:
+                if size <= max_size:
+                    frame = rng.integers(0, 65535, (size, size), dtype=np.int32)
+                    yield response_cls, size, bytes(response_cls.from_array(frame))
+        elif issubclass(response_cls, _sansio.ListResponse):
+            for size in LIST_SIZES:
+                names = '\r\n'.join(f'device{i}' for i in range(size))
+                yield response_cls, size, bytes(response_cls.from_components(names))
+        elif response_cls.FRAMING is _sansio.Framing.LINES:
+            for size in LIST_SIZES:
+                values = '\t'.join(map(repr, rng.random(size).tolist()))
+                yield response_cls, size, bytes(response_cls.from_components(values))
+        else:
+            payload = SCALAR_PAYLOADS.get(response_cls.FNC, '1.2345')
+            yield response_cls, 1, bytes(response_cls.from_components(payload))
+
+
+def parse(request, wire):
+    lvs = _sansio.LVS(_sansio.Role.CLIENT)
+    lvs.send(request)
+    view = memoryview(wire)
+    for start in range(0, len(view), alsdac.BUFSIZE):
+        lvs.receive_bytes(view[start:start + alsdac.BUFSIZE])
+    response = lvs.next_event()
+    return response.data if hasattr(response, 'data') else response
+
+
+def bench_parse(max_size=4096, **_):
+    for response_cls, size, wire in parse_cases(max_size):
+        request = make_request(response_cls.FNC)
+        record = {'suite': 'parse', 'case': response_cls.__name__, 'params': {'size': size, 'bytes': len(wire)}}
+        try:
+            parse(request, wire)
+        except Exception as ex:
+            # A broken parser is a result too
+            yield dict(record, error=repr(ex))
+            continue
+        times = timeit(lambda: parse(request, wire), min_runs=1 if len(wire) > 1e7 else 3)
+        stats = summarize(times)
+        yield dict(record, seconds=stats, mb_per_s=len(wire) / stats['min'] / 1e6)
+
+
+def bench_encode(batch_sizes=(10, 100), **_):
+    names = [f'm{i}' for i in range(max(batch_sizes))]
+    for name in names:
+        bytes(_sansio.GetMotorPosRequest(name))  # warm the encode cache
+
+    def uncached():
+        # What every request cost before the encode cache: format, then encode on send
+        for name in names:
+            bytes(_sansio.GetMotorPosRequest.from_components(f'GetMotorPos({name})\r\n'))
+
+    def cached():
+        for name in names:
+            bytes(_sansio.GetMotorPosRequest(name))
+
+    for case, func in (('format + encode', uncached), ('GetMotorPosRequest', cached)):
+        stats = summarize(timeit(func))
+        yield {'suite': 'encode', 'case': case, 'params': {'requests': len(names)}, 'seconds': stats,
+               'requests_per_s': len(names) / stats['min']}
+
+    for size in batch_sizes:
+        requests = [_sansio.GetMotorPosRequest(name) for name in names[:size]]
+        lvs = _sansio.LVS(_sansio.Role.CLIENT, pipeline=True)
+
+        def one_at_a_time():
+            for request in requests:
+                lvs.send(request)
+            lvs._pending.clear()
+
+        def batched():
+            lvs.send_many(requests)
+            lvs._pending.clear()
+
+        for case, func in (('LVS.send', one_at_a_time), ('LVS.send_many', batched)):
+            stats = summarize(timeit(func))
+            yield {'suite': 'encode', 'case': case, 'params': {'requests': size}, 'seconds': stats,
+                   'requests_per_s': size / stats['min']}
+
+
+async def _bench_get(latency, motors, rounds, frame_size):
+    results = []
+    sim = simulator.Simulator(motors=[f'm{i}' for i in range(motors)], shape=(frame_size, frame_size),
+                              latency=latency)
+    from alsdac.caproto import Beamline
+
+    async with trio.open_nursery() as nursery:
+        port = await nursery.start(simulator.serve, sim, '127.0.0.1', 0)
+        alsdac.set_server_address('127.0.0.1')
+        alsdac.set_port(port)
+        beamline = Beamline(prefix='bench:', cache_max_age=0)
+        params = {'latency': latency, 'motors': motors}
+
+        times = []
+        for i in range(rounds * motors):
+            t0 = time.perf_counter()
+            await beamline.get(_sansio.GetMotorPosRequest(f'm{i % motors}'))
+            times.append(time.perf_counter() - t0)
+        results.append({'suite': 'get', 'case': 'sequential GetMotorPos', 'params': params,
+                        'seconds': summarize(times), 'requests_per_s': len(times) / sum(times)})
+
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            async with trio.open_nursery() as poll:
+                for i in range(motors):
+                    poll.start_soon(beamline.get, _sansio.GetMotorPosRequest(f'm{i}'))
+        elapsed = time.perf_counter() - t0
+        results.append({'suite': 'get', 'case': 'concurrent GetMotorPos', 'params': params,
+                        'seconds_per_round': elapsed / rounds, 'requests_per_s': rounds * motors / elapsed})
+
+        for request_cls in (_sansio.GetInstrumentAcquired2DBinaryRequest, _sansio.GetInstrumentAcquired2DRequest):
+            request = request_cls('ptGreyInstrument')
+            await beamline.get(request)  # frame formatting is cached by the simulator after the first call
+            times = []
+            for _ in range(max(3, rounds // 10)):
+                t0 = time.perf_counter()
+                (await beamline.get(request)).data
+                times.append(time.perf_counter() - t0)
+            results.append({'suite': 'get', 'case': f'{request_cls.FNC} + data',
+                            'params': dict(params, size=frame_size), 'seconds': summarize(times),
+                            'frames_per_s': 1 / statistics.median(times)})
+        nursery.cancel_scope.cancel()
+    return results
+
+
+def bench_get(latencies=(0., .001), motors=40, rounds=20, frame_size=1024, **_):
+    for latency in latencies:
+        yield from trio.run(_bench_get, latency, motors, rounds, frame_size)
+
+
+def bench_ca(duration=2., frame_size=512, ca_port=5999, **_):
+    os.environ.update(EPICS_CA_SERVER_PORT=str(ca_port), EPICS_CA_ADDR_LIST='127.0.0.1',
+                      EPICS_CA_AUTO_ADDR_LIST='NO')
+    from caproto.threading.client import Context as ClientContext
+    from alsdac import caproto as ioc_module
+
+    results = []
+    ready = threading.Event()
+    done = threading.Event()
+
+    async def serve_ioc():
+        async with trio.open_nursery() as nursery:
+            port = await nursery.start(simulator.serve, simulator.Simulator(shape=(frame_size, frame_size)),
+                                       '127.0.0.1', 0)
+            alsdac.set_server_address('127.0.0.1')
+            alsdac.set_port(port)
+            ioc = ioc_module.Beamline(prefix='bench:')
+            await ioc.update()
+            nursery.start_soon(ioc_module.main, ioc.update, ioc.pvdb, False, ioc.background)
+            # Searches are answered before the server listens for circuits; wait until it does
+            while True:
+                try:
+                    await (await trio.open_tcp_stream('127.0.0.1', ca_port)).aclose()
+                    break
+                except OSError:
+                    await trio.sleep(.05)
+            ready.set()
+            await trio.to_thread.run_sync(done.wait)
+            nursery.cancel_scope.cancel()
+
+    server = threading.Thread(target=trio.run, args=(serve_ioc,), daemon=True)
+    server.start()
+    ready.wait()
+    try:
+        context = ClientContext()
+        rbv, frame, trigger, exposure_time, acquire = context.get_pvs(
+            'bench:motors:esp300axis1.RBV', 'bench:instruments:ptGreyInstrument.read',
+            'bench:instruments:ptGreyInstrument.trigger', 'bench:instruments:ptGreyInstrument.exposure_time',
+            'bench:instruments:ptGreyInstrument.acquire')
+        for pv in (rbv, frame, trigger, exposure_time, acquire):
+            pv.wait_for_connection(timeout=10)
+        exposure_time.write([0.], wait=True)  # time the pipeline, not the camera
+
+        for case, read in (('Motor RBV', lambda: rbv.read()),
+                           ('Instrument.read', lambda: frame.read(data_count=0)),
+                           ('Instrument trigger + read', lambda: (trigger.write([1], wait=True),
+                                                                  frame.read(data_count=0)))):
+            times = timeit(read, min_time=duration)
+            results.append({'suite': 'ca', 'case': case, 'params': {'size': frame_size},
+                            'seconds': summarize(times), 'reads_per_s': len(times) / sum(times)})
+
+        # Other PVs must stay live while frames stream in
+        acquire.write([1], wait=True)
+        times = timeit(lambda: rbv.read(), min_time=duration)
+        acquire.write([0], wait=True)
+        results.append({'suite': 'ca', 'case': 'Motor RBV while acquiring', 'params': {'size': frame_size},
+                        'seconds': summarize(times), 'reads_per_s': len(times) / sum(times)})
+        context.disconnect()
+    finally:
+        done.set()
+        server.join(timeout=5)
+    return results
+
+
+SUITES = {'parse': bench_parse, 'encode': bench_encode, 'get': bench_get, 'ca': bench_ca}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='alsdac hot path benchmarks')
+    parser.add_argument('--suites', default='parse,encode,get,ca', help='comma-separated; any of ' + ','.join(SUITES))
+    parser.add_argument('--max-size', type=int, default=4096, help='largest square frame to parse')
+    parser.add_argument('--frame-size', type=int, default=1024, help='frame size for get/ca suites')
+    parser.add_argument('--json', default=None, help='write results here')
+    args = parser.parse_args()
+
+    results = []
+    for suite in args.suites.split(','):
+        for result in SUITES[suite](max_size=args.max_size, frame_size=args.frame_size):
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                                       'trio': trio.__version__, 'platform': platform.platform(),
+                                       'time': time.time()},
+                       'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
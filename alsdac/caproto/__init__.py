@@ -7,13 +7,17 @@ import alsdac
 import time
 import numpy as np
 import trio
+import bisect
+import collections
 from alsdac import _sansio
+from alsdac.writers import FrameWriter
+from alsdac.shm import FrameRing
 import socket
 from caproto.trio.server import Context, run
 import caproto as ca
 import logging
 from caproto.server import records
-from caproto._data import ChannelAlarm
+from caproto._data import ChannelAlarm, AlarmStatus, AlarmSeverity
 
 logger = logging.getLogger('cosmic')
 logFormatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]%(message)s")
@@ -29,31 +33,281 @@ class LVGroup(PVGroup):
 
 
 class DynamicLVGroup(LVGroup):
+    """
+    A group of one PVGroup per LabVIEW device of some kind.
+
+    discover() re-lists the devices every ``discovery_period`` seconds, but
+    a device's PVGroup is only built when a client first looks up one of its
+    PVs (see DeviceDict), and is dropped again once it has gone unused for
+    ``idle_timeout`` seconds with no client holding a channel to it open. Devices that disappear from the list keep their
+    PVs but are marked disconnected (COMM/INVALID) until they come back.
+    """
     device_list_message_cls = None
     device_cls = None
-    devices = pvproperty(value=[], dtype=ChannelType.STRING, max_length=10000)
+    devices = pvproperty(value=[], dtype=ChannelType.STRING, max_length=10000, read_only=True)
+    discovery_period = pvproperty(value=10., dtype=float, doc='Device discovery period (s)')
+    idle_timeout = pvproperty(value=600., dtype=float, doc='Drop devices unused for this long (s); 0 never does')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pvdb = DeviceDict(self, self.pvdb)
+        self._own_pvs = list(self.pvdb)
+        self.device_groups = {}  # device name -> PVGroup, for devices in use
+        self.last_used = {}  # device name -> time.monotonic() of its last lookup
+        self.disconnected = set()
+        self._device_names = None
+
+    def device_name(self, pvname):
+        if pvname.startswith(self.prefix):
+            return pvname[len(self.prefix):].partition('.')[0]
+
+    def device_pvs(self, name):
+        return [f'{self.prefix}{name}.{pvproperty.pvspec.name}' for pvproperty in self.device_cls._pvs_.values()]
 
     async def update(self):
         device_names = (await self.parent.get(self.device_list_message_cls())).data
-        newpvs = {}
-        for name in device_names:
-            device = self.device_cls(name, parent=self)
-            newpvs.update({f'{self.prefix}{name}.{value.pvspec.name}': value for key, value in device.attr_pvdb.items()
-                           if f'{self.prefix}{name}.{key}' not in self.pvdb})
-            # newpvs.update({f'{self.prefix}{name}.{key}': value for key, value in device.attr_pvdb.items()
-            #                if f'{self.prefix}{name}.{key}' not in self.pvdb})
-        self.pvdb.update(newpvs)
-        return newpvs
-
-    @devices.getter
-    async def devices(self, instance):
-        await self.update()
-        return list(self.pvdb.keys())
+        if device_names == self._device_names:
+            return
+        self._device_names = device_names
+        self.pvdb.misses.clear()  # some of them may exist now
+
+        present = set(device_names)
+        for name in self.disconnected & present:
+            await self._set_connected(name, True)
+        for name in self.device_groups.keys() - present - self.disconnected:
+            await self._set_connected(name, False)
+
+        pvnames = self._own_pvs + [pvname for name in device_names for pvname in self.device_pvs(name)]
+        await self.devices.write(pvnames[:self.devices.max_length])
+
+    def instantiate(self, pvname):
+        """Build the PVGroup of the device ``pvname`` belongs to, if it's listed; return whether one was built."""
+        name = self.device_name(pvname)
+        if name in self.device_groups or name not in (self._device_names or ()):
+            return False
+        device = self.device_groups[name] = self.device_cls(name, parent=self)
+        self.last_used[name] = time.monotonic()
+        self.pvdb.update({f'{self.prefix}{name}.{value.pvspec.name}': value for value in device.attr_pvdb.values()})
+        logger.info(f'Created {self.prefix}{name}')
+        return True
+
+    def device(self, name):
+        """The PVGroup of device ``name``, built if need be."""
+        pvname = f'{self.prefix}{name}.'
+        self.instantiate(pvname)
+        self.touch(pvname)
+        return self.device_groups[name]
+
+    def touch(self, pvname):
+        name = self.device_name(pvname)
+        if name in self.last_used:
+            self.last_used[name] = time.monotonic()
+
+    def busy(self, name):
+        """Whether a client has a channel to one of the device's PVs open (monitoring it or not)."""
+        context = self.parent.pvdb.context
+        return context is not None and any(self.device_name(pvname) == name for pvname in context.open_channels())
+
+    def evict_idle(self):
+        timeout = self.idle_timeout.value
+        if timeout <= 0:
+            return
+        cutoff = time.monotonic() - timeout
+        for name, used in list(self.last_used.items()):
+            if used < cutoff and not self.busy(name):
+                self.evict(name)
+
+    def evict(self, name):
+        for pvname in self.device_pvs(name):
+            self.pvdb.pop(pvname, None)
+        del self.device_groups[name]
+        del self.last_used[name]
+        self.disconnected.discard(name)
+        logger.info(f'Dropped idle {self.prefix}{name}')
+
+    async def _set_connected(self, name, connected):
+        if connected:
+            self.disconnected.discard(name)
+            status, severity = AlarmStatus.NO_ALARM, AlarmSeverity.NO_ALARM
+        else:
+            self.disconnected.add(name)
+            status, severity = AlarmStatus.COMM, AlarmSeverity.INVALID_ALARM
+        logger.info(f'{self.prefix}{name} {"reconnected" if connected else "disconnected"}')
+        # Channels share alarms (one per alarm group); write each once
+        alarms = {id(channel.alarm): channel.alarm for channel in self.device_groups[name].attr_pvdb.values()}
+        for alarm in alarms.values():
+            await alarm.write(status=status, severity=severity)
+
+    async def discover(self):
+        while True:
+            try:
+                await self.update()
+                self.evict_idle()
+            except Exception:
+                logger.exception(f'Device discovery failed for {self.prefix}')
+            await trio.sleep(max(self.discovery_period.value, 1.))
+
+
+MAX_FRAME_SIZE = 4096 * 4096
+MAX_ROIS = 64
+MAX_BREAKPOINTS = 65536
+
+
+class Acquisition:
+    """
+    The frame pipeline of one Instrument, run as its own task (see AcquisitionRunner).
+
+    Exposures are started for each trigger, or back to back while ``acquire`` is set, and every frame is fetched
+    as soon as its exposure ends into a ring of the last RING_SIZE frames. When another exposure is due it is
+    started before the finished frame is fetched, so the camera exposes while the previous frame transfers.
+    Fetches are single-flight: a read that finds one in progress waits for it rather than fetching the frame again,
+    but an exposure only takes a fetch that started after it ended.
+    """
+    RING_SIZE = 4
+
+    def __init__(self, instrument):
+        self.instrument = instrument
+        self.ring = collections.deque(maxlen=self.RING_SIZE)  # (frame id, frame), oldest first
+        self.frame_id = 0  # of the newest frame in the ring
+        # Exposures are numbered from 1 in the order they're started
+        self.requested = 0  # the last one a trigger asked for
+        self.started = 0
+        self.completed = 0  # the last one whose frame is in the ring
+        self.aborted = range(0)  # ones whose frames won't come, after a failure
+        self.continuous = False  # follows the instrument's acquire PV
+        self.running = False
+        self._cancel_scope = None
+        self._wake = trio.Event()
+        self._completed = trio.Event()  # set (and replaced) whenever completed changes
+        self._fetching = None  # trio.Event of the fetch in flight, if any
+        self._fetch_started = None  # trio.current_time() that fetch started at
+
+    @property
+    def active(self):
+        return self.continuous or self.requested > self.started or self._fetching is not None
+
+    async def trigger(self):
+        """Ask for an exposure starting from now and wait until its frame is in the ring."""
+        exposure = self.requested = max(self.requested, self.started) + 1
+        self.wake()
+        while self.completed < exposure:
+            await self._completed.wait()
+        if exposure in self.aborted:
+            raise RuntimeError(f'Acquisition failed for {self.instrument.prefix}')
+
+    def wake(self):
+        self.instrument.parent.acquisitions.start(self)
+        self._wake.set()
+
+    async def fetch(self, after=None):
+        """
+        Fetch the frame the server holds now into the ring.
+
+        A fetch already in flight is waited for instead, unless it started before ``after`` (a trio.current_time());
+        then the frame it gets may be older than that, so another is fetched once it's done.
+        """
+        while self._fetching is not None:
+            fetching, started = self._fetching, self._fetch_started
+            await fetching.wait()
+            if after is None or started >= after:
+                return
+        self._fetching, self._fetch_started = trio.Event(), trio.current_time()
+        try:
+            await self.instrument.capture()
+        finally:
+            self._fetching.set()
+            self._fetching = None
+
+    def add(self, frame):
+        self.frame_id += 1
+        self.ring.append((self.frame_id, frame))
+
+    def frame(self, frame_id):
+        """Frame ``frame_id`` if it's still in the ring, else None."""
+        for id_, frame in self.ring:
+            if id_ == frame_id:
+                return frame
+
+    def _due(self):
+        return self.continuous or self.requested > self.started
+
+    def _complete(self, exposure):
+        self.completed = exposure
+        self._completed.set()
+        self._completed = trio.Event()
+
+    async def _start_exposure(self):
+        """Start the next exposure; return its number and when it ends."""
+        instrument = self.instrument
+        exposure_time = instrument.exposure_time.value
+        await instrument.parent.parent.get(_sansio.StartInstrumentAcquireRequest(instrument.devicename, exposure_time))
+        self.started += 1
+        return self.started, trio.current_time() + exposure_time
+
+    async def run(self):
+        with trio.CancelScope() as self._cancel_scope:
+            while True:
+                if not self._due():
+                    self._wake = trio.Event()
+                    await self._wake.wait()
+                    continue
+                try:
+                    exposure, exposed_at = await self._start_exposure()
+                    while True:
+                        await trio.sleep_until(exposed_at)
+                        finished, finished_at = exposure, exposed_at
+                        more = self._due()
+                        if more:
+                            exposure, exposed_at = await self._start_exposure()
+                        await self.fetch(after=finished_at)
+                        await self.instrument.save()
+                        self._complete(finished)
+                        if not more:
+                            break
+                except Exception:
+                    logger.exception(f'Acquisition failed for {self.instrument.prefix}')
+                    # Don't leave triggers waiting on exposures that won't come
+                    self.requested = self.started = max(self.requested, self.started)
+                    self.aborted = range(self.completed + 1, self.requested + 1)
+                    self._complete(self.requested)
+                    await trio.sleep(1.)
+
+    def close(self):
+        if self._cancel_scope is not None:
+            self._cancel_scope.cancel()
+
+
+class AcquisitionRunner:
+    """Runs each Instrument's Acquisition task, from the first time it's needed, in one nursery."""
+
+    def __init__(self):
+        self._send, self._receive = trio.open_memory_channel(float('inf'))
+
+    def start(self, acquisition):
+        if not acquisition.running:
+            acquisition.running = True
+            self._send.send_nowait(acquisition)
+
+    async def run(self):
+        async with trio.open_nursery() as nursery:
+            async for acquisition in self._receive:
+                nursery.start_soon(acquisition.run)
+
+
+def _frame_stat(key):
+    """A getter for a PV that publishes one of Instrument.reduce's results for the current frame."""
+
+    async def get(self, instance):
+        if await self.current_frame() is None:
+            return instance.value
+        return self.stats[key]
+
+    return get
 
 
 class Instrument(LVGroup):
     trigger = pvproperty(value=[0], dtype=bool)
-    read = pvproperty(value=[0], dtype=float)
+    read = pvproperty(value=[0], dtype=float, max_length=MAX_FRAME_SIZE)
     scalarread = pvproperty(value=[0], dtype=float)
 
     # Non-standard PVs
@@ -61,38 +315,220 @@ class Instrument(LVGroup):
     exposure_counts = pvproperty(value=[1], dtype=int)
     size_x = pvproperty(value=[0], dtype=int)
     size_y = pvproperty(value=[0], dtype=int)
+    acquire = pvproperty(value=0, dtype=int, doc='Acquire continuously while 1; trigger takes single frames')
+    frame_counter = pvproperty(value=0, dtype=int, read_only=True, doc='Id of the newest frame; changes once per frame')
+
+    # Reductions, computed once per captured frame; x is the first image axis, as for size_x
+    rois = pvproperty(value=[], dtype=int, max_length=4 * MAX_ROIS,
+                      doc='Regions of interest, flattened as x, y, size_x, size_y per ROI; '
+                          'none means the central 4x4 pixels. Applies from the next frame')
+    roi_sums = pvproperty(value=[0.], dtype=float, max_length=MAX_ROIS, read_only=True, get=_frame_stat('roi_sums'),
+                          doc='Sum over each ROI; scalarread is the first')
+    binning = pvproperty(value=4, dtype=int, doc='Preview binning factor. Applies from the next frame')
+    preview = pvproperty(value=[0.], dtype=float, max_length=MAX_FRAME_SIZE, read_only=True,
+                         get=_frame_stat('preview'), doc='The frame averaged over binning x binning blocks')
+    preview_x = pvproperty(value=0, dtype=int, read_only=True)
+    preview_y = pvproperty(value=0, dtype=int, read_only=True)
+    threshold = pvproperty(value=0., dtype=float,
+                           doc='Fraction of the maximum below which pixels are left out of the centroid and sigma')
+    frame_sum = pvproperty(value=0., dtype=float, read_only=True, get=_frame_stat('sum'))
+    frame_max = pvproperty(value=0., dtype=float, read_only=True, get=_frame_stat('max'))
+    centroid_x = pvproperty(value=0., dtype=float, read_only=True, get=_frame_stat('centroid_x'))
+    centroid_y = pvproperty(value=0., dtype=float, read_only=True, get=_frame_stat('centroid_y'))
+    sigma_x = pvproperty(value=0., dtype=float, read_only=True, get=_frame_stat('sigma_x'))
+    sigma_y = pvproperty(value=0., dtype=float, read_only=True, get=_frame_stat('sigma_y'))
 
-    last_capture = None
+    # Saving every acquired frame to local disk; see alsdac.writers
+    write_path = pvproperty(value='', dtype=ChannelType.CHAR, max_length=1024,
+                            doc='File to save frames to; .h5/.hdf5 for HDF5 (needs h5py), else a .npy stack')
+    write_enable = pvproperty(value=0, dtype=int, doc='Save every acquired frame while 1; writing 1 starts a new file')
+    write_block = pvproperty(value=1000, dtype=int, doc='Frames to preallocate file space for at a time')
+    write_index = pvproperty(value=0, dtype=int, read_only=True, doc='Frames saved to the current file')
+    write_rate = pvproperty(value=0., dtype=float, read_only=True, doc='Frames saved per second')
+    write_backlog = pvproperty(value=0, dtype=int, read_only=True, doc='Frames waiting to be saved')
+
+    # Frames shared in memory with readers on this host; see alsdac.shm
+    share_slots = pvproperty(value=0, dtype=int, doc='Frames to keep in the shared memory ring; 0 shares none')
+    share_name = pvproperty(value='', dtype=ChannelType.CHAR, max_length=256, read_only=True,
+                            doc='Shared memory block of the frame ring, for alsdac.shm.FrameRingReader')
+
+    last_capture = None  # the newest frame in the acquisition ring
+    stats = None  # Instrument.reduce() of last_capture
+    writer = None  # FrameWriter while write_enable is set
+    shared = None  # FrameRing while share_slots is set
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquisition = Acquisition(self)
 
     @trigger.putter
     async def trigger(self, instance, value):
-        await self.parent.parent.get(_sansio.StartInstrumentAcquireRequest(self.devicename, self.exposure_time))
-        self.last_capture = None
+        # Completes once the new frame has been fetched, so reads that follow get it straight away
+        await self.acquisition.trigger()
+
+    @acquire.putter
+    async def acquire(self, instance, value):
+        self.acquisition.continuous = bool(value)
+        if value:
+            self.acquisition.wake()
+
+    @write_enable.putter
+    async def write_enable(self, instance, value):
+        await self.stop_writing()
+        if value:
+            path = self.write_path.value
+            if not path:
+                raise ValueError('write_path is not set')
+            self.writer = FrameWriter(path, block=max(int(self.write_block.value), 1))
+            logger.info(f'Saving {self.prefix} frames to {path}')
+        await self.publish_writer()
+
+    @share_slots.putter
+    async def share_slots(self, instance, value):
+        await self.stop_sharing()
+        if value > 0:
+            pvprefix = f'{self.parent.prefix}{self.devicename}'
+            name = 'alsdac_' + ''.join(c if c.isalnum() else '_' for c in pvprefix)
+            self.shared = FrameRing(name, slots=value)
+            if self.last_capture is not None:
+                self.shared.publish(self.last_capture, self.acquisition.frame_id)
+        await self.share_name.write(self.shared.name if self.shared is not None else '')
+
+    async def stop_sharing(self):
+        shared, self.shared = self.shared, None
+        if shared is not None:
+            # A worker thread may be publishing to it; close() waits for that to finish
+            await trio.to_thread.run_sync(shared.close)
+
+    async def save(self):
+        """Hand the newest frame to the writer, if saving; waits while the disk is behind."""
+        writer = self.writer
+        if writer is None:
+            return
+        try:
+            await trio.to_thread.run_sync(writer.put, self.last_capture)
+        except Exception:
+            logger.exception(f'Saving {self.prefix} frames failed')
+            await self.write_enable.write(0)
+            return
+        await self.publish_writer()
+
+    async def stop_writing(self):
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            try:
+                await trio.to_thread.run_sync(writer.close)
+            except Exception:
+                logger.exception(f'Closing {writer.path} failed')
+            await self.write_index.write(writer.written)
+
+    async def publish_writer(self):
+        writer = self.writer
+        if writer is not None:
+            await self.write_index.write(writer.written)
+        await self.write_rate.write(writer.rate if writer is not None else 0.)
+        await self.write_backlog.write(writer.backlog if writer is not None else 0)
 
     @read.getter
     async def read(self, instance):
-        if self.last_capture is not None:
-            return self.last_capture.flatten()
-        self.last_capture = alsdac.GetInstrumentAcquired2D(self.devicename)
-        await self.size_x.write(self.last_capture.shape[0])
-        await self.size_y.write(self.last_capture.shape[1])
-        return self.last_capture.flatten()
+        frame = await self.current_frame()
+        return np.empty(0) if frame is None else frame.ravel()
 
     @scalarread.getter
     async def scalarread(self, instance):
-        if self.last_capture is not None:
-            return self.reduce_to_scalar(self.last_capture)
-        self.last_capture = alsdac.GetInstrumentAcquired2D(self.devicename)
-        await self.size_x.write(self.last_capture.shape[0])
-        await self.size_y.write(self.last_capture.shape[1])
-        scalar = self.reduce_to_scalar(self.last_capture)
-        return scalar
+        if await self.current_frame() is None:
+            return instance.value
+        return self.stats['roi_sums'][0]
+
+    async def current_frame(self):
+        """
+        The newest frame, fetched first if there's none yet; None if that fetch failed.
+
+        The getters can't raise instead: caproto lets a getter's exception take down the client's circuit.
+        """
+        if self.last_capture is None:
+            try:
+                await self.acquisition.fetch()
+            except Exception:
+                # Only the reader that ran the fetch sees its error; the others find no frame
+                logger.exception(f'Fetching a frame from {self.prefix} failed')
+        return self.last_capture
+
+    async def capture(self):
+        """Fetch the server's current frame and publish it; use acquisition.fetch() rather than calling this."""
+        response = await self.parent.parent.get(_sansio.GetInstrumentAcquired2DBinaryRequest(self.devicename))
+        # Parsing and reducing a large frame takes tens of ms; a worker thread does it so every other PV
+        # keeps being served meanwhile
+        frame, self.stats = await trio.to_thread.run_sync(self.process, response, self.rois.value,
+                                                          self.binning.value, self.threshold.value)
+        self.last_capture = frame
+        self.acquisition.add(frame)
+        if self.shared is not None:
+            await trio.to_thread.run_sync(self.shared.publish, frame, self.acquisition.frame_id)
+        await self.frame_counter.write(self.acquisition.frame_id)
+        await self.size_x.write(frame.shape[0])
+        await self.size_y.write(frame.shape[1])
+        await self.publish_stats()
+
+    async def publish_stats(self):
+        """Push the current frame's reductions to monitors of their PVs."""
+        stats = self.stats
+        for pv, key in ((self.roi_sums, 'roi_sums'), (self.preview_x, 'preview_x'), (self.preview_y, 'preview_y'),
+                        (self.preview, 'preview'), (self.frame_sum, 'sum'),
+                        (self.frame_max, 'max'), (self.centroid_x, 'centroid_x'), (self.centroid_y, 'centroid_y'),
+                        (self.sigma_x, 'sigma_x'), (self.sigma_y, 'sigma_y')):
+            await pv.write(stats[key])
+
+    @classmethod
+    def process(cls, response, rois=(), binning=1, threshold=0.):
+        """
+        Parse a frame response and reduce() the frame; returns (frame, stats).
+
+        Touches nothing but its arguments, so it's safe to run in a worker thread. The frame is converted to
+        native byte order once here, rather than by every reduction and CA read that follows.
+        """
+        frame = response.data
+        frame = frame.astype(frame.dtype.newbyteorder('='), copy=False)
+        return frame, cls.reduce(frame, rois, binning, threshold)
 
     @staticmethod
     def reduce_to_scalar(image):
         shape = image.shape
         return image[shape[0] // 2 - 2:shape[0] // 2 + 2, shape[1] // 2 - 2:shape[1] // 2 + 2].sum()
 
+    @staticmethod
+    def reduce(image, rois=(), binning=1, threshold=0.):
+        """
+        Everything the Instrument publishes about one frame, in a single pass per reduction.
+
+        Returns a dict of roi_sums, preview (the binned image, flattened) with its preview_x/y shape, and the sum,
+        max, centroid_x/y and sigma_x/y of the frame. Centroid and sigma come from the row and column projections,
+        leaving out pixels below ``threshold`` times the maximum.
+        """
+        rois = np.asarray(rois, dtype=int).reshape(-1, 4)
+        if len(rois):
+            roi_sums = [image[max(x, 0):x + dx, max(y, 0):y + dy].sum(dtype=np.float64) for x, y, dx, dy in rois]
+        else:
+            roi_sums = [float(Instrument.reduce_to_scalar(image))]
+
+        binning = max(int(binning), 1)
+        rows, cols = image.shape[0] // binning, image.shape[1] // binning
+        preview = image[:rows * binning, :cols * binning].reshape(rows, binning, cols, binning).mean(axis=(1, 3))
+
+        peak = image.max() if image.size else 0
+        weights = image if threshold <= 0 else np.where(image >= threshold * peak, image, 0)
+        stats = {'roi_sums': np.array(roi_sums), 'preview': preview.ravel(), 'preview_x': rows, 'preview_y': cols,
+                 'sum': float(image.sum(dtype=np.float64)), 'max': float(peak)}
+        for axis, projection in (('x', weights.sum(axis=1, dtype=np.float64)),
+                                 ('y', weights.sum(axis=0, dtype=np.float64))):
+            total = projection.sum()
+            pixels = np.arange(len(projection))
+            centroid = projection @ pixels / total if total else 0.
+            variance = projection @ (pixels - centroid) ** 2 / total if total else 0.
+            stats[f'centroid_{axis}'] = float(centroid)
+            stats[f'sigma_{axis}'] = float(np.sqrt(max(variance, 0.)))
+        return stats
+
 
 # TODO: add AnalogInput Ophyd device
 class AnalogInput(records.AiFields, LVGroup):
@@ -123,13 +559,77 @@ class Motor(records.MotorFields, LVGroup):  # MotorFields
                              dtype=ChannelType.DOUBLE,
                              doc='User Offset (EGU)',
                              read_only=False)
+    stop = pvproperty(name='STOP', dtype=ChannelType.INT, doc='Stop')
 
 
+    TOLERANCE = 1e-4  # RBV within this of the setpoint counts as arrived
+    setpoint = None
+    moves = 0  # moves started, so the scanner can tell a round's results are for an earlier one
+
+    # Non-standard PVs
+    breakpoints = pvproperty(value=[], dtype=float, max_length=MAX_BREAKPOINTS,
+                             doc='Fly scan breakpoint positions; sent as uniform regions in one command')
+    breakpoint_regions = pvproperty(value=0, dtype=int, read_only=True, doc='Regions the breakpoints were sent as')
+
+    # Its own alarm group, so a bad readout doesn't alarm the rest of the motor
+    flying_positions = pvproperty(value=[], dtype=ChannelType.FLOAT, max_length=MAX_BREAKPOINTS, read_only=True,
+                                  alarm_group='flying_positions',
+                                  doc='Positions latched at each breakpoint during the last fly scan')
+
+    @flying_positions.getter
+    async def flying_positions(self, instance):
+        # Raising here would drop the client's circuit, so failures are alarms instead
+        response = await self.parent.parent.get(_sansio.GetFlyingPositionsRequest(self.devicename))
+        try:
+            positions = response.data  # a fresh array; caproto keeps what getters return
+        except _sansio.ProtocolError as ex:
+            logger.warning(f'{self.devicename} flying_positions: {ex}')
+            await instance.alarm.write(status=AlarmStatus.READ, severity=AlarmSeverity.INVALID_ALARM)
+            return instance.value
+        if len(positions) > MAX_BREAKPOINTS:
+            logger.warning(f'{self.devicename} flying_positions: {len(positions)} positions, '
+                           f'only the first {MAX_BREAKPOINTS} are served')
+            await instance.alarm.write(status=AlarmStatus.READ, severity=AlarmSeverity.MAJOR_ALARM)
+            return positions[:MAX_BREAKPOINTS]
+        if instance.alarm.status is AlarmStatus.READ:
+            await instance.alarm.write(status=AlarmStatus.NO_ALARM, severity=AlarmSeverity.NO_ALARM)
+        return positions
+
+    @breakpoints.putter
+    async def breakpoints(self, instance, value):
+        regions = _sansio.breakpoint_regions(value)
+        response = await self.parent.parent.get(_sansio.set_breakpoints_request(self.devicename, regions))
+        if response.str_payload.startswith('ERROR'):
+            # Most likely a server without SetBreakpointRegions, given breakpoints that aren't evenly spaced
+            raise ValueError(f'{self.devicename} did not take {len(regions)} breakpoint regions: '
+                             f'{response.str_payload}')
+        await self.breakpoint_regions.write(len(regions))
+
     @value.putter
     async def value(self, instance, value):
-        await self.MOVN.write([True])
+        await self.start_move()
         # alsdac.MoveMotor(self.devicename, value[0])
         await self.parent.parent.get(_sansio.MoveMotorRequest(self.devicename, value))
+        self.track_move(value)
+
+    @stop.putter
+    async def stop(self, instance, value):
+        if value:
+            await self.parent.parent.get(_sansio.StopMotorRequest(self.devicename))
+            # The scanner sees the motor stop short of its setpoint and finishes the move there
+            self.parent.parent.cache.invalidate(_sansio.GetMotorPosRequest(self.devicename))
+        return 0
+
+    async def start_move(self):
+        self.moves += 1
+        await self.motor_is_moving.write(1)
+        await self.done_moving_to_value.write(0)
+
+    def track_move(self, setpoint):
+        """Once the move has been sent, hand the motor to its group's scanner."""
+        self.parent.parent.cache.invalidate(_sansio.GetMotorPosRequest(self.devicename))
+        self.setpoint = setpoint
+        self.parent.scanner.track(self)
 
     # TODO: LABVIEW TCP interface has no command to get the setpoint; request this addition; fill in getter
 
@@ -141,98 +641,568 @@ class Motor(records.MotorFields, LVGroup):  # MotorFields
     #     # will be returned automatically
     #     return obj._value
 
-    @value.startup
-    async def value(self, instance, async_lib):
-        'Periodically check if at setpoint'
-        while True:
-            if self.MOVN.value[0]:
-                while True:
-                    _, rbv = await self.user_readback_value.read(ChannelType.FLOAT)
-                    if abs(instance.value[0] - rbv[0]) < 0.0001:  # Threshold
-                        await self.MOVN.write([False])
-                        break
-
-                    await async_lib.library.sleep(.1)
-            await async_lib.library.sleep(.1)
-
     @user_readback_value.getter
     async def user_readback_value(self, instance):
         value = (await self.parent.parent.get(_sansio.GetMotorPosRequest(self.devicename))).data
         return value
 
 
+class MotorScanner:
+    """
+    Polls every moving motor of a Motors group in batched rounds.
+
+    Each round sends GetMotorPos and GetMotorStatus for all moving motors at
+    once (pipelined, so one round costs about one round trip), pushes RBV to
+    monitors and flips MOVN/DMOV when a move completes. While nothing moves
+    the scanner sleeps until a move is tracked. While rounds fail, they are
+    retried at up to ``max_backoff`` seconds apart.
+    """
+
+    def __init__(self, group, period=.05, max_backoff=5.):
+        self.group = group
+        self.period = period
+        self.max_backoff = max_backoff
+        self._moving = set()
+        self._stopped = set()  # reported done, but with an RBV that may predate the stop
+        self._wake = trio.Event()
+        self._error = None
+
+    def track(self, motor):
+        self._moving.add(motor)
+        self._stopped.discard(motor)
+        self._wake.set()
+
+    def __contains__(self, motor):
+        return motor in self._moving
+
+    async def run(self):
+        delay = self.period
+        while True:
+            if not self._moving:
+                await self.group.moving.write(0)
+                self._wake = trio.Event()
+                await self._wake.wait()
+            started = trio.current_time()
+            try:
+                await self.scan()
+            except Exception as ex:
+                # Log a persistent error once, not every round
+                if repr(ex) != self._error:
+                    logger.exception('Motor scan failed')
+                    self._error = repr(ex)
+                delay = min(delay * 2, self.max_backoff)
+            else:
+                if self._error is not None:
+                    logger.info('Motor scan recovered')
+                    self._error = None
+                delay = self.period
+            await trio.sleep_until(started + delay)
+
+    async def scan(self):
+        beamline = self.group.parent
+        motors = list(self._moving)
+        moves = {motor: motor.moves for motor in motors}
+        results = {}
+
+        async def fetch(key, cmd):
+            # Past the readback cache: a cached position can predate the status read alongside it, and finish a
+            # move short of where it ends
+            results[key] = (await beamline.pool.get(cmd)).data
+
+        async with trio.open_nursery() as nursery:
+            for motor in motors:
+                nursery.start_soon(fetch, (motor, 'RBV'), _sansio.GetMotorPosRequest(motor.devicename))
+                nursery.start_soon(fetch, (motor, 'DONE'), _sansio.GetMotorStatusRequest(motor.devicename))
+
+        for motor in motors:
+            if motor.moves != moves[motor]:
+                # A new move started during the round; these results are for the old one
+                continue
+            rbv = results[motor, 'RBV']
+            await motor.user_readback_value.write(rbv)
+            if motor.moves != moves[motor]:
+                continue
+            if abs(motor.setpoint - rbv) < motor.TOLERANCE or motor in self._stopped:
+                self._moving.discard(motor)
+                self._stopped.discard(motor)
+                await motor.motor_is_moving.write(0)
+                if motor.moves == moves[motor]:
+                    await motor.done_moving_to_value.write(1)
+            elif results[motor, 'DONE']:
+                # Position and status are read concurrently, so this RBV may be from before the stop; finish
+                # with the next round's
+                self._stopped.add(motor)
+        await self.group.moving.write(len(self._moving))
+        if self.group.group_moving and not self.group.group_moving & self._moving:
+            self.group.group_moving = set()
+            await self.group.group_done.write(1)
+
+
 async def sender(client_sock, lvs: _sansio.LVS, data):
     # print("sender: started!")
     # print("sender: sending {!r}".format(data))
-    logger.info('packet sent:'+data.str_payload)
+    logger.info('packet sent: %s', data.str_payload)
     await client_sock.send_all(lvs.send(data))
 
 
 async def receiver(client_sock: trio.SocketStream, lvs: _sansio.LVS):
-    _data = []
-    _data.append(await client_sock.receive_some(alsdac.BUFSIZE))
+    """
+    Return the next response, and the time spent framing it.
+
+    Only framing is timed: payloads are decoded lazily, when their data is first read, and that cost falls to the
+    caller.
+    """
+    while True:
+        started = time.perf_counter()
+        event = lvs.next_event()
+        if event is not _sansio.NEED_DATA:
+            frame_time = time.perf_counter() - started
+            logger.info('packet received: %r', event)
+            return event, frame_time
+        lvs.receive_bytes(await client_sock.receive_some(alsdac.BUFSIZE))
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram, in seconds."""
+    __slots__ = ('counts', 'sum')
+    BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, .1, .3, 1., 3.)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # the last is +Inf
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    @property
+    def mean(self):
+        count = self.count
+        return self.sum / count if count else 0.
+
 
-    expcols, exprows, _ = alsdac.stream_size(_data[0])
+class CommandMetrics:
+    __slots__ = ('requests', 'errors', 'bytes_out', 'bytes_in', 'queue_wait', 'wire_time', 'frame_time')
 
-    if exprows and expcols:
-        while not _data[-1].endswith(b'\r\n\r\n'):
-            _data.append(await client_sock.receive_some(alsdac.BUFSIZE))
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.queue_wait = Histogram()
+        self.wire_time = Histogram()
+        self.frame_time = Histogram()
 
-    logger.info('packet received:'+str(b''.join(_data), alsdac.RECEIVE_ENCODING).strip())
-    return lvs.recv(_data)
 
+class Metrics:
+    """Per-command (FNC) request counts, byte counts and latency histograms."""
+
+    def __init__(self):
+        self.commands = collections.defaultdict(CommandMetrics)
+        self.in_flight = 0
+
+    def prometheus(self, prefix='alsdac'):
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = [f'{prefix}_in_flight {self.in_flight}']
+        for fnc, metrics in sorted(self.commands.items()):
+            labels = f'command="{fnc}"'
+            for name in ('requests', 'errors', 'bytes_out', 'bytes_in'):
+                lines.append(f'{prefix}_{name}_total{{{labels}}} {getattr(metrics, name)}')
+            for name in ('queue_wait', 'wire_time', 'frame_time'):
+                histogram = getattr(metrics, name)
+                cumulative = 0
+                for bound, count in zip(histogram.BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_{name}_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_{name}_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'{prefix}_{name}_seconds_count{{{labels}}} {cumulative}')
+        return '\n'.join(lines) + '\n'
 
-# TODO: run update periodically
 
 class DeferDict(dict):
-    def __init__(self, *args, **kwargs):
+    """
+    A pvdb that resolves names it doesn't hold through the pvdbs of subgroups.
+
+    Names are routed by prefix (split on ':'), so a lookup costs one dict probe
+    per ':' in the name; nothing is copied up, so subgroups may add and drop
+    PVs freely. Names that resolve nowhere are remembered in ``misses``, which
+    DeferDicts share with the pvdbs they defer to; CA search storms for names
+    we don't serve are answered from it. Adding PVs (via update) clears it.
+    """
+    MAX_MISSES = 100000
+    context = None  # the DynamicContext serving this pvdb, if any
+
+    def __init__(self, *args, misses=None, **kwargs):
         super(DeferDict, self).__init__(*args, **kwargs)
-        self.defer_to = []
-        self.filter = ''
+        self.routes = {}  # group prefix -> group pvdb
+        self.misses = set() if misses is None else misses
+
+    def defer(self, group):
+        self.routes[group.prefix] = group.pvdb
+        if isinstance(group.pvdb, DeferDict):
+            group.pvdb.misses = self.misses
+
+    def route(self, key):
+        end = key.find(':')
+        while end != -1:
+            pvdb = self.routes.get(key[:end + 1])
+            if pvdb is not None:
+                return pvdb
+            end = key.find(':', end + 1)
+        return None
 
     def __missing__(self, key):
-        if self.filter in key:
-            for group in self.defer_to:
-                if group.prefix in key:
-                    logger.info(f'Deferring {key} to {group.name}')
-                    return group.pvdb[key]
+        if key not in self.misses:
+            pvdb = self.route(key)
+            if pvdb is not None:
+                try:
+                    return pvdb.resolve(key) if isinstance(pvdb, DeferDict) else pvdb[key]
+                except KeyError:
+                    pass
+            if len(self.misses) >= self.MAX_MISSES:
+                self.misses.clear()
+            self.misses.add(key)
+        raise KeyError(key)
 
+    def update(self, *args, **kwargs):
+        super(DeferDict, self).update(*args, **kwargs)
+        self.misses.clear()
 
-class Beamline(PVGroup):
-    def __init__(self, *args, **kwargs):
-        super(Beamline, self).__init__(*args, **kwargs)
-        self._lock = trio.Lock()
+    def resolve(self, key):
+        """Look ``key`` up on behalf of a DeferDict that routed it here."""
+        return self[key]
+
+
+class DeviceDict(DeferDict):
+    """The pvdb of a DynamicLVGroup; builds device PVGroups on first lookup and records when each was used."""
+
+    def __init__(self, group, *args, **kwargs):
+        super(DeviceDict, self).__init__(*args, **kwargs)
+        self.group = group
+
+    def resolve(self, key):
+        value = self[key]
+        self.group.touch(key)
+        return value
+
+    def __missing__(self, key):
+        if key not in self.misses and self.group.instantiate(key):
+            return self[key]
+        return super(DeviceDict, self).__missing__(key)
+
+
+class _ResponseSlot:
+    __slots__ = ('response', 'received_at', 'frame_time', 'nbytes', 'exclusive')
+
+    def __init__(self, exclusive=False):
+        self.response = None
+        self.exclusive = exclusive  # nothing may be sent until this reply is in
+
+
+class LVConnection:
+    """One TCP connection to the LabVIEW server, optionally pipelined."""
+
+    def __init__(self, pipeline=True):
+        self._connect_lock = trio.Lock()
+        self._send_lock = trio.Lock()
+        self._recv_lock = trio.Lock()
         self._socket = None
         self._socket_stream = None
-        self.lvs = _sansio.LVS(_sansio.Role.CLIENT)
+        self.lvs = _sansio.LVS(_sansio.Role.CLIENT, pipeline=pipeline)
+        self._slots = collections.deque()  # one per request in flight, in send order
+        self.queued = 0  # requests accepted by get() and not yet answered
+
+    async def startup_socket(self):
+        async with self._connect_lock:
+            if not self._socket:
+                sock = trio.socket.socket()
+                try:
+                    await sock.connect((alsdac.SERVER_ADDRESS, alsdac.PORT))
+                except BaseException:
+                    # Cancelled or refused; the next caller starts over
+                    sock.close()
+                    raise
+                self._socket = sock
+                self._socket_stream = trio.SocketStream(self._socket)
+
+                self._socket_stream.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                self._socket_stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 1)
+                self._socket_stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 1)
+                self._socket_stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 10)
+                self._socket_stream.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    async def get(self, cmd, stats=None, metrics=None):
+        self.queued += 1
+        command_metrics = metrics.commands[cmd.FNC] if metrics is not None else CommandMetrics()
+        command_metrics.requests += 1
+        try:
+            await self.startup_socket()
+            # Requests are written back to back; whichever caller holds the receive
+            # lock reads responses in order and hands each to its slot until its own
+            # arrives. Replies without an end marker can't have anything queued
+            # behind them, so those hold the send lock for the full round trip.
+            unframed = _sansio.Commands[_sansio.Role.SERVER][cmd.FNC].FRAMING is _sansio.Framing.LINES
+            slot = _ResponseSlot(exclusive=unframed or not self.lvs.pipeline)
+            queued_at = time.perf_counter()
+            async with self._send_lock:
+                if self._slots and self._slots[-1].exclusive:
+                    # Its caller was cancelled while waiting; the reply still has to be read first
+                    await self._receive_until(self._slots[-1])
+                sent_at = time.perf_counter()
+                if stats is not None:
+                    stats.record_wait(sent_at - queued_at)
+                bytes_sent = self.lvs.bytes_sent
+                # lvs expects a reply to every request it frames, so the slot is queued with it and the write
+                # can't be cancelled part way; otherwise every later reply would go to the wrong caller
+                self._slots.append(slot)
+                try:
+                    with trio.CancelScope(shield=True):
+                        await sender(self._socket_stream, self.lvs, cmd)
+                except _sansio.ProtocolError:
+                    self._slots.pop()
+                    raise
+                command_metrics.bytes_out += self.lvs.bytes_sent - bytes_sent
+                if slot.exclusive:
+                    await self._receive_until(slot)
+            await self._receive_until(slot)
+        except BaseException:
+            command_metrics.errors += 1
+            raise
+        finally:
+            self.queued -= 1
+        command_metrics.queue_wait.observe(sent_at - queued_at)
+        command_metrics.wire_time.observe(slot.received_at - sent_at)
+        command_metrics.frame_time.observe(slot.frame_time)
+        command_metrics.bytes_in += slot.nbytes
+        return slot.response
+
+    async def _receive_until(self, slot):
+        async with self._recv_lock:
+            while slot.response is None:
+                consumed = self.lvs.bytes_consumed
+                response, frame_time = await receiver(self._socket_stream, self.lvs)
+                waiting = self._slots.popleft()
+                waiting.response = response
+                waiting.received_at = time.perf_counter() - frame_time
+                waiting.frame_time = frame_time
+                waiting.nbytes = self.lvs.bytes_consumed - consumed
+
+
+class LaneStats:
+    __slots__ = ('requests', 'max_depth', 'total_wait', 'max_wait')
+
+    def __init__(self):
+        self.requests = 0
+        self.max_depth = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+
+    def record_wait(self, wait):
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class ConnectionPool:
+    """
+    Routes requests over several LabVIEW connections.
+
+    Each request class maps to a lane (``'scalar'`` unless listed in
+    ``routes``); each lane owns its own connections, so bulk transfers never
+    hold up scalar queries. Within a lane the least busy connection is used.
+    """
+    ROUTES = {_sansio.GetInstrumentAcquired1DRequest: 'bulk',
+              _sansio.GetInstrumentAcquired2DRequest: 'bulk',
+              _sansio.GetInstrumentAcquired2DBinaryRequest: 'bulk',
+              _sansio.GetInstrumentAcquired3DRequest: 'bulk',
+              _sansio.GetFlyingPositionsRequest: 'bulk'}
+    LANES = {'scalar': 1, 'bulk': 1}
+
+    def __init__(self, lanes=None, routes=None, pipeline=True, metrics=None):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.routes = {**self.ROUTES, **(routes or {})}
+        self.lanes = {lane: [LVConnection(pipeline=pipeline) for _ in range(size)]
+                      for lane, size in dict(self.LANES, **(lanes or {})).items()}
+        self.lane_stats = {lane: LaneStats() for lane in self.lanes}
+
+    async def get(self, cmd):
+        lane = self.routes.get(type(cmd), 'scalar')
+        connection = min(self.lanes[lane], key=lambda conn: conn.queued)
+        stats = self.lane_stats[lane]
+        stats.requests += 1
+        stats.max_depth = max(stats.max_depth, self.depth(lane) + 1)
+        self.metrics.in_flight += 1
+        try:
+            return await connection.get(cmd, stats, self.metrics)
+        finally:
+            self.metrics.in_flight -= 1
+
+    def depth(self, lane):
+        return sum(conn.queued for conn in self.lanes[lane])
+
+    def stats(self):
+        return {lane: {'connections': len(self.lanes[lane]),
+                       'depth': self.depth(lane),
+                       'max_depth': stats.max_depth,
+                       'requests': stats.requests,
+                       'mean_wait': stats.total_wait / stats.requests if stats.requests else 0.,
+                       'max_wait': stats.max_wait}
+                for lane, stats in self.lane_stats.items()}
+
+
+class ReadbackCache:
+    """
+    Shares responses to CACHEABLE requests for up to ``max_age`` seconds.
+
+    Concurrent identical requests are coalesced into a single round trip
+    through ``get``; everything else passes straight through.
+    """
+
+    def __init__(self, get, max_age=.05):
+        self._get = get
+        self.max_age = max_age
+        self._entries = {}  # request payload -> (time requested, response)
+        self._in_flight = {}  # request payload -> trio.Event
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, cmd):
+        if not cmd.CACHEABLE:
+            return await self._get(cmd)
+
+        key = cmd.str_payload
+        while True:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= self.max_age:
+                self.hits += 1
+                return entry[1]
+            event = self._in_flight.get(key)
+            if event is None:
+                break
+            # Someone is already asking; wait for their answer (or failure)
+            self.coalesced += 1
+            await event.wait()
+
+        self.misses += 1
+        event = self._in_flight[key] = trio.Event()
+        try:
+            requested = time.monotonic()
+            response = await self._get(cmd)
+            self._entries[key] = (requested, response)
+            return response
+        finally:
+            del self._in_flight[key]
+            event.set()
+
+    def invalidate(self, cmd):
+        self._entries.pop(cmd.str_payload, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                'entries': len(self._entries), 'max_age': self.max_age}
+
+
+class Beamline(PVGroup):
+    def __init__(self, *args, pipeline=True, lanes=None, cache_max_age=.05, **kwargs):
+        super(Beamline, self).__init__(*args, **kwargs)
+        self.pool = ConnectionPool(lanes=lanes, pipeline=pipeline)
+        self.cache = ReadbackCache(self.pool.get, max_age=cache_max_age)
 
         # Make pvdb defer to subgroups
         self.pvdb = DeferDict()
-        self.pvdb.filter = self.prefix
-        self.pvdb.defer_to = [self.Motors, self.Detectors, self.AnalogInputs, self.DigitalInputOutputs]
+        for group in self.Motors, self.Detectors, self.AnalogInputs, self.DigitalInputOutputs, self.Stats:
+            self.pvdb.defer(group)
 
     async def update(self):
         for group in self.Detectors, self.AnalogInputs, self.DigitalInputOutputs, self.Motors:
             await group.update()  # Ignore introspection warning
 
-    async def startup_socket(self):
-        if not self._socket:
-            self._socket = trio.socket.socket()
-            await self._socket.connect((alsdac.SERVER_ADDRESS, alsdac.PORT))
-            self._socket_stream = trio.SocketStream(self._socket)
+    async def get(self, cmd):
+        return await self.cache.get(cmd)
 
-            self._socket_stream.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            self._socket_stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 1)
-            self._socket_stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 1)
-            self._socket_stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 10)
-            self._socket_stream.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    async def background(self):
+        """
+        Run the beamline's background tasks until cancelled.
 
-    async def get(self, cmd):
-        async with self._lock:
-            await self.startup_socket()
-            await sender(self._socket_stream, self.lvs, cmd)
-            result = await receiver(self._socket_stream, self.lvs)
-            return result
+        The pvdb defers to subgroups, so the server never sees their startup
+        or shutdown hooks; main() runs this alongside the server instead, and
+        it shuts the Detectors down on the way out.
+        """
+        try:
+            async with trio.open_nursery() as nursery:
+                for group in self.Detectors, self.AnalogInputs, self.DigitalInputOutputs, self.Motors:
+                    nursery.start_soon(group.discover)
+                nursery.start_soon(self.Motors.scanner.run)
+                nursery.start_soon(self.Detectors.acquisitions.run)
+                nursery.start_soon(self.Stats.run)
+        finally:
+            # Shared memory outlives the process unless it's unlinked
+            with trio.CancelScope(shield=True):
+                await self.Detectors.shutdown()
+
+    def prometheus(self):
+        """Wire, lane and cache metrics in the Prometheus text exposition format."""
+        lines = [self.pool.metrics.prometheus()]
+        for lane, stats in self.pool.stats().items():
+            for name, value in stats.items():
+                lines.append(f'alsdac_lane_{name}{{lane="{lane}"}} {value}\n')
+        for name, value in self.cache.stats().items():
+            lines.append(f'alsdac_cache_{name} {value}\n')
+        return ''.join(lines)
+
+    @SubGroup(prefix='stats:')
+    class Stats(PVGroup):
+        """Wire metrics, refreshed every ``update_period`` seconds; see Metrics."""
+        update_period = pvproperty(value=1., dtype=float, doc='Refresh period (s)')
+        requests = pvproperty(value=0, dtype=int, read_only=True)
+        errors = pvproperty(value=0, dtype=int, read_only=True)
+        bytes_in = pvproperty(value=0, dtype=int, read_only=True)
+        bytes_out = pvproperty(value=0, dtype=int, read_only=True)
+        in_flight = pvproperty(value=0, dtype=int, read_only=True)
+        cache_hits = pvproperty(value=0, dtype=int, read_only=True)
+        cache_misses = pvproperty(value=0, dtype=int, read_only=True)
+
+        # Per-command values, aligned with ``commands``
+        commands = pvproperty(value=[], dtype=ChannelType.STRING, max_length=256, read_only=True)
+        command_requests = pvproperty(value=[], dtype=int, max_length=256, read_only=True)
+        command_bytes_in = pvproperty(value=[], dtype=int, max_length=256, read_only=True)
+        mean_queue_wait = pvproperty(value=[], dtype=float, max_length=256, read_only=True)
+        mean_wire_time = pvproperty(value=[], dtype=float, max_length=256, read_only=True)
+        mean_frame_time = pvproperty(value=[], dtype=float, max_length=256, read_only=True)
+
+        prometheus = pvproperty(value='', dtype=ChannelType.CHAR, max_length=1 << 20, read_only=True,
+                                doc='Prometheus text dump')
+
+        async def run(self):
+            while True:
+                await self.refresh()
+                await trio.sleep(max(self.update_period.value, .1))
+
+        async def refresh(self):
+            beamline = self.parent
+            commands = sorted(beamline.pool.metrics.commands.items())
+            metrics = [command for _, command in commands]
+            await self.requests.write(sum(command.requests for command in metrics))
+            await self.errors.write(sum(command.errors for command in metrics))
+            await self.bytes_in.write(sum(command.bytes_in for command in metrics))
+            await self.bytes_out.write(sum(command.bytes_out for command in metrics))
+            await self.in_flight.write(beamline.pool.metrics.in_flight)
+            await self.cache_hits.write(beamline.cache.hits)
+            await self.cache_misses.write(beamline.cache.misses)
+            await self.commands.write([fnc for fnc, _ in commands])
+            await self.command_requests.write([command.requests for command in metrics])
+            await self.command_bytes_in.write([command.bytes_in for command in metrics])
+            await self.mean_queue_wait.write([command.queue_wait.mean for command in metrics])
+            await self.mean_wire_time.write([command.wire_time.mean for command in metrics])
+            await self.mean_frame_time.write([command.frame_time.mean for command in metrics])
+
+        @prometheus.getter
+        async def prometheus(self, instance):
+            return self.parent.prometheus()
 
     @SubGroup(prefix='instruments:')
     class Detectors(DynamicLVGroup):
@@ -241,6 +1211,24 @@ class Beamline(PVGroup):
         device_list_message_cls = _sansio.ListInstrumentsRequest
         device_cls = Instrument
 
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.acquisitions = AcquisitionRunner()
+
+        def busy(self, name):
+            device = self.device_groups[name]
+            return (device.acquisition.active or device.writer is not None or device.shared is not None
+                    or super().busy(name))
+
+        def evict(self, name):
+            self.device_groups[name].acquisition.close()
+            super().evict(name)
+
+        async def shutdown(self):
+            """Stop sharing frames, unlinking every instrument's shared memory block."""
+            for device in self.device_groups.values():
+                await device.stop_sharing()
+
     @SubGroup(prefix='ais:')
     class AnalogInputs(DynamicLVGroup):
         pvname = 'AnalogInput'
@@ -262,12 +1250,58 @@ class Beamline(PVGroup):
         device_list_message_cls = _sansio.ListMotorsRequest
         device_cls = Motor
 
+        moving = pvproperty(value=0, dtype=int, read_only=True, doc='Number of motors in motion')
+
+        # Grouped moves: set group_names, then write group_setpoints to start them all with one MoveAllMotors
+        group_names = pvproperty(value=[], dtype=ChannelType.STRING, max_length=64, doc='Motors to move together')
+        group_setpoints = pvproperty(value=[], dtype=float, max_length=64, doc='Targets for group_names; writing moves')
+        group_done = pvproperty(value=1, dtype=int, read_only=True, doc='0 until every motor of the last group move stops')
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.scanner = MotorScanner(self)
+            self.group_moving = set()
+
+        @group_setpoints.putter
+        async def group_setpoints(self, instance, value):
+            names = self.group_names.value
+            if len(names) != len(value):
+                raise ValueError(f'{len(value)} setpoints for {len(names)} motors')
+            unknown = [name for name in names if name not in (self._device_names or ())]
+            if unknown:
+                raise ValueError(f'unknown motors: {", ".join(unknown)}')
+            motors = [self.device(name) for name in names]
+            await self.group_done.write(0)
+            for motor in motors:
+                await motor.start_move()
+            try:
+                await self.parent.get(_sansio.MoveAllMotorsRequest.from_positions(zip(names, value)))
+            except Exception:
+                for motor in motors:
+                    await motor.motor_is_moving.write(0)
+                    await motor.done_moving_to_value.write(1)
+                await self.group_done.write(1)
+                raise
+            for motor, setpoint in zip(motors, value):
+                motor.track_move(setpoint)
+            self.group_moving = set(motors)
+
+        def busy(self, name):
+            return self.device_groups[name] in self.scanner or super().busy(name)
+
 
 class DynamicContext(Context):
-    def __init__(self, update, *args, **kwargs):
-        super(DynamicContext, self).__init__(*args, **kwargs)
+    def __init__(self, update, pvdb, *args, **kwargs):
+        super(DynamicContext, self).__init__(pvdb, *args, **kwargs)
         self._devices_inited = False
         self.update = update
+        if isinstance(pvdb, DeferDict):
+            # So groups can tell which of their PVs clients hold channels to
+            pvdb.context = self
+
+    def open_channels(self):
+        """Names of the channels clients have open."""
+        return {channel.name for circuit in self.circuits for channel in circuit.circuit.channels.values()}
 
     async def _broadcaster_evaluate(self, addr, commands):
         if not self._devices_inited:
@@ -276,9 +1310,14 @@ class DynamicContext(Context):
         await super(DynamicContext, self)._broadcaster_evaluate(addr, commands)
 
 
-async def main(update, pvdb, log_pv_names):
+async def main(update, pvdb, log_pv_names, background=None):
     ctx = DynamicContext(update, pvdb)
-    return await ctx.run(log_pv_names=log_pv_names)
+    async with trio.open_nursery() as nursery:
+        if background is not None:
+            nursery.start_soon(background)
+        result = await ctx.run(log_pv_names=log_pv_names)
+        nursery.cancel_scope.cancel()
+    return result
 
 
 if __name__ == '__main__':
@@ -291,15 +1330,18 @@ if __name__ == '__main__':
         alsdac.set_server_address(sys.argv['--address'])
     if '--port' in sys.argv:
         alsdac.set_port(sys.argv['--port'])
+    pipeline = '--no-pipeline' not in sys.argv
+    if not pipeline:
+        sys.argv.remove('--no-pipeline')
 
     ioc_options, run_options = ioc_arg_parser(
         default_prefix='beamline:',
         desc='als test')
-    ioc = Beamline(**ioc_options)
+    ioc = Beamline(pipeline=pipeline, **ioc_options)
     # run(ioc.pvdb, **run_options)
     
     print(run_options)
-    trio.run(main, ioc.update, ioc.pvdb, '--list-pvs' in sys.argv)
+    trio.run(main, ioc.update, ioc.pvdb, '--list-pvs' in sys.argv, ioc.background)
 
     # # Afterwards, you can connect to these devices like:
     # import os
@@ -8,12 +8,12 @@ import pyqtgraph.ptime as ptime
 
 # Connect to camera
 import os
-from scipy import ndimage
 
 os.environ['OPHYD_CONTROL_LAYER'] = 'caproto'
 from alsdac.ophyd import Instrument
 
 cam = Instrument('beamline:instruments:ptGreyInstrument', name='cam')
+cam.threshold.put(.2)  # leave the background out of the centroid
 
 app = QtGui.QApplication([])
 
@@ -49,12 +49,13 @@ def updateData(success=False, **kwargs):
     # if not success: return
     global img, data, i, updateTime, fps, center, autolevel
     ## Display the data
-    data = cam.read()['cam_image']['value']
+    # The IOC bins the frame and finds its centroid; only the preview and two numbers come over CA
+    data = cam.read_preview()
     img.setImage(data, autoLevels=autolevel)
     autolevel = False
 
-    centroid = ndimage.measurements.center_of_mass(np.ma.masked_less(data,data.max()*.2))
-    centroidplot.setData(x=[centroid[1]], y=[centroid[0]])
+    binning = cam.binning.get()
+    centroidplot.setData(x=[cam.centroid_y.get() / binning], y=[cam.centroid_x.get() / binning])
 
     now = ptime.time()
     fps2 = 1.0 / (now - updateTime)
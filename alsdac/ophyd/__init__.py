@@ -1,8 +1,12 @@
 import os
-import time
+import threading
+from functools import partial
 
 os.environ['OPHYD_CONTROL_LAYER'] = 'caproto'
-from ophyd import Device, Component, EpicsSignal, EpicsSignalRO, EpicsMotor, get_cl
+from ophyd import Device, Component, EpicsSignal, EpicsSignalRO, EpicsMotor, PseudoPositioner
+from ophyd.status import DeviceStatus, wait as status_wait
+
+from alsdac.shm import FrameRingReader
 
 
 class Instrument(Device):
@@ -12,6 +16,48 @@ class Instrument(Device):
     size_x = Component(EpicsSignalRO, '.size_x')
     size_y = Component(EpicsSignalRO, '.size_y')
 
+    # Reductions the IOC computes once per frame
+    rois = Component(EpicsSignal, '.rois', kind='config')
+    roi_sums = Component(EpicsSignalRO, '.roi_sums')
+    frame_sum = Component(EpicsSignalRO, '.frame_sum')
+    frame_max = Component(EpicsSignalRO, '.frame_max')
+    centroid_x = Component(EpicsSignalRO, '.centroid_x', kind='hinted')
+    centroid_y = Component(EpicsSignalRO, '.centroid_y', kind='hinted')
+    sigma_x = Component(EpicsSignalRO, '.sigma_x')
+    sigma_y = Component(EpicsSignalRO, '.sigma_y')
+    threshold = Component(EpicsSignal, '.threshold', kind='config')
+    binning = Component(EpicsSignal, '.binning', kind='config')
+    preview = Component(EpicsSignalRO, '.preview', kind='omitted')
+    preview_x = Component(EpicsSignalRO, '.preview_x', kind='omitted')
+    preview_y = Component(EpicsSignalRO, '.preview_y', kind='omitted')
+
+    # Frames shared in memory by the IOC, for readers on its host
+    share_slots = Component(EpicsSignal, '.share_slots', kind='config')
+    share_name = Component(EpicsSignalRO, '.share_name', string=True, kind='omitted')
+    _shared = None
+
+    def shared_frames(self):
+        """
+        A FrameRingReader of the frames the IOC shares in memory; only works on the IOC's host.
+
+        Set share_slots first. Frames come back as views into shared memory, with no copy or CA transfer.
+        """
+        # The block's name only depends on the IOC's prefix, and the reader follows the block when it's replaced
+        if self._shared is None:
+            name = self.share_name.get()
+            if not name:
+                raise RuntimeError(f'{self.name} shares no frames; set share_slots first')
+            self._shared = FrameRingReader(name)
+        return self._shared
+
+    def read_shared(self, copy=False):
+        """The newest frame, read through shared memory rather than CA; see shared_frames."""
+        return self.shared_frames().latest(copy=copy)[1]
+
+    def read_preview(self):
+        """The current frame, binned by the IOC; a fraction of the size of image."""
+        return self.preview.get().reshape(self.preview_x.get(), self.preview_y.get())
+
     def read(self):
         # while True:
         #     try:
@@ -30,39 +76,206 @@ class Instrument(Device):
     # except TimeoutError:
     #     print('Waiting for response; connection is slow...')
 
+class _PendingMove:
+    __slots__ = ('status', 'target', 'started')
+
+    def __init__(self, status, target):
+        self.status = status
+        self.target = target
+        self.started = False  # DMOV has gone low since the move was registered
+
+
+class MoveWatcher:
+    """
+    Finishes the MoveStatus of every pending Motor move in the process.
+
+    Completion is driven by CA monitors on each motor's RBV and DMOV rather
+    than by polling: once DMOV has dropped since the move was registered, the
+    move is done when RBV comes within ``tolerance`` of the target or when
+    DMOV rises again. Monitor callbacks can lag the put that starts a move,
+    so until this move's own drop arrives, an RBV at the target (the cached
+    one, say, or the motor already being there) or a DMOV rise from the
+    previous move says nothing about it. Waiting for the drop also means a
+    move is never finished before the IOC has seen it, so its DMOV rise can't
+    turn up later and finish the next move. Moves that take longer than
+    ``timeout`` fail through the status object's own timeout. Finishing a
+    move early relies on ophyd internals; see _finish_move.
+    """
+
+    def __init__(self, tolerance=1e-4, timeout=None):
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self._pending = {}  # motor -> [_PendingMove, ...]
+        self._subscribed = set()
+        self._lock = threading.Lock()
+
+    def watch(self, motor, status, target):
+        with self._lock:
+            if motor not in self._subscribed:
+                motor.user_readback.subscribe(partial(self._readback_changed, motor), run=False)
+                motor.motor_done_move.subscribe(partial(self._done_move_changed, motor), run=False)
+                self._subscribed.add(motor)
+            self._pending.setdefault(motor, []).append(_PendingMove(status, target))
+
+    def _readback_changed(self, motor, value=None, **kwargs):
+        if value is None:
+            return
+        self._finish(motor, lambda move: move.started and abs(value - move.target) < self.tolerance)
+
+    def _done_move_changed(self, motor, value=None, **kwargs):
+        if value == 0:
+            with self._lock:
+                for move in self._pending.get(motor, []):
+                    move.started = True
+        elif value == 1:
+            self._finish(motor, lambda move: move.started)
+
+    def _finish(self, motor, arrived):
+        with self._lock:
+            pending = self._pending.get(motor, [])
+            finished = [move for move in pending if move.status.done or arrived(move)]
+            if not finished:
+                return
+            self._pending[motor] = [move for move in pending if move not in finished]
+        if any(not move.status.done for move in finished):
+            _finish_move(motor)
+
+
+def _finish_move(motor):
+    """
+    Finish ``motor``'s current move now, as EpicsMotor's own DMOV callback would when DMOV rises.
+
+    ophyd has no public way to do this, so it goes through two private members, checked against ophyd 1.11.2 (the
+    tests in tests/test_ophyd.py exercise both): PositionerBase._done_moving() finishes the MoveStatus that move()
+    returned and runs the positioner's done callbacks, so EpicsMotor finds nothing left to finish when DMOV does
+    rise; and EpicsMotor._moving is cleared, since otherwise that DMOV rise, which belongs to this move, would
+    finish the next one.
+    """
+    motor._moving = False
+    motor._done_moving(success=True)
+
+
+_move_watcher = None
+
+
+def move_watcher():
+    """Return the process-wide MoveWatcher, creating it on first use."""
+    global _move_watcher
+    if _move_watcher is None:
+        _move_watcher = MoveWatcher()
+    return _move_watcher
+
+
 class Motor(EpicsMotor):
-    def __init__(self, *args, **kwargs):
-        super(Motor, self).__init__(*args, **kwargs)
-        self._status_threads = []
-
-    def move(self, *args, **kwargs):
-        status = super(Motor, self).move(*args, **kwargs)
-        def statusmonitor_thread():
-            thisthread = self._status_threads[-1]
-            try:
-                while True:
-                    time.sleep(.01)
-                    # check if within threshold
-                    if abs(self.user_readback.get(use_monitor=False)-self.user_setpoint.get()) < .0001:
-                        success = True
-                        break
-            except TimeoutError:
-                # logger.debug('automonitor(%r, %s) timed out', self.name)
-                success = False
-            except Exception as ex:
-                # logger.debug('automonitor(%r, %s) failed', self.name, exc_info=ex)
-                success = False
-            finally:
-                status._finished(success=success)
-                self._status_threads.remove(thisthread)
-                del thisthread
-
-        statusthread = get_cl().thread_class(target=statusmonitor_thread)
-        self._status_threads.append(statusthread)
-        statusthread.daemon = True
-        statusthread.start()
+    def move(self, position, wait=True, timeout=None, **kwargs):
+        watcher = move_watcher()
+        if timeout is None:
+            timeout = watcher.timeout
+        status = super(Motor, self).move(position, wait=False, timeout=timeout, **kwargs)
+        watcher.watch(self, status, position)
+        if wait:
+            status_wait(status)
         return status
 
+
+class FlyingMotor(Motor):
+    """
+    A Motor that is also a Bluesky flyer.
+
+    Set ``breakpoints`` (positions to latch at) and ``fly_target``; kickoff()
+    starts the move, complete() finishes with it, and collect() yields one
+    event per latched position, read as one float32 waveform over CA.
+    """
+    breakpoints = Component(EpicsSignal, '.breakpoints', kind='config')
+    flying_positions = Component(EpicsSignalRO, '.flying_positions', kind='omitted')
+
+    def __init__(self, *args, fly_target=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fly_target = fly_target
+        self._fly_status = None
+
+    def kickoff(self):
+        if self.fly_target is None:
+            raise RuntimeError(f'{self.name}.fly_target is not set')
+        self._fly_status = self.move(self.fly_target, wait=False)
+        status = DeviceStatus(self)
+        status._finished(success=True)
+        return status
+
+    def complete(self):
+        if self._fly_status is None:
+            raise RuntimeError(f'{self.name} has not been kicked off')
+        return self._fly_status
+
+    def describe_collect(self):
+        return {self.name: {f'{self.name}_flying_position': {'source': f'PV:{self.flying_positions.pvname}',
+                                                             'dtype': 'number', 'shape': [],
+                                                             'precision': self.precision}}}
+
+    def collect(self):
+        self._fly_status = None
+        reading = self.flying_positions.read()[self.flying_positions.name]
+        key = f'{self.name}_flying_position'
+        timestamp = reading['timestamp']
+        for position in reading['value'].tolist():
+            yield {'time': timestamp, 'data': {key: position}, 'timestamps': {key: timestamp}}
+
+
+class MotorGroup(Device):
+    """
+    Grouped moves through the IOC's motors group (e.g. prefix 'beamline:motors:').
+
+    set({name: position, ...}) starts every motor with one MoveAllMotors
+    command and returns one status, finished when the IOC reports that all
+    of them have stopped.
+    """
+    names = Component(EpicsSignal, 'group_names', string=True)
+    setpoints = Component(EpicsSignal, 'group_setpoints')
+    done = Component(EpicsSignalRO, 'group_done', auto_monitor=True)
+
+    def set(self, positions, timeout=None):
+        names, setpoints = zip(*dict(positions).items())
+        status = DeviceStatus(self, timeout=timeout)
+
+        def done_changed(value=None, old_value=None, **kwargs):
+            if old_value == 0 and value == 1:
+                self.done.clear_sub(done_changed)
+                status._finished(success=True)
+
+        self.names.put(list(names), wait=True)
+        self.done.subscribe(done_changed, run=False)
+        self.setpoints.put(list(setpoints), wait=True)
+        return status
+
+
+class GroupedPseudoPositioner(PseudoPositioner):
+    """
+    A PseudoPositioner whose real axes are alsdac Motors, all moved by one command.
+
+    Each pseudo move sends its real positions through ``motor_group`` (a
+    MotorGroup for the motors' IOC group) rather than moving every axis on
+    its own, so the axes start together and finish on one status:
+
+        class Raster(GroupedPseudoPositioner):
+            px = Cpt(PseudoSingle)
+            py = Cpt(PseudoSingle)
+            x = Cpt(Motor, 'esp300axis1')
+            y = Cpt(Motor, 'esp300axis2')
+            ...
+
+        raster = Raster('beamline:motors:', motor_group=MotorGroup('beamline:motors:', name='group'), name='raster')
+    """
+
+    def __init__(self, *args, motor_group, **kwargs):
+        self.motor_group = motor_group
+        super().__init__(*args, **kwargs)
+
+    def _concurrent_move(self, real_pos, timeout=None, **kwargs):
+        positions = {real.prefix.rsplit(':', 1)[-1]: value for real, value in zip(self._real, real_pos)}
+        status = self.motor_group.set(positions, timeout=timeout)
+        status.add_callback(lambda status: self._done_moving(success=status.success))
+
+
 class ScalarInstrument(Device):
     image = Component(EpicsSignalRO, '.scalarread')
     sig_trigger = Component(EpicsSignal, '.trigger', trigger_value=True)
@@ -0,0 +1,237 @@
+"""
+Frames shared in memory with consumers on the IOC's host.
+
+An IOC Instrument with share_slots set copies every frame it fetches into a ring of that many frame buffers in one
+multiprocessing.shared_memory block, and publishes the block's name as its share_name PV. Readers map the same
+block and get read-only numpy views of the frames, with no copy and no serialization:
+
+    ring = FrameRingReader(name)
+    frame_id, frame = ring.latest()
+
+A view stays good until the ring comes round to its slot again, ``slots`` frames later; ring.valid(frame_id) tells
+whether it has. get(..., copy=True) returns a copy checked not to have been overwritten while it was taken.
+
+The block holds a header, then a record per slot, then the slot buffers. A slot's ``seq`` is odd while the writer
+fills it and even otherwise, so readers can tell when a frame changed under them. A block is retired (and a new
+one made under the same name) when a frame outgrows its slots; readers reattach when they notice, and see an
+empty ring while there's no block to attach to.
+"""
+import mmap
+import os
+import secrets
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+MAGIC = b'ALSFRM1\0'
+MAX_NDIM = 4
+ALIGN = 64
+HEADER = np.dtype([('magic', 'S8'), ('retired', '<u4'), ('slots', '<u4'), ('slot_bytes', '<u8'), ('latest', '<u8')])
+SLOT = np.dtype([('seq', '<u8'), ('frame_id', '<u8'), ('ndim', '<u4'), ('shape', '<u4', (MAX_NDIM,)),
+                 ('dtype', 'S16')])
+
+
+def _aligned(nbytes):
+    return -(-nbytes // ALIGN) * ALIGN
+
+
+def _layout(buf, slots=None):
+    """Views of the header and slot records in ``buf``, and the offset of the first slot buffer."""
+    header = np.ndarray((), HEADER, buffer=buf)
+    if slots is None:
+        slots = int(header['slots'])
+    records = np.ndarray((slots,), SLOT, buffer=buf, offset=ALIGN)
+    return header, records, _aligned(ALIGN + slots * SLOT.itemsize)
+
+
+SHM_DIR = '/dev/shm'
+
+
+def _attach(name):
+    """
+    Map block ``name`` read-only; returns the mmap, which stays mapped for as long as any view of it exists.
+
+    This maps the block's file directly rather than through SharedMemory: numpy doesn't hold on to the buffers it
+    views, so SharedMemory.close() (which runs when the object is collected) would unmap frames still in use, and
+    before Python 3.13 attaching registers the block with the resource tracker, which would unlink it from under the
+    IOC when the reader exits. Raises FileNotFoundError if there's no block (yet).
+    """
+    fd = os.open(os.path.join(SHM_DIR, name), os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size < ALIGN:
+            # Made, but not sized yet
+            raise FileNotFoundError(f'{name} is being created')
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
+class FrameRing:
+    """
+    The writing side: publishes frames into a ring of ``slots`` buffers in shared memory block ``name``.
+
+    The block is made when the first frame is published, with slots sized to fit it. publish() and close() may be
+    called from different threads; once closed, the ring publishes nothing.
+    """
+
+    def __init__(self, name=None, slots=4):
+        self.name = name or f'alsdac_{secrets.token_hex(4)}'
+        self.slots = slots
+        self.closed = False
+        self._shm = None
+        self._header = self._records = None
+        self._data_start = self._slot_bytes = 0
+        self._lock = threading.Lock()  # so close() can't unmap the block under a publish()
+
+    def publish(self, frame, frame_id):
+        """Copy ``frame`` into the ring as ``frame_id``; ids must increase."""
+        frame = np.ascontiguousarray(frame)
+        if frame.ndim > MAX_NDIM:
+            raise ValueError(f'frames may have at most {MAX_NDIM} dimensions, not {frame.ndim}')
+        with self._lock:
+            if not self.closed:
+                self._publish(frame, frame_id)
+
+    def _publish(self, frame, frame_id):
+        if self._shm is None or frame.nbytes > self._slot_bytes:
+            self._create(frame.nbytes)
+        records = self._records
+        slot = frame_id % self.slots
+        records['seq'][slot] += 1  # odd: being written
+        start = self._data_start + slot * self._slot_bytes
+        np.ndarray(frame.shape, frame.dtype, buffer=self._shm.buf, offset=start)[...] = frame
+        records['frame_id'][slot] = frame_id
+        records['ndim'][slot] = frame.ndim
+        records['shape'][slot] = frame.shape + (0,) * (MAX_NDIM - frame.ndim)
+        records['dtype'][slot] = frame.dtype.str.encode()
+        records['seq'][slot] += 1
+        self._header['latest'] = frame_id
+
+    def _create(self, frame_bytes):
+        self._retire()
+        self._slot_bytes = _aligned(max(frame_bytes, 1))
+        size = _aligned(ALIGN + self.slots * SLOT.itemsize) + self.slots * self._slot_bytes
+        try:
+            self._shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by an IOC that didn't exit cleanly
+            shared_memory.SharedMemory(name=self.name).unlink()
+            self._shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        self._header, self._records, self._data_start = _layout(self._shm.buf, self.slots)
+        self._records[...] = 0
+        self._header['slots'] = self.slots
+        self._header['slot_bytes'] = self._slot_bytes
+        self._header['latest'] = 0
+        self._header['retired'] = 0
+        self._header['magic'] = MAGIC
+
+    def close(self):
+        """Retire and unlink the block; readers still holding views keep their mapping until they drop them."""
+        with self._lock:
+            self.closed = True
+            self._retire()
+
+    def _retire(self):
+        if self._shm is None:
+            return
+        self._header['retired'] = 1
+        self._header = self._records = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+
+class FrameRingReader:
+    """
+    The reading side of a FrameRing, by block name.
+
+    While the block doesn't exist (before the first frame, or between a retire and the next frame) the ring reads
+    as empty.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._header = self._records = None
+        self.slots = self._slot_bytes = self._data_start = 0
+        self._refresh()
+
+    def _attach(self):
+        try:
+            buf = memoryview(_attach(self.name))
+        except FileNotFoundError:
+            self._header = self._records = None
+            return
+        header, records, data_start = _layout(buf)
+        if header['magic'] != MAGIC:
+            if header['magic']:
+                raise ValueError(f'{self.name} is not a frame ring')
+            # The writer sets the magic last, once the block is ready
+            self._header = self._records = None
+            return
+        self._buf = buf
+        self._header, self._records, self._data_start = header, records, data_start
+        self.slots = int(header['slots'])
+        self._slot_bytes = int(header['slot_bytes'])
+
+    def _refresh(self):
+        """Whether there's a block to read, attaching to a new one if the last was retired."""
+        if self._header is None or self._header['retired']:
+            # Views already handed out keep the old mapping alive until they go
+            self._attach()
+        return self._header is not None
+
+    @property
+    def latest_id(self):
+        """Id of the newest frame in the ring; 0 before the first."""
+        if not self._refresh():
+            return 0
+        return int(self._header['latest'])
+
+    def latest(self, copy=False):
+        """(frame id, frame) of the newest frame."""
+        frame_id = self.latest_id
+        return frame_id, self.get(frame_id, copy=copy)
+
+    def get(self, frame_id, copy=False):
+        """
+        Frame ``frame_id``, as a view into shared memory or, with ``copy``, a private copy.
+
+        Raises KeyError if the frame isn't in the ring (any more).
+        """
+        if not self._refresh():
+            raise KeyError(frame_id)
+        records = self._records
+        slot = frame_id % self.slots
+        seq = records['seq'][slot]
+        if seq % 2 or records['frame_id'][slot] != frame_id or not frame_id:
+            raise KeyError(frame_id)
+        shape = tuple(int(n) for n in records['shape'][slot][:records['ndim'][slot]])
+        frame = np.ndarray(shape, np.dtype(records['dtype'][slot].decode()), buffer=self._buf,
+                           offset=self._data_start + slot * self._slot_bytes)
+        if copy:
+            frame = frame.copy()
+            if records['seq'][slot] != seq:
+                raise KeyError(frame_id)
+        return frame
+
+    def valid(self, frame_id):
+        """Whether frame ``frame_id`` (and so any view of it) is still intact in the ring."""
+        if self._header is None and not self._refresh():
+            return False
+        records = self._records
+        slot = frame_id % self.slots
+        return not self._header['retired'] and records['frame_id'][slot] == frame_id and not records['seq'][slot] % 2
+
+    def wait(self, after=0, timeout=None, period=.001):
+        """Poll until a frame newer than ``after`` is published; return its id, or None on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            frame_id = self.latest_id
+            if frame_id > after:
+                return frame_id
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(period)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+A stand-in for the LabVIEW DAC server, for testing and benchmarking off the beamline.
+
+Serves simulated motors, AIs, DIOs and instruments over the same TCP protocol, using the _sansio message classes
+in the server role. Latency, jitter, motion dynamics, chunked delivery and frame sizes are all configurable:
+
+    python -m alsdac.simulator --port 55000 --latency .002 --shape 2048 2048
+
+Then point clients at it with alsdac.set_server_address('127.0.0.1').
+"""
+import argparse
+import logging
+import math
+import random
+
+import numpy as np
+import trio
+
+from alsdac import _sansio
+
+logger = logging.getLogger('alsdac.simulator')
+
+BUFSIZE = 163840
+
+
+class SimMotor:
+    def __init__(self, name, position=0., velocity=1.):
+        self.name = name
+        self.velocity = velocity
+        self.enabled = True
+        self.soft_limits = (-100., 100.)
+        self.breakpoints = np.empty(0)
+        self._start = self._target = position
+        self._t0 = self._t1 = 0.
+
+    def position(self, now):
+        if now >= self._t1:
+            return self._target
+        return self._start + (self._target - self._start) * (now - self._t0) / (self._t1 - self._t0)
+
+    def moving(self, now):
+        return now < self._t1
+
+    def flying_positions(self, now):
+        """Breakpoints crossed since the last move started."""
+        low, high = sorted((self._start, self.position(now)))
+        crossed = self.breakpoints[(self.breakpoints >= low) & (self.breakpoints <= high)]
+        return crossed if self._target >= self._start else crossed[::-1]
+
+    def move(self, target, now):
+        self._start = self.position(now)
+        self._target = target
+        self._t0 = now
+        self._t1 = now + abs(target - self._start) / self.velocity
+
+    def stop(self, now):
+        self._start = self._target = self.position(now)
+        self._t1 = now
+
+
+class SimAnalogInput:
+    def __init__(self, name, offset=0., noise=.01):
+        self.name = name
+        self.offset = offset
+        self.noise = noise
+
+    def value(self, now):
+        return self.offset + math.sin(now) + random.gauss(0, self.noise)
+
+
+class SimInstrument:
+    def __init__(self, name, shape=(512, 512)):
+        self.name = name
+        self.shape = tuple(shape)
+        rows, cols = np.indices(self.shape)
+        spot = np.exp(-((rows - self.shape[0] / 2) ** 2 + (cols - self.shape[1] / 2) ** 2)
+                      / (2 * (min(self.shape) / 10) ** 2))
+        self._base = (1000 * spot + np.random.poisson(10, self.shape)).astype(np.int32)
+        self.frame = self._base  # the last completed exposure
+        self.frame_count = 0
+        self.ready_at = 0.
+        self._exposing = None
+        self._responses = {}
+
+    def acquire(self, exposure, now):
+        self.update(now)
+        shift = tuple(random.randint(-2, 2) for _ in self.shape)
+        self._exposing = np.roll(self._base, shift, axis=(0, 1))
+        self.ready_at = now + exposure
+
+    def update(self, now):
+        """Complete the exposure in progress if it has ended; until then the previous frame stays readable."""
+        if self._exposing is not None and now >= self.ready_at:
+            self.frame, self._exposing = self._exposing, None
+            self.frame_count += 1
+            self._responses = {}
+
+    def response(self, response_cls, now):
+        self.update(now)
+        # Formatting a large frame (especially as text) is slow; do it once per capture
+        if response_cls not in self._responses:
+            self._responses[response_cls] = response_cls.from_array(self.frame)
+        return self._responses[response_cls]
+
+
+def _lister(attr):
+    def handler(self, now):
+        return '\r\n'.join(getattr(self, attr))
+
+    return handler
+
+
+def _motor_enabler(enabled):
+    def handler(self, now, name):
+        self.motors[name].enabled = enabled
+        return 'OK'
+
+    return handler
+
+
+def _frame_getter(response_cls):
+    def handler(self, now, name):
+        return self.instruments[name].response(response_cls, now)
+
+    return handler
+
+
+class Simulator:
+    """
+    Simulated LabVIEW server state, plus the per-connection protocol handling.
+
+    Each response is sent ``latency`` (+/- ``jitter``) seconds after its request arrived, in request order, so
+    pipelined clients see one round trip rather than one per request. With ``chunk_size`` set, responses are
+    written in chunks of that many bytes, ``chunk_delay`` seconds apart.
+    """
+
+    def __init__(self, motors=('esp300axis1', 'esp300axis2'), ais=('ai0', 'ai1'), dios=('dio0',),
+                 instruments=('ptGreyInstrument',), shape=(512, 512), velocity=1., latency=0., jitter=0.,
+                 chunk_size=None, chunk_delay=0.):
+        self.motors = {name: SimMotor(name, velocity=velocity) for name in motors}
+        self.ais = {name: SimAnalogInput(name) for name in ais}
+        self.dios = {name: SimAnalogInput(name, noise=0) for name in dios}
+        self.instruments = {name: SimInstrument(name, shape) for name in instruments}
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+
+    async def handle(self, stream):
+        """Serve one client connection until it closes."""
+        lvs = _sansio.LVS(_sansio.Role.SERVER)
+        send_channel, receive_channel = trio.open_memory_channel(float('inf'))
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(self._responder, stream, lvs, receive_channel)
+            async with send_channel:
+                while True:
+                    data = await stream.receive_some(BUFSIZE)
+                    if not data:
+                        break
+                    lvs.receive_bytes(data)
+                    while True:
+                        try:
+                            request = lvs.next_event()
+                        except _sansio.ProtocolError as ex:
+                            await send_channel.send((trio.current_time(), None, ex))
+                            continue
+                        if request is _sansio.NEED_DATA:
+                            break
+                        self.requests += 1
+                        await send_channel.send((trio.current_time(), request, None))
+
+    async def _responder(self, stream, lvs, receive_channel):
+        async with receive_channel:
+            async for arrived, request, error in receive_channel:
+                await trio.sleep_until(arrived + self.latency + random.uniform(0, self.jitter))
+                if error is not None:
+                    # Not a command we know, so there's no response class to frame it with
+                    payload = bytes(f'ERROR: {error}\r\n', _sansio.ENCODING)
+                else:
+                    payload = lvs.send(self.respond(request))
+                await self._send(stream, payload)
+
+    async def _send(self, stream, payload):
+        if not self.chunk_size:
+            await stream.send_all(payload)
+            return
+        view = memoryview(payload)
+        for start in range(0, len(view), self.chunk_size):
+            await stream.send_all(view[start:start + self.chunk_size])
+            await trio.sleep(self.chunk_delay)
+
+    def respond(self, request):
+        now = trio.current_time()
+        response_cls = _sansio.Commands[_sansio.Role.SERVER][request.FNC]
+        handler = self.HANDLERS.get(request.FNC)
+        if handler is None:
+            return response_cls.from_components(f'ERROR: {request.FNC} is not simulated')
+        try:
+            payload = handler(self, now, *request.args)
+        except (KeyError, TypeError, ValueError) as ex:
+            payload = f'ERROR: {ex!r}'
+        if isinstance(payload, _sansio.Message):
+            return payload
+        return response_cls.from_components(payload)
+
+    def _get_motor_pos(self, now, name):
+        return repr(self.motors[name].position(now))
+
+    def _get_motor(self, now, name):
+        return f'{self.motors[name].position(now)!r} 0x0 Jan 1 1904 12:00AM'
+
+    def _get_motor_status(self, now, name):
+        return 'Moving' if self.motors[name].moving(now) else 'Move finished'
+
+    def _number_motors(self, now):
+        return str(len(self.motors))
+
+    def _move_motor(self, now, name, position):
+        self.motors[name].move(float(position), now)
+        return 'OK'
+
+    def _move_all_motors(self, now, *args):
+        targets = {name: float(position) for name, position in zip(args[::2], args[1::2])}
+        motors = [self.motors[name] for name in targets]  # all or nothing
+        for motor in motors:
+            motor.move(targets[motor.name], now)
+        return 'OK'
+
+    def _set_breakpoints(self, now, name, first, step, count):
+        self.motors[name].breakpoints = _sansio.breakpoint_positions([first, step, count])
+        return 'OK'
+
+    def _set_breakpoint_regions(self, now, name, *regions):
+        self.motors[name].breakpoints = _sansio.breakpoint_positions(regions)
+        return 'OK'
+
+    def _disable_breakpoints(self, now, name):
+        self.motors[name].breakpoints = np.empty(0)
+        return 'OK'
+
+    def _get_flying_positions(self, now, name):
+        return _sansio.GetFlyingPositionsResponse.from_array(self.motors[name].flying_positions(now))
+
+    def _stop_motor(self, now, name):
+        self.motors[name].stop(now)
+        return 'Motor Stopped'
+
+    def _home_motor(self, now, name):
+        self.motors[name].move(0., now)
+        return 'OK!0'
+
+    def _get_soft_limits(self, now, name):
+        return '{} {}'.format(*self.motors[name].soft_limits)
+
+    def _get_motor_velocity(self, now, name):
+        return repr(self.motors[name].velocity)
+
+    def _get_freerun(self, now, name):
+        device = self.ais.get(name) or self.dios[name]
+        return repr(device.value(now))
+
+    def _start_instrument_acquire(self, now, name, exposure):
+        self.instruments[name].acquire(float(exposure), now)
+        return 'OK'
+
+    def _get_instrument_status(self, now, name):
+        instrument = self.instruments[name]
+        instrument.update(now)
+        state = 'Acquiring' if now < instrument.ready_at else 'Idle'
+        return f'{state}\r\nFrames: {instrument.frame_count}'
+
+    HANDLERS = {'ListMotors': _lister('motors'),
+                'ListAIs': _lister('ais'),
+                'ListDIOs': _lister('dios'),
+                'ListInstruments': _lister('instruments'),
+                'GetMotorPos': _get_motor_pos,
+                'GetMotor': _get_motor,
+                'GetMotorStatus': _get_motor_status,
+                'GetMotorStat': _get_motor_status,  # what alsdac.GetMotorStatus sends
+                'NumberMotors': _number_motors,
+                'MoveMotor': _move_motor,
+                'MoveAllMotors': _move_all_motors,
+                'StopMotor': _stop_motor,
+                'HomeMotor': _home_motor,
+                'EnableMotor': _motor_enabler(True),
+                'DisableMotor': _motor_enabler(False),
+                'GetSoftLimits': _get_soft_limits,
+                'SetBreakpoints': _set_breakpoints,
+                'SetBreakpointRegions': _set_breakpoint_regions,
+                'DisableBreakpoints': _disable_breakpoints,
+                'GetFlyingPositions': _get_flying_positions,
+                'GetMotorVelocity': _get_motor_velocity,
+                'GetFreerun': _get_freerun,
+                'StartInstrumentAcquire': _start_instrument_acquire,
+                'GetInstrumentStatus': _get_instrument_status,
+                'GetInstrumentAcquired2D': _frame_getter(_sansio.GetInstrumentAcquired2DResponse),
+                'GetInstrumentAcquired2DBinary': _frame_getter(_sansio.GetInstrumentAcquired2DBinaryResponse),
+                }
+
+
+async def serve(simulator=None, host='127.0.0.1', port=55000, *, task_status=trio.TASK_STATUS_IGNORED):
+    """
+    Serve ``simulator`` (a default Simulator if None) on ``host:port`` until cancelled.
+
+    Use port=0 to pick a free port; when started with ``nursery.start`` the bound port is returned.
+    """
+    if simulator is None:
+        simulator = Simulator()
+    listeners = await trio.open_tcp_listeners(port, host=host)
+    task_status.started(listeners[0].socket.getsockname()[1])
+    await trio.serve_listeners(simulator.handle, listeners)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated ALS LabVIEW DAC server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=55000)
+    parser.add_argument('--motors', nargs='*', default=['esp300axis1', 'esp300axis2'])
+    parser.add_argument('--ais', nargs='*', default=['ai0', 'ai1'])
+    parser.add_argument('--dios', nargs='*', default=['dio0'])
+    parser.add_argument('--instruments', nargs='*', default=['ptGreyInstrument'])
+    parser.add_argument('--shape', nargs=2, type=int, default=[512, 512], help='frame rows, columns')
+    parser.add_argument('--velocity', type=float, default=1., help='motor velocity (units/s)')
+    parser.add_argument('--latency', type=float, default=0., help='response delay (s)')
+    parser.add_argument('--jitter', type=float, default=0., help='extra random response delay (s)')
+    parser.add_argument('--chunk-size', type=int, default=None, help='split responses into chunks of this many bytes')
+    parser.add_argument('--chunk-delay', type=float, default=0., help='delay between chunks (s)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level='INFO')
+    simulator = Simulator(motors=args.motors, ais=args.ais, dios=args.dios, instruments=args.instruments,
+                          shape=args.shape, velocity=args.velocity, latency=args.latency, jitter=args.jitter,
+                          chunk_size=args.chunk_size, chunk_delay=args.chunk_delay)
+    logger.info('Serving on %s:%d', args.host, args.port)
+    trio.run(serve, simulator, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
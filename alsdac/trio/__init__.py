@@ -0,0 +1,122 @@
+"""
+A native trio client for the LabVIEW server.
+
+    async with alsdac.trio.open_client() as client:
+        pos = (await client.request(_sansio.GetMotorPosRequest('esp300axis2'))).data
+        positions = await client.gather(*map(_sansio.GetMotorPosRequest, ['esp300axis1', 'esp300axis2']))
+
+Requests from any number of tasks are pipelined over one connection, and gather() writes all of its requests at once.
+A cancelled request gives up its place without disturbing the others; its response is read and discarded when it
+arrives.
+"""
+import collections
+import socket
+from contextlib import asynccontextmanager
+
+import trio
+
+import alsdac
+from alsdac import _sansio
+
+
+class _ResponseSlot:
+    __slots__ = ('event', 'response', 'error')
+
+    def __init__(self):
+        self.event = trio.Event()
+        self.response = None
+        self.error = None
+
+    def set(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        self.event.set()
+
+    async def wait(self):
+        await self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class AsyncClient:
+    """
+    One pipelined connection to the LabVIEW server, read by a background task.
+
+    Use open_client() to create one; the reader runs in that context's nursery.
+    """
+
+    def __init__(self, stream: trio.SocketStream):
+        self._stream = stream
+        self._lvs = _sansio.LVS(_sansio.Role.CLIENT, pipeline=True)
+        self._slots = collections.deque()  # one per request in flight, in send order
+        self._send_lock = trio.StrictFIFOLock()
+        self._unframed = None  # the outstanding reply with no end marker, if any
+        self._error = None
+
+    @property
+    def in_flight(self):
+        return len(self._slots)
+
+    async def request(self, cmd):
+        """Send a request and wait for its response."""
+        return (await self.gather(cmd))[0]
+
+    async def gather(self, *cmds):
+        """Send several requests in a single write; return their responses in the same order."""
+        slots = [_ResponseSlot() for _ in cmds]
+        async with self._send_lock:
+            # Nothing may be queued behind a reply that has no end marker
+            if self._unframed is not None:
+                await self._unframed.event.wait()
+            if self._error is not None:
+                raise self._error
+            payload = self._lvs.send_many(cmds)
+            self._slots.extend(slots)
+            # A partial write would corrupt every request behind this one
+            with trio.CancelScope(shield=True):
+                await self._stream.send_all(payload)
+            if cmds and _sansio.Commands[_sansio.Role.SERVER][cmds[-1].FNC].FRAMING is _sansio.Framing.LINES:
+                self._unframed = slots[-1]
+        return [await slot.wait() for slot in slots]
+
+    async def get(self, data: str) -> bytes:
+        """Send a raw command string (e.g. 'GetMotorPos(m1)\\r\\n') and return the raw response bytes."""
+        fnc = data.partition('(')[0].strip()
+        cmd = _sansio.Commands[_sansio.Role.CLIENT][fnc].from_components(data)
+        return bytes(await self.request(cmd))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self._stream.receive_some(alsdac.BUFSIZE)
+                self._lvs.receive_bytes(data)
+                while self._slots:
+                    event = self._lvs.next_event()
+                    if event is _sansio.NEED_DATA:
+                        break
+                    self._slots.popleft().set(event)
+                if not data:
+                    raise trio.BrokenResourceError('connection closed by the LabVIEW server')
+        except (trio.BrokenResourceError, trio.ClosedResourceError, _sansio.ProtocolError) as ex:
+            self._fail(ex)
+
+    def _fail(self, ex):
+        self._error = ex
+        while self._slots:
+            self._slots.popleft().set(error=ex)
+
+
+@asynccontextmanager
+async def open_client(host=None, port=None):
+    """Connect to the LabVIEW server (alsdac.SERVER_ADDRESS/PORT by default) and yield an AsyncClient."""
+    stream = await trio.open_tcp_stream(host or alsdac.SERVER_ADDRESS, port or alsdac.PORT)
+    stream.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    async with stream:
+        client = AsyncClient(stream)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(client._read_loop)
+            try:
+                yield client
+            finally:
+                nursery.cancel_scope.cancel()
@@ -0,0 +1,179 @@
+"""
+Saving captured frames to local disk at acquisition rate.
+
+A FrameWriter appends every frame it's given to a stack file from a background thread:
+
+    writer = FrameWriter('/data/scan42.npy')
+    for frame in frames:
+        writer.put(frame)  # blocks while the disk is behind
+    writer.close()
+
+Paths ending in .h5 or .hdf5 are written as a chunked HDF5 dataset (this needs h5py); anything else as a
+memory-mapped .npy stack that np.load(path, mmap_mode='r') reads back. Either way space is preallocated ``block``
+frames at a time and the file is trimmed to the frames written when it's closed.
+"""
+import io
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger('alsdac.writers')
+
+HDF5_SUFFIXES = ('.h5', '.hdf5')
+
+
+class NpyStack:
+    """Frames appended along the first axis of a memory-mapped .npy file."""
+
+    def __init__(self, path, shape, dtype, block=1000):
+        self.path = path
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.block = int(block)
+        self.count = 0
+        self._map = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(self.block,) + self.shape)
+
+    def append(self, frame):
+        if self.count == len(self._map):
+            self._resize(self.count + self.block)
+        self._map[self.count] = frame
+        self.count += 1
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._resize(self.count, remap=False)
+
+    def _resize(self, length, remap=True):
+        # Rewrite the header in place for the new length, then grow or trim the data after it. The header is a
+        # Python literal, so the length must be a plain int: numpy 2 writes np.int32(n) for a numpy integer
+        length = int(length)
+        offset = self._map.offset
+        self._map.flush()
+        self._map = None
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                      'fortran_order': False, 'shape': (length,) + self.shape})
+        if header.tell() != offset:
+            raise ValueError(f'{self.path}: the .npy header can\'t be resized in place (numpy < 1.24?)')
+        with open(self.path, 'r+b') as f:
+            f.write(header.getvalue())
+            f.truncate(offset + length * self.dtype.itemsize * int(np.prod(self.shape)))
+        if remap:
+            self._map = np.load(self.path, mmap_mode='r+')
+
+
+class HDF5Stack:
+    """Frames appended along the first axis of a chunked HDF5 dataset, one chunk per frame."""
+
+    def __init__(self, path, shape, dtype, block=1000, dataset='frames'):
+        import h5py  # optional; only HDF5 output needs it
+
+        self.path = path
+        self.shape = tuple(shape)
+        self.block = block
+        self.count = 0
+        self._file = h5py.File(path, 'w')
+        self._dataset = self._file.create_dataset(dataset, shape=(block,) + self.shape, dtype=dtype,
+                                                  maxshape=(None,) + self.shape, chunks=(1,) + self.shape)
+
+    def append(self, frame):
+        if self.count == len(self._dataset):
+            self._dataset.resize(self.count + self.block, axis=0)
+        self._dataset[self.count] = frame
+        self.count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._dataset.resize(self.count, axis=0)
+        self._file.close()
+
+
+def open_stack(path, shape, dtype, block=1000):
+    """An HDF5Stack or NpyStack at ``path``, by its suffix."""
+    cls = HDF5Stack if str(path).lower().endswith(HDF5_SUFFIXES) else NpyStack
+    return cls(path, shape, dtype, block)
+
+
+_IDLE = object()
+
+
+class FrameWriter:
+    """
+    Appends frames to a stack file (see open_stack) from a background thread.
+
+    The file is opened when the first frame arrives, which sets the shape and dtype of the stack; it's flushed
+    every ``flush_period`` seconds. put() blocks while ``depth`` frames are already waiting, so a producer slows
+    to the rate the disk sustains rather than queueing frames without bound.
+    """
+
+    def __init__(self, path, block=1000, depth=8, flush_period=1.):
+        if str(path).lower().endswith(HDF5_SUFFIXES):
+            import h5py  # noqa: F401 -- fail here rather than at the first frame
+        self.path = path
+        self.block = block
+        self.flush_period = flush_period
+        self.written = 0  # frames appended so far
+        self.rate = 0.  # frames per second over the last flush period
+        self.error = None
+        self._queue = queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(target=self._run, name=f'FrameWriter {path}', daemon=True)
+        self._thread.start()
+
+    @property
+    def backlog(self):
+        return self._queue.qsize()
+
+    def put(self, frame, timeout=None):
+        """Queue ``frame`` to be written, waiting for room; frames must not be modified afterwards."""
+        if self.error is not None:
+            raise self.error
+        self._queue.put(frame, timeout=timeout)
+
+    def close(self):
+        """Write out the frames still queued, trim and close the file."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        stack = None
+        window_start = time.monotonic()
+        window_count = 0
+        try:
+            while True:
+                try:
+                    frame = self._queue.get(timeout=self.flush_period)
+                except queue.Empty:
+                    frame = _IDLE
+                if frame is None:
+                    break
+                if frame is not _IDLE:
+                    if stack is None:
+                        stack = open_stack(self.path, frame.shape, frame.dtype, self.block)
+                    stack.append(frame)
+                    self.written = stack.count
+                    window_count += 1
+                now = time.monotonic()
+                if now - window_start >= self.flush_period:
+                    if stack is not None:
+                        stack.flush()
+                    self.rate = window_count / (now - window_start)
+                    window_start, window_count = now, 0
+        except Exception as ex:
+            logger.exception(f'Writing {self.path} failed')
+            self.error = ex
+            # Keep taking frames so no put() is left waiting
+            while self._queue.get() is not None:
+                pass
+        finally:
+            self.rate = 0.
+            if stack is not None:
+                stack.close()
@@ -43,12 +43,17 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 3.6'
+        'Programming Language :: Python :: 3.8'
     ],
 
     # What does your project relate to?
     keywords='synchrotron controls beamline hardware data',
 
     install_requires=['trio', 'numpy'],
-    python_requires='>=3.6',
+    extras_require={
+        'caproto': ['caproto'],  # the IOC (alsdac.caproto)
+        'ophyd': ['ophyd', 'caproto'],  # alsdac.ophyd devices
+        'hdf5': ['h5py'],  # .h5 frame persistence (alsdac.writers)
+    },
+    python_requires='>=3.8',
 )
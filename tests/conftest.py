@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+import trio
+
+import alsdac
+from alsdac import simulator
+
+
+@pytest.fixture
+def sim(request):
+    """A Simulator, built from the test's parameters: @pytest.mark.parametrize('sim', [{...}], indirect=True)."""
+    return simulator.Simulator(**getattr(request, 'param', {}))
+
+
+@pytest.fixture
+def run_against(sim, monkeypatch):
+    """run_against(test, *args) runs ``await test(*args)`` in trio, with ``sim`` served on a free local port."""
+    monkeypatch.setattr(alsdac, 'SERVER_ADDRESS', '127.0.0.1')
+
+    def run(test, *args):
+        async def main():
+            async with trio.open_nursery() as nursery:
+                port = await nursery.start(simulator.serve, sim, '127.0.0.1', 0)
+                monkeypatch.setattr(alsdac, 'PORT', port)
+                await test(*args)
+                nursery.cancel_scope.cancel()
+
+        trio.run(main)
+
+    return run
+
+
+@pytest.fixture
+def sim_port(sim):
+    """Serve ``sim`` from a background thread, for blocking clients; yields the port it listens on."""
+    started = threading.Event()
+    state = {}
+
+    async def serve():
+        async with trio.open_nursery() as nursery:
+            state['token'], state['scope'] = trio.lowlevel.current_trio_token(), nursery.cancel_scope
+            state['port'] = await nursery.start(simulator.serve, sim, '127.0.0.1', 0)
+            started.set()
+
+    thread = threading.Thread(target=trio.run, args=(serve,), daemon=True)
+    thread.start()
+    assert started.wait(10)
+    yield state['port']
+    trio.from_thread.run_sync(state['scope'].cancel, trio_token=state['token'])
+    thread.join(10)
+
+
+@pytest.fixture
+def beamline():
+    """An IOC Beamline (prefix 'beamline:'), with its readback cache off so every read reaches the simulator."""
+    from alsdac.caproto import Beamline
+    return Beamline(prefix='beamline:', cache_max_age=0)
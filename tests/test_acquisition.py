@@ -0,0 +1,113 @@
+"""The IOC's acquisition pipeline (alsdac.caproto.Acquisition) against the simulator."""
+import numpy as np
+import pytest
+import trio
+
+CAMERA = 'ptGreyInstrument'
+
+
+def numbered_frames(camera):
+    """Make the simulated ``camera`` expose frames filled with their number (1, 2, ...); frame 0 is there already."""
+
+    def acquire(exposure, now):
+        camera.update(now)
+        camera._exposing = np.full(camera.shape, camera.frame_count + 1, dtype=np.int32)
+        camera.ready_at = now + exposure
+
+    camera.frame = np.zeros(camera.shape, dtype=np.int32)
+    camera.acquire = acquire
+
+
+def run_instrument(beamline, run_against, test, exposure_time=.05):
+    """run_against ``await test(instrument)``, with the camera's Instrument and the acquisitions running."""
+    detectors = beamline.Detectors
+
+    async def main():
+        await detectors.update()
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(detectors.acquisitions.run)
+            instrument = detectors.device(CAMERA)
+            await instrument.exposure_time.write([exposure_time])
+            await test(instrument)
+            nursery.cancel_scope.cancel()
+
+    run_against(main)
+
+
+@pytest.mark.parametrize('sim', [{'shape': (16, 16)}], indirect=True)
+def test_trigger_waits_for_its_frame(sim, beamline, run_against):
+    numbered_frames(sim.instruments[CAMERA])
+
+    async def test(instrument):
+        for number in 1, 2, 3:
+            await instrument.trigger.write([1])
+            assert (instrument.last_capture == number).all()
+            assert instrument.frame_counter.value == number
+        # The ring holds the newest frames, by id
+        assert [frame_id for frame_id, frame in instrument.acquisition.ring] == [1, 2, 3]
+        assert (instrument.acquisition.frame(2) == 2).all()
+        assert not instrument.acquisition.active
+
+    run_instrument(beamline, run_against, test)
+
+
+# Frames trickle out over about .3 s, on the bulk lane, while exposures are started on the scalar lane
+@pytest.mark.parametrize('sim', [{'shape': (64, 64), 'chunk_size': 1024, 'chunk_delay': .02}], indirect=True)
+def test_trigger_ignores_a_fetch_started_before_its_exposure_ended(sim, beamline, run_against):
+    numbered_frames(sim.instruments[CAMERA])
+
+    async def test(instrument):
+        read = []
+
+        async def reader():
+            # No frame yet, so this fetches the one the server holds now, before the exposure below
+            read.append((await instrument.current_frame()).copy())
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(reader)
+            await trio.sleep(.01)
+            assert instrument.acquisition._fetching is not None
+            await instrument.trigger.write([1])
+        assert (read[0] == 0).all()
+        assert (instrument.last_capture == 1).all()
+
+    run_instrument(beamline, run_against, test)
+
+
+@pytest.mark.parametrize('sim', [{'shape': (64, 64), 'chunk_size': 4096, 'chunk_delay': .01}], indirect=True)
+def test_continuous_acquisition_overlaps_exposure_and_transfer(sim, beamline, run_against):
+    numbered_frames(sim.instruments[CAMERA])
+    counts = []
+
+    async def test(instrument):
+        await instrument.acquire.write(1)
+        await trio.sleep(1.)
+        await instrument.acquire.write(0)
+        counts.append(instrument.frame_counter.value)
+        with trio.fail_after(1):
+            while instrument.acquisition.active:
+                await trio.sleep(.01)
+        # Every exposure's frame arrived, in order
+        frames = [int(frame[0, 0]) for frame_id, frame in instrument.acquisition.ring]
+        assert frames == list(range(frames[0], frames[0] + len(frames)))
+
+    run_instrument(beamline, run_against, test)
+    # Exposures of .05 s and transfers of about .04 s: about 20 frames in a second when they overlap, 11 if not
+    assert counts[0] >= 15
+
+
+@pytest.mark.parametrize('sim', [{'shape': (16, 16)}], indirect=True)
+def test_failed_exposure_fails_its_trigger(sim, beamline, run_against):
+    numbered_frames(sim.instruments[CAMERA])
+
+    async def test(instrument):
+        camera = sim.instruments.pop(CAMERA)
+        with pytest.raises(RuntimeError, match='Acquisition failed'):
+            await instrument.trigger.write([1])
+        sim.instruments[CAMERA] = camera
+        # The pipeline recovers, after a pause, for the next trigger
+        with trio.fail_after(5):
+            await instrument.trigger.write([1])
+        assert (instrument.last_capture == 1).all()
+
+    run_instrument(beamline, run_against, test)
@@ -0,0 +1,124 @@
+"""alsdac.asyncio.AsyncClient against the simulator."""
+import asyncio
+import time
+
+import pytest
+
+import alsdac
+import alsdac.asyncio
+from alsdac import _sansio
+
+
+def run_client(port, test):
+    """asyncio.run ``await test(client)``, with an AsyncClient connected to ``port``."""
+    async def main():
+        async with await alsdac.asyncio.AsyncClient.connect('127.0.0.1', port) as client:
+            await test(client)
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize('sim', [{'latency': .05}], indirect=True)
+def test_gather_is_pipelined(sim, sim_port):
+    cmds = [_sansio.GetMotorPosRequest('esp300axis1'), _sansio.GetMotorStatusRequest('esp300axis1')] * 10
+
+    async def test(client):
+        start = time.perf_counter()
+        responses = await client.gather(*cmds)
+        # One write, so about one round trip rather than twenty
+        assert time.perf_counter() - start < 5 * sim.latency
+        assert [type(response) for response in responses] == [_sansio.GetMotorPosResponse,
+                                                              _sansio.GetMotorStatusResponse] * 10
+        assert [response.data for response in responses[:2]] == [0., True]
+        assert client.in_flight == 0
+
+    run_client(sim_port, test)
+
+
+@pytest.mark.parametrize('sim', [{'motors': [f'm{i}' for i in range(8)], 'jitter': .01}], indirect=True)
+def test_tasks_share_a_client(sim, sim_port):
+    for i, motor in enumerate(sim.motors.values()):
+        motor.move(float(i), 0.)
+
+    async def read(client, name):
+        return [await alsdac.GetMotorPos_async(name, client) for _ in range(20)]
+
+    async def test(client):
+        results = await asyncio.gather(*(read(client, name) for name in sim.motors))
+        assert results == [[float(i)] * 20 for i in range(8)]
+
+    run_client(sim_port, test)
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1', 'm2'], 'latency': .1}], indirect=True)
+def test_cancelled_request(sim, sim_port):
+    sim.motors['m2'].move(2., 0.)
+
+    async def test(client):
+        cancelled = asyncio.ensure_future(client.request(_sansio.GetMotorPosRequest('m1')))
+        await asyncio.sleep(.01)
+        waited = asyncio.ensure_future(client.request(_sansio.GetMotorPosRequest('m2')))
+        await asyncio.sleep(.01)
+        cancelled.cancel()
+        # The cancelled request's response is read and dropped, not handed to the one behind it
+        assert (await waited).data == 2.
+        assert cancelled.cancelled()
+        assert client.in_flight == 0
+        assert (await client.request(_sansio.GetMotorPosRequest('m2'))).data == 2.
+
+    run_client(sim_port, test)
+
+
+def test_unframed_reply(sim_port):
+    async def test(client):
+        listed = asyncio.ensure_future(client.gather(_sansio.GetMotorPosRequest('esp300axis1'),
+                                                     _sansio.ListMotorsRequest()))
+        while client.in_flight < 2:
+            await asyncio.sleep(0)
+        # Nothing can be queued behind a reply without an end marker, so this waits for it
+        assert (await client.request(_sansio.GetMotorPosRequest('esp300axis2'))).data == 0.
+        assert listed.done()
+        assert (await listed)[1].data == ['esp300axis1', 'esp300axis2']
+
+        with pytest.raises(_sansio.ProtocolError):
+            await client.gather(_sansio.ListMotorsRequest(), _sansio.GetMotorPosRequest('esp300axis1'))
+        assert client.in_flight == 0
+
+    run_client(sim_port, test)
+
+
+@pytest.mark.parametrize('sim', [{'latency': .2}], indirect=True)
+def test_close_fails_requests_in_flight(sim_port):
+    async def main():
+        client = await alsdac.asyncio.AsyncClient.connect('127.0.0.1', sim_port)
+        request = asyncio.ensure_future(client.request(_sansio.GetMotorPosRequest('esp300axis1')))
+        while not client.in_flight:
+            await asyncio.sleep(0)
+        await client.close()
+        with pytest.raises(ConnectionError):
+            await request
+        with pytest.raises(ConnectionError):
+            await client.request(_sansio.GetMotorPosRequest('esp300axis1'))
+
+    asyncio.run(main())
+
+
+def test_connection_closed():
+    async def hang_up(reader, writer):
+        await reader.read(1)
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(hang_up, '127.0.0.1', 0)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            async with await alsdac.asyncio.AsyncClient.connect('127.0.0.1', port) as client:
+                # Cut off mid-request or mid-response, depending on how the hang-up lands
+                with pytest.raises((ConnectionError, _sansio.ProtocolError)) as first:
+                    await client.request(_sansio.GetMotorPosRequest('esp300axis1'))
+                # ...and everything after it fails the same way
+                with pytest.raises(type(first.value)) as then:
+                    await client.request(_sansio.GetMotorPosRequest('esp300axis1'))
+                assert then.value is first.value
+
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+import alsdac
+from alsdac import _sansio
+
+
+@pytest.fixture
+def client(sim_port):
+    with alsdac.Client('127.0.0.1', sim_port, timeout=5) as client:
+        yield client
+
+
+@pytest.mark.parametrize('sim', [{'motors': [f'm{i}' for i in range(8)]}], indirect=True)
+def test_threads_share_a_client(sim, client):
+    for i, motor in enumerate(sim.motors.values()):
+        motor.move(float(i), 0.)
+    results = {}
+
+    def read(name):
+        results[name] = [client.request(_sansio.GetMotorPosRequest(name)).data for _ in range(50)]
+
+    threads = [threading.Thread(target=read, args=(name,)) for name in sim.motors]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {f'm{i}': [float(i)] * 50 for i in range(8)}
+
+
+@pytest.mark.parametrize('sim', [{'latency': .05}], indirect=True)
+def test_request_many_is_pipelined(sim, client):
+    cmds = [_sansio.GetMotorPosRequest('esp300axis1'), _sansio.GetMotorStatusRequest('esp300axis1')] * 10
+    start = time.perf_counter()
+    responses = client.request_many(cmds)
+    # One write, so about one round trip rather than twenty
+    assert time.perf_counter() - start < 5 * sim.latency
+    assert [type(response) for response in responses] == [_sansio.GetMotorPosResponse,
+                                                          _sansio.GetMotorStatusResponse] * 10
+    assert [response.data for response in responses[:2]] == [0., True]
+
+
+def test_unframed_reply(client):
+    futures = client.submit_many([_sansio.GetMotorPosRequest('esp300axis1'), _sansio.ListMotorsRequest()])
+    # Nothing can be queued behind a reply without an end marker, so the next request waits for it
+    response = client.request(_sansio.GetMotorPosRequest('esp300axis2'))
+    assert futures[1].done()
+    assert futures[1].result().data == ['esp300axis1', 'esp300axis2']
+    assert response.data == 0.
+
+
+@pytest.mark.parametrize('sim', [{'latency': .2}], indirect=True)
+def test_close_fails_requests_in_flight(client):
+    future = client.submit(_sansio.GetMotorPosRequest('esp300axis1'))
+    client.close()
+    with pytest.raises(ConnectionError):
+        future.result(5)
+    # The next request reconnects, and the old connection's reader leaves it alone
+    assert client.request(_sansio.GetMotorPosRequest('esp300axis1')).data == 0.
+    time.sleep(.1)
+    assert client.request(_sansio.GetMotorPosRequest('esp300axis1')).data == 0.
+
+
+def test_refused_connection():
+    with pytest.raises(ConnectionError):
+        alsdac.Client('127.0.0.1', 1).request(_sansio.GetMotorPosRequest('esp300axis1'))
+
+
+def test_module_functions(sim, sim_port, monkeypatch):
+    monkeypatch.setattr(alsdac, 'SERVER_ADDRESS', '127.0.0.1')
+    monkeypatch.setattr(alsdac, 'PORT', sim_port)
+    monkeypatch.setattr(alsdac, '_client', None)
+    sim.motors['esp300axis1'].move(1.5, 0.)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            clients = set(pool.map(lambda _: alsdac.client(), range(32)))
+        # One shared Client, however many threads race to make it
+        assert len(clients) == 1
+        assert alsdac.GetMotorPos('esp300axis1') == 1.5
+        assert alsdac.ListMotors() == ['esp300axis1', 'esp300axis2']
+        assert alsdac.NumberMotors() == 2
+    finally:
+        alsdac._reset_client()
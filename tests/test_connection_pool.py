@@ -0,0 +1,138 @@
+import pytest
+import trio
+
+from alsdac import _sansio
+from alsdac.caproto import ConnectionPool
+
+
+@pytest.mark.parametrize('sim', [{'motors': [f'm{i}' for i in range(20)], 'latency': .05}], indirect=True)
+def test_pipelined_gets(sim, run_against):
+    for i, motor in enumerate(sim.motors.values()):
+        motor.move(float(i), 0.)
+    pool = ConnectionPool()
+    results = {}
+
+    async def test():
+        async def read(name):
+            results[name] = (await pool.get(_sansio.GetMotorPosRequest(name))).data
+
+        start = trio.current_time()
+        async with trio.open_nursery() as nursery:
+            for name in sim.motors:
+                nursery.start_soon(read, name)
+        # Sent back to back on one connection, so about one round trip rather than twenty
+        assert trio.current_time() - start < 10 * sim.latency
+
+    run_against(test)
+    assert results == {f'm{i}': float(i) for i in range(20)}
+    assert pool.stats()['scalar']['requests'] == 20
+    assert pool.stats()['scalar']['depth'] == 0
+
+
+@pytest.mark.parametrize('sim', [{'latency': .01}], indirect=True)
+def test_unpipelined_gets(sim, run_against):
+    pool = ConnectionPool(pipeline=False)
+
+    async def test():
+        async with trio.open_nursery() as nursery:
+            for _ in range(5):
+                nursery.start_soon(pool.get, _sansio.GetMotorPosRequest('esp300axis1'))
+
+    run_against(test)
+    assert sim.requests == 5
+    assert pool.stats()['scalar']['max_depth'] == 5
+
+
+@pytest.mark.parametrize('sim', [{'shape': (64, 32)}], indirect=True)
+def test_lane_routing(run_against):
+    pool = ConnectionPool()
+    frames = []
+
+    async def test():
+        await pool.get(_sansio.StartInstrumentAcquireRequest('ptGreyInstrument', 0))
+        frames.append(await pool.get(_sansio.GetInstrumentAcquired2DBinaryRequest('ptGreyInstrument')))
+        await pool.get(_sansio.GetMotorPosRequest('esp300axis1'))
+        await pool.get(_sansio.ListMotorsRequest())
+
+    run_against(test)
+    assert frames[0].shape == (64, 32)
+    stats = pool.stats()
+    assert stats['bulk']['requests'] == 1
+    assert stats['scalar']['requests'] == 3
+    # Each lane has its own connection, and only used its own
+    (bulk,), (scalar,) = pool.lanes['bulk'], pool.lanes['scalar']
+    assert bulk.lvs.bytes_consumed > 64 * 32 * 4 > scalar.lvs.bytes_consumed > 0
+
+
+@pytest.mark.parametrize('sim', [{'latency': .02}], indirect=True)
+def test_custom_lanes(run_against):
+    pool = ConnectionPool(lanes={'scalar': 2, 'lists': 1}, routes={_sansio.ListMotorsRequest: 'lists'})
+
+    async def test():
+        async with trio.open_nursery() as nursery:
+            for _ in range(2):
+                nursery.start_soon(pool.get, _sansio.GetMotorPosRequest('esp300axis1'))
+            nursery.start_soon(pool.get, _sansio.ListMotorsRequest())
+
+    run_against(test)
+    stats = pool.stats()
+    assert (stats['scalar']['connections'], stats['lists']['connections'], stats['bulk']['connections']) == (2, 1, 1)
+    assert (stats['scalar']['requests'], stats['lists']['requests'], stats['bulk']['requests']) == (2, 1, 0)
+    # The second request went to the idle connection rather than queueing behind the first
+    assert all(conn.lvs.bytes_sent for conn in pool.lanes['scalar'])
+
+
+def test_error_reply_keeps_connection(run_against):
+    pool = ConnectionPool()
+
+    async def test():
+        response = await pool.get(_sansio.GetMotorPosRequest('nonexistent'))
+        assert response.str_payload.startswith('ERROR')
+        with pytest.raises(ValueError):
+            response.data
+        assert (await pool.get(_sansio.GetMotorPosRequest('esp300axis1'))).data == 0.
+
+    run_against(test)
+    assert pool.metrics.commands['GetMotorPos'].requests == 2
+
+
+@pytest.mark.parametrize('pipeline', [True, False])
+@pytest.mark.parametrize('sim', [{'motors': ['m1'], 'latency': .002}], indirect=True)
+def test_cancelled_gets(sim, run_against, pipeline):
+    sim.motors['m1'].move(2.5, 0.)
+    pool = ConnectionPool(pipeline=pipeline)
+    requests = [_sansio.GetMotorPosRequest('m1'), _sansio.GetMotorStatusRequest('m1'), _sansio.ListMotorsRequest()]
+    results = []
+
+    async def test():
+        async def get(cmd, timeout):
+            with trio.move_on_after(timeout):
+                await pool.get(cmd)
+
+        # Cancelled while queued, mid-send and while waiting for the reply
+        async with trio.open_nursery() as nursery:
+            for i in range(60):
+                nursery.start_soon(get, requests[i % 3], i % 7 * .001)
+        for cmd in requests:
+            results.append((await pool.get(cmd)).data)
+
+    run_against(test)
+    assert results == [2.5, True, ['m1']]
+    connection, = pool.lanes['scalar']
+    assert not connection._slots and not connection.lvs.in_flight
+
+
+def test_metrics(run_against):
+    pool = ConnectionPool()
+
+    async def test():
+        for _ in range(3):
+            await pool.get(_sansio.GetMotorPosRequest('esp300axis1'))
+
+    run_against(test)
+    metrics = pool.metrics.commands['GetMotorPos']
+    assert metrics.requests == 3 and metrics.errors == 0
+    assert metrics.bytes_out == 3 * len(b'GetMotorPos(esp300axis1)\r\n')
+    for histogram in metrics.queue_wait, metrics.wire_time, metrics.frame_time:
+        assert histogram.count == 3
+    assert 'alsdac_frame_time_seconds_count{command="GetMotorPos"} 3' in pool.metrics.prometheus()
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import pytest
+
+from alsdac.caproto import DeferDict
+
+
+def group(prefix, pvdb):
+    return SimpleNamespace(prefix=prefix, pvdb=pvdb)
+
+
+@pytest.fixture
+def pvdb():
+    """'top:' with a plain group under 'top:ai:', and a DeferDict under 'top:motors:' with one of its own."""
+    motors = DeferDict({'top:motors:m1.RBV': 'm1'})
+    motors.defer(group('top:motors:slits:', {'top:motors:slits:s1.RBV': 's1'}))
+    pvdb = DeferDict({'top:stats': 'stats'})
+    pvdb.defer(group('top:ai:', {'top:ai:ai0.VAL': 'ai0'}))
+    pvdb.defer(group('top:motors:', motors))
+    return pvdb
+
+
+def test_routes_by_prefix(pvdb):
+    assert pvdb['top:stats'] == 'stats'
+    assert pvdb['top:ai:ai0.VAL'] == 'ai0'
+    assert pvdb['top:motors:m1.RBV'] == 'm1'
+    assert pvdb['top:motors:slits:s1.RBV'] == 's1'
+    # Nothing is copied up
+    assert set(pvdb) == {'top:stats'}
+    # Prefixes match from the start of the name, not anywhere in it
+    for name in 'xtop:ai:ai0.VAL', 'other:top:ai:ai0.VAL', 'top:ai0.VAL':
+        with pytest.raises(KeyError):
+            pvdb[name]
+
+
+def test_misses_are_shared_and_remembered(pvdb):
+    motors = pvdb.routes['top:motors:']
+    assert motors.misses is pvdb.misses
+    with pytest.raises(KeyError):
+        pvdb['top:motors:m2.RBV']
+    assert pvdb.misses == {'top:motors:m2.RBV'}
+
+    # A remembered miss isn't looked for again, even once the name exists below...
+    dict.__setitem__(motors, 'top:motors:m2.RBV', 'm2')
+    with pytest.raises(KeyError):
+        pvdb['top:motors:m2.RBV']
+    # ...until PVs are added through update(), at any level
+    motors.update({'top:motors:m3.RBV': 'm3'})
+    assert not pvdb.misses
+    assert pvdb['top:motors:m2.RBV'] == 'm2'
+
+
+def test_misses_are_bounded(pvdb, monkeypatch):
+    monkeypatch.setattr(DeferDict, 'MAX_MISSES', 10)
+    for i in range(25):
+        with pytest.raises(KeyError):
+            pvdb[f'elsewhere:pv{i}']
+        assert len(pvdb.misses) <= 10
+    assert 'elsewhere:pv24' in pvdb.misses
+
+
+def test_beamline_shares_misses_with_its_groups(beamline):
+    with pytest.raises(KeyError):
+        beamline.pvdb['beamline:motors:nonexistent.RBV']
+    for group in beamline.Motors, beamline.Detectors, beamline.AnalogInputs, beamline.DigitalInputOutputs:
+        assert group.pvdb.misses is beamline.pvdb.misses
+    assert beamline.pvdb['beamline:stats:requests'] is not None
@@ -0,0 +1,137 @@
+import pytest
+from caproto import AlarmSeverity, AlarmStatus
+
+from alsdac import simulator
+from alsdac.caproto import Beamline
+
+
+def device_names(group):
+    # The list leads with the group's own PVs; device PVs are the ones with a field
+    return sorted({group.device_name(pvname) for pvname in group.devices.value if '.' in pvname})
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1']}], indirect=True)
+def test_discovers_new_devices(sim, run_against):
+
+    async def test(beamline):
+        motors = beamline.Motors
+        await motors.update()
+        assert device_names(motors) == ['m1']
+        assert 'beamline:motors:m1.RBV' in motors.devices.value
+        # Nothing is built until a client looks a PV up
+        assert motors.device_groups == {}
+
+        with pytest.raises(KeyError):
+            beamline.pvdb['beamline:motors:m2.RBV']
+        assert 'beamline:motors:m2.RBV' in beamline.pvdb.misses
+
+        sim.motors['m2'] = simulator.SimMotor('m2')
+        await motors.update()
+        assert device_names(motors) == ['m1', 'm2']
+        assert not beamline.pvdb.misses
+        assert beamline.pvdb['beamline:motors:m2.RBV'] is not None
+        assert list(motors.device_groups) == ['m2']
+
+    run_against(test, Beamline(prefix='beamline:', cache_max_age=0))
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1']}], indirect=True)
+def test_unchanged_list_writes_nothing(run_against):
+
+    async def test(beamline):
+        motors = beamline.Motors
+        await motors.update()
+        written = motors.devices.timestamp
+        beamline.pvdb.misses.add('beamline:motors:nonexistent.RBV')
+        await motors.update()
+        assert motors.devices.timestamp == written
+        assert beamline.pvdb.misses
+
+    run_against(test, Beamline(prefix='beamline:', cache_max_age=0))
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1', 'm2']}], indirect=True)
+def test_vanished_devices_are_marked_disconnected(sim, run_against):
+
+    async def test(beamline):
+        motors = beamline.Motors
+        await motors.update()
+        readback = beamline.pvdb['beamline:motors:m1.RBV']
+
+        removed = sim.motors.pop('m1')
+        await motors.update()
+        assert device_names(motors) == ['m2']
+        assert motors.disconnected == {'m1'}
+        # Its PVs stay, flagged
+        assert beamline.pvdb['beamline:motors:m1.RBV'] is readback
+        assert (readback.alarm.status, readback.alarm.severity) == (AlarmStatus.COMM, AlarmSeverity.INVALID_ALARM)
+
+        sim.motors['m1'] = removed
+        await motors.update()
+        assert motors.disconnected == set()
+        assert (readback.alarm.status, readback.alarm.severity) == (AlarmStatus.NO_ALARM, AlarmSeverity.NO_ALARM)
+
+    run_against(test, Beamline(prefix='beamline:', cache_max_age=0))
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1', 'm2']}], indirect=True)
+def test_idle_devices_are_evicted(run_against):
+
+    async def test(beamline):
+        motors = beamline.Motors
+        await motors.update()
+        await motors.idle_timeout.write(60.)
+        readback = beamline.pvdb['beamline:motors:m1.RBV']
+        beamline.pvdb['beamline:motors:m2.RBV']
+        assert set(motors.device_groups) == {'m1', 'm2'}
+
+        # m2 was looked up just now; m1 not for two minutes
+        motors.last_used['m1'] -= 120.
+        motors.evict_idle()
+        assert set(motors.device_groups) == {'m2'}
+        assert 'beamline:motors:m1.RBV' not in motors.pvdb
+        # ...and is built afresh when next looked up
+        assert beamline.pvdb['beamline:motors:m1.RBV'] is not readback
+        assert set(motors.device_groups) == {'m1', 'm2'}
+
+        # Looking a PV up again counts as use
+        motors.last_used['m1'] -= 120.
+        beamline.pvdb['beamline:motors:m1.RBV']
+        motors.evict_idle()
+        assert set(motors.device_groups) == {'m1', 'm2'}
+
+        # An idle_timeout of 0 never evicts
+        await motors.idle_timeout.write(0.)
+        motors.last_used['m1'] -= 120.
+        motors.evict_idle()
+        assert 'm1' in motors.device_groups
+
+    run_against(test, Beamline(prefix='beamline:', cache_max_age=0))
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1', 'm2']}], indirect=True)
+def test_busy_devices_are_kept(run_against, monkeypatch):
+
+    class Context:
+        def open_channels(self):
+            return {'beamline:motors:m1.RBV'}
+
+    async def test(beamline):
+        motors = beamline.Motors
+        await motors.update()
+        await motors.idle_timeout.write(60.)
+        monkeypatch.setattr(beamline.pvdb, 'context', Context())
+        for name in 'm1', 'm2':
+            beamline.pvdb[f'beamline:motors:{name}.RBV']
+            motors.last_used[name] -= 120.
+        # A client holds a channel to one of m1's PVs open, and m2 is moving
+        motors.scanner.track(motors.device_groups['m2'])
+        motors.evict_idle()
+        assert set(motors.device_groups) == {'m1', 'm2'}
+
+        monkeypatch.setattr(Context, 'open_channels', lambda self: set())
+        motors.scanner._moving.clear()
+        motors.evict_idle()
+        assert motors.device_groups == {}
+
+    run_against(test, Beamline(prefix='beamline:', cache_max_age=0))
@@ -0,0 +1,230 @@
+import logging
+
+import numpy as np
+import pytest
+import trio
+from caproto import AlarmSeverity, AlarmStatus, ChannelType
+
+import alsdac.caproto
+
+
+async def wait_for(predicate, timeout=5.):
+    with trio.fail_after(timeout):
+        while not predicate():
+            await trio.sleep(.01)
+
+
+async def read(pv):
+    """Read ``pv`` as a CA client would, through its getter."""
+    metadata, values = await pv.read(ChannelType.FLOAT)
+    return np.asarray(values)
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1'], 'velocity': 100.}], indirect=True)
+def test_flying_positions(sim, beamline, run_against):
+    sim.motors['m1'].breakpoints = np.arange(1., 6.)
+    sim.motors['m1'].move(10., 0.)
+    values = []
+
+    async def test():
+        await beamline.Motors.update()
+        motor = beamline.Motors.device('m1')
+        await trio.sleep(.2)
+        pv = motor.flying_positions
+        values.append(await pv.getter(pv))
+        sim.motors['m1'].breakpoints = np.arange(1., 3.)
+        values.append(await pv.getter(pv))
+        np.testing.assert_array_equal(await read(pv), np.arange(1., 3.))
+
+    run_against(test)
+    np.testing.assert_array_equal(values[0], np.arange(1., 6.))
+    np.testing.assert_array_equal(values[1], np.arange(1., 3.))
+    # What the getter handed caproto isn't reused by the next read
+    assert not np.shares_memory(*values)
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1'], 'velocity': 100.}], indirect=True)
+def test_flying_positions_overflow(sim, beamline, run_against, monkeypatch):
+    monkeypatch.setattr(alsdac.caproto, 'MAX_BREAKPOINTS', 3)
+    sim.motors['m1'].breakpoints = np.arange(1., 6.)
+    sim.motors['m1'].move(10., 0.)
+
+    async def test():
+        await beamline.Motors.update()
+        motor = beamline.Motors.device('m1')
+        await trio.sleep(.2)
+        pv = motor.flying_positions
+        np.testing.assert_array_equal(await read(pv), [1., 2., 3.])
+        assert (pv.alarm.status, pv.alarm.severity) == (AlarmStatus.READ, AlarmSeverity.MAJOR_ALARM)
+        # The rest of the motor isn't alarmed
+        assert motor.user_readback_value.alarm.severity == AlarmSeverity.NO_ALARM
+
+        sim.motors['m1'].breakpoints = np.arange(1., 3.)
+        np.testing.assert_array_equal(await read(pv), [1., 2.])
+        assert pv.alarm.severity == AlarmSeverity.NO_ALARM
+
+    run_against(test)
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1']}], indirect=True)
+def test_flying_positions_error(sim, beamline, run_against):
+    async def test():
+        await beamline.Motors.update()
+        motor = beamline.Motors.device('m1')
+        del sim.motors['m1']
+        assert len(await read(motor.flying_positions)) == 0
+        assert motor.flying_positions.alarm.severity == AlarmSeverity.INVALID_ALARM
+
+    run_against(test)
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1']}], indirect=True)
+def test_breakpoints(sim, beamline, run_against, monkeypatch):
+    # A server that only takes evenly spaced breakpoints
+    monkeypatch.setattr(sim, 'HANDLERS', {fnc: handler for fnc, handler in sim.HANDLERS.items()
+                                          if fnc != 'SetBreakpointRegions'})
+
+    async def test():
+        await beamline.Motors.update()
+        motor = beamline.Motors.device('m1')
+        await motor.breakpoints.write(np.arange(0., 2., .5))
+        np.testing.assert_array_equal(sim.motors['m1'].breakpoints, np.arange(0., 2., .5))
+        assert motor.breakpoint_regions.value == 1
+
+        with pytest.raises(ValueError, match='2 breakpoint regions'):
+            await motor.breakpoints.write([0., .5, 3.])
+        np.testing.assert_array_equal(sim.motors['m1'].breakpoints, np.arange(0., 2., .5))
+
+        await motor.breakpoints.write([])
+        assert len(sim.motors['m1'].breakpoints) == 0
+
+    run_against(test)
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1', 'm2', 'm3'], 'velocity': 5.}], indirect=True)
+def test_scanner_finishes_moves(sim, beamline, run_against):
+    motors = beamline.Motors
+    polled = []
+
+    async def test():
+        await motors.update()
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(motors.scanner.run)
+            devices = [motors.device(name) for name in sim.motors]
+            for i, device in enumerate(devices):
+                await device.value.write(.5 * (i + 1))
+            assert all(device in motors.scanner for device in devices)
+            assert all(device.done_moving_to_value.value == 0 for device in devices)
+
+            requests = sim.requests
+            await wait_for(lambda: all(device.done_moving_to_value.value == 1 for device in devices))
+            polled.append(sim.requests - requests)
+            for i, device in enumerate(devices):
+                assert device.user_readback_value.value == pytest.approx(.5 * (i + 1))
+                assert device.motor_is_moving.value == 0
+            await wait_for(lambda: motors.moving.value == 0)
+            nursery.cancel_scope.cancel()
+
+    run_against(test)
+    # Three motors polled together for about .3 s: rounds of six requests every .05 s, not one loop per motor
+    rounds = .6 / motors.scanner.period
+    assert polled[0] <= 6 * (rounds + 4)
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1'], 'velocity': 5.}], indirect=True)
+def test_scanner_new_move_mid_round(sim, beamline, run_against):
+    motors = beamline.Motors
+
+    async def test():
+        await motors.update()
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(motors.scanner.run)
+            device = motors.device('m1')
+            await device.value.write(1.)
+            await trio.sleep(.05)
+            # Retargeted before the first move is done; only the second may finish it
+            await device.value.write(.2)
+            await wait_for(lambda: device.done_moving_to_value.value == 1)
+            assert device.user_readback_value.value == pytest.approx(.2)
+            nursery.cancel_scope.cancel()
+
+    run_against(test)
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1'], 'velocity': .5}], indirect=True)
+def test_scanner_backs_off_and_recovers(sim, beamline, run_against, caplog):
+    caplog.set_level(logging.INFO, logger=alsdac.caproto.logger.name)
+    motors = beamline.Motors
+    motors.scanner.max_backoff = .2
+
+    async def test():
+        await motors.update()
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(motors.scanner.run)
+            device = motors.device('m1')
+            await device.value.write(.1)
+            removed = sim.motors.pop('m1')  # every round now fails
+            requests = sim.requests
+            await trio.sleep(1.)
+            failed_rounds = (sim.requests - requests) / 2
+            sim.motors['m1'] = removed
+            await wait_for(lambda: device.done_moving_to_value.value == 1)
+            nursery.cancel_scope.cancel()
+        # Backed off from .05 s to .2 s rather than polling every period
+        assert failed_rounds < 1. / motors.scanner.period / 2
+
+    run_against(test)
+    failures = [record for record in caplog.records if record.getMessage() == 'Motor scan failed']
+    assert len(failures) == 1
+    assert any(record.getMessage() == 'Motor scan recovered' for record in caplog.records)
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1', 'm2', 'm3'], 'velocity': 5.}], indirect=True)
+def test_group_move(sim, beamline, run_against):
+    motors = beamline.Motors
+
+    async def test():
+        await motors.update()
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(motors.scanner.run)
+            await motors.group_names.write(['m1', 'm3'])
+            requests = sim.requests
+            await motors.group_setpoints.write([.5, 1.])
+            # One command, so both axes started at once
+            assert sim.requests - requests == 1
+            assert sim.motors['m1']._t0 == sim.motors['m3']._t0
+            assert motors.group_done.value == 0
+
+            await wait_for(lambda: motors.group_done.value == 1)
+            assert sim.motors['m1'].position(trio.current_time()) == pytest.approx(.5)
+            assert sim.motors['m3'].position(trio.current_time()) == pytest.approx(1.)
+            for name, target in ('m1', .5), ('m3', 1.):
+                device = motors.device(name)
+                assert device.done_moving_to_value.value == 1
+                assert device.user_readback_value.value == pytest.approx(target)
+            assert 'm2' not in motors.device_groups
+            nursery.cancel_scope.cancel()
+
+    run_against(test)
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1', 'm2']}], indirect=True)
+def test_group_move_rejected(sim, beamline, run_against):
+    motors = beamline.Motors
+
+    async def test():
+        await motors.update()
+        await motors.group_names.write(['m1', 'x9', 'm2', 'y7'])
+        requests = sim.requests
+        with pytest.raises(ValueError, match='unknown motors: x9, y7'):
+            await motors.group_setpoints.write([1., 2., 3., 4.])
+        await motors.group_names.write(['m1', 'm2'])
+        with pytest.raises(ValueError, match='1 setpoints for 2 motors'):
+            await motors.group_setpoints.write([1.])
+        # Nothing was sent or started
+        assert sim.requests == requests
+        assert motors.group_done.value == 1
+        assert not any(motor.moving(trio.current_time()) for motor in sim.motors.values())
+        assert not motors.device_groups
+
+    run_against(test)
@@ -0,0 +1,136 @@
+"""alsdac.ophyd devices against a live IOC, itself backed by the simulator, over CA on localhost."""
+import os
+import socket
+import threading
+import time
+
+import pytest
+import trio
+
+import alsdac
+from alsdac import simulator
+
+PREFIX = 'ophydtest:'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='module')
+def ioc():
+    """The simulator (velocity 2 units/s), served through a Beamline IOC on a free CA port; yields the simulator."""
+    from alsdac import caproto as ioc_module
+
+    saved = {name: os.environ.get(name) for name in ('EPICS_CA_SERVER_PORT', 'EPICS_CA_ADDR_LIST',
+                                                     'EPICS_CA_AUTO_ADDR_LIST')}
+    ca_port = free_port()
+    os.environ.update(EPICS_CA_SERVER_PORT=str(ca_port), EPICS_CA_ADDR_LIST='127.0.0.1',
+                      EPICS_CA_AUTO_ADDR_LIST='NO')
+    sim = simulator.Simulator(velocity=2.)
+    address, port = alsdac.SERVER_ADDRESS, alsdac.PORT
+    started = threading.Event()
+    state = {}
+
+    async def serve():
+        async with trio.open_nursery() as nursery:
+            state['token'], state['scope'] = trio.lowlevel.current_trio_token(), nursery.cancel_scope
+            alsdac.set_server_address('127.0.0.1')
+            alsdac.set_port(await nursery.start(simulator.serve, sim, '127.0.0.1', 0))
+            beamline = ioc_module.Beamline(prefix=PREFIX)
+            await beamline.update()
+            nursery.start_soon(ioc_module.main, beamline.update, beamline.pvdb, False, beamline.background)
+            started.set()
+
+    thread = threading.Thread(target=trio.run, args=(serve,), daemon=True)
+    thread.start()
+    assert started.wait(10)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', ca_port)).close()
+            break
+        except OSError:
+            assert time.monotonic() < deadline, 'the IOC did not start'
+            time.sleep(.05)
+    try:
+        yield sim
+    finally:
+        trio.from_thread.run_sync(state['scope'].cancel, trio_token=state['token'])
+        thread.join(10)
+        alsdac.SERVER_ADDRESS, alsdac.PORT = address, port
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+@pytest.fixture
+def motor(ioc):
+    from alsdac.ophyd import Motor
+
+    motor = Motor(f'{PREFIX}motors:esp300axis1', name='motor')
+    motor.wait_for_connection(timeout=10)
+    motor.move(0., wait=True, timeout=10)
+    return motor
+
+
+def arrived(motor, target):
+    return abs(motor.user_readback.get(use_monitor=False) - target) < 1e-3
+
+
+def test_back_to_back_moves(motor):
+    # A stale DMOV rise from one move must not finish the next one early
+    for i in range(1, 11):
+        status = motor.move(i * .05, wait=True, timeout=10)
+        assert status.success
+        assert arrived(motor, i * .05)
+    assert not motor.moving
+
+
+def test_zero_length_move(motor):
+    status = motor.move(0., wait=True, timeout=5)
+    assert status.done and status.success
+    # ...and leaves nothing behind to finish the next move early
+    status = motor.move(.2, wait=True, timeout=10)
+    assert status.success and arrived(motor, .2)
+
+
+def test_interrupted_move(motor):
+    first = motor.move(2., wait=False, timeout=10)
+    time.sleep(.2)
+    second = motor.move(.5, wait=True, timeout=10)
+    # ophyd fails a move that is superseded by the next one, and stops the motor for it from another thread, so the
+    # next one may end wherever that stop caught it
+    assert first.done and not first.success
+    assert second.done and not motor.moving
+    status = motor.move(.5, wait=True, timeout=10)
+    assert status.success and arrived(motor, .5)
+
+    third = motor.move(2., wait=False, timeout=10)
+    time.sleep(.2)
+    motor.stop()
+    # As for any EpicsMotor, a stopped move finishes when DMOV rises, where the motor stopped
+    third.wait(5)
+    assert not motor.moving
+    assert motor.user_readback.get(use_monitor=False) < 1.5
+    # ...and that DMOV rise doesn't finish the next move
+    status = motor.move(.1, wait=True, timeout=10)
+    assert status.success and arrived(motor, .1)
+
+
+def test_motor_group(ioc):
+    from alsdac.ophyd import Motor, MotorGroup
+
+    group = MotorGroup(f'{PREFIX}motors:', name='group')
+    group.wait_for_connection(timeout=10)
+    status = group.set({'esp300axis1': .3, 'esp300axis2': .6}, timeout=10)
+    status.wait(10)
+    assert status.success
+    for name, target in ('esp300axis1', .3), ('esp300axis2', .6):
+        motor = Motor(f'{PREFIX}motors:{name}', name=name)
+        motor.wait_for_connection(timeout=10)
+        assert arrived(motor, target)
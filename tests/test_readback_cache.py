@@ -0,0 +1,120 @@
+import trio
+
+import alsdac.caproto
+from alsdac import _sansio
+from alsdac.caproto import ReadbackCache
+
+
+class FakeServer:
+    """Answers every request after ``delay`` seconds, counting the requests that reach it."""
+
+    def __init__(self, delay=.01):
+        self.delay = delay
+        self.requests = []
+
+    async def get(self, cmd):
+        self.requests.append(cmd.str_payload)
+        await trio.sleep(self.delay)
+        return len(self.requests)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.
+
+    def __call__(self):
+        return self.now
+
+
+def test_single_flight():
+    server = FakeServer()
+    cache = ReadbackCache(server.get, max_age=1.)
+    results = []
+
+    async def main():
+        async def read():
+            results.append(await cache.get(_sansio.GetMotorPosRequest('m1')))
+
+        async with trio.open_nursery() as nursery:
+            for _ in range(10):
+                nursery.start_soon(read)
+
+    trio.run(main)
+    assert len(server.requests) == 1
+    assert results == [1] * 10
+    assert (cache.misses, cache.coalesced) == (1, 9)
+
+
+def test_max_age(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(alsdac.caproto.time, 'monotonic', clock)
+    server = FakeServer(delay=0)
+    cache = ReadbackCache(server.get, max_age=.05)
+    cmd = _sansio.GetMotorPosRequest('m1')
+
+    async def main():
+        assert await cache.get(cmd) == 1
+        clock.now += .04
+        assert await cache.get(cmd) == 1  # still fresh
+        clock.now += .02
+        assert await cache.get(cmd) == 2  # expired
+
+    trio.run(main)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_keys_and_invalidate():
+    server = FakeServer(delay=0)
+    cache = ReadbackCache(server.get, max_age=10.)
+
+    async def main():
+        assert await cache.get(_sansio.GetMotorPosRequest('m1')) == 1
+        assert await cache.get(_sansio.GetMotorPosRequest('m2')) == 2
+        assert await cache.get(_sansio.GetMotorPosRequest('m1')) == 1
+        cache.invalidate(_sansio.GetMotorPosRequest('m1'))
+        assert await cache.get(_sansio.GetMotorPosRequest('m1')) == 3
+
+    trio.run(main)
+
+
+def test_uncacheable_passes_through():
+    server = FakeServer(delay=0)
+    cache = ReadbackCache(server.get, max_age=10.)
+
+    async def main():
+        for _ in range(3):
+            await cache.get(_sansio.MoveMotorRequest('m1', 1.))
+
+    trio.run(main)
+    assert len(server.requests) == 3
+    assert cache.stats()['entries'] == 0
+
+
+def test_failure_is_not_cached():
+    calls = []
+
+    async def flaky(cmd):
+        calls.append(cmd)
+        await trio.sleep(.01)
+        if len(calls) == 1:
+            raise ConnectionError('server gone')
+        return 'ok'
+
+    cache = ReadbackCache(flaky, max_age=10.)
+    outcomes = []
+
+    async def main():
+        async def read():
+            try:
+                outcomes.append(await cache.get(_sansio.GetMotorPosRequest('m1')))
+            except ConnectionError:
+                outcomes.append('failed')
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(read)
+            await trio.sleep(.001)
+            nursery.start_soon(read)  # waits on the first, then asks again itself
+
+    trio.run(main)
+    assert outcomes == ['failed', 'ok']
+    assert len(calls) == 2
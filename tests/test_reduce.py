@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from caproto import ChannelType
+
+from alsdac.caproto import Instrument
+
+
+def spot(shape=(8, 6), at=(2, 3), value=10):
+    image = np.zeros(shape, dtype=np.int32)
+    image[at] = value
+    return image
+
+
+def test_rois():
+    image = spot()
+    stats = Instrument.reduce(image, rois=[0, 0, 4, 4, -2, -2, 4, 4, 2, 3, 1, 1, 0, 0, 100, 100])
+    # Clipped to the frame, rather than wrapping around or raising
+    np.testing.assert_array_equal(stats['roi_sums'], [10., 0., 10., 10.])
+    # No ROIs: the central 4x4 pixels
+    np.testing.assert_array_equal(Instrument.reduce(image)['roi_sums'], [10.])
+    np.testing.assert_array_equal(Instrument.reduce(spot(at=(0, 0)))['roi_sums'], [0.])
+
+
+def test_preview():
+    image = np.arange(48, dtype=np.int32).reshape(8, 6)
+    stats = Instrument.reduce(image, binning=2)
+    assert (stats['preview_x'], stats['preview_y']) == (4, 3)
+    np.testing.assert_array_equal(stats['preview'].reshape(4, 3), image.reshape(4, 2, 3, 2).mean(axis=(1, 3)))
+
+    # Rows and columns that don't fill a bin are left out
+    stats = Instrument.reduce(image, binning=5)
+    assert (stats['preview_x'], stats['preview_y']) == (1, 1)
+    assert stats['preview'] == pytest.approx(image[:5, :5].mean())
+
+    stats = Instrument.reduce(image, binning=0)
+    np.testing.assert_array_equal(stats['preview'], image.ravel())
+
+
+def test_stats():
+    stats = Instrument.reduce(spot())
+    assert (stats['sum'], stats['max']) == (10., 10.)
+    assert (stats['centroid_x'], stats['centroid_y']) == (2., 3.)
+    assert (stats['sigma_x'], stats['sigma_y']) == (0., 0.)
+
+    rows, cols = np.indices((64, 48))
+    gaussian = 1000 * np.exp(-(rows - 20.) ** 2 / (2 * 3. ** 2) - (cols - 30.) ** 2 / (2 * 2. ** 2))
+    stats = Instrument.reduce(gaussian)
+    assert (stats['centroid_x'], stats['centroid_y']) == (pytest.approx(20.), pytest.approx(30.))
+    assert (stats['sigma_x'], stats['sigma_y']) == (pytest.approx(3., rel=1e-3), pytest.approx(2., rel=1e-3))
+
+
+def test_threshold():
+    image = spot(shape=(9, 9), at=(1, 1)) + 1
+    # The background pulls the centroid towards the middle...
+    assert Instrument.reduce(image)['centroid_x'] > 1.5
+    # ...unless it's below the threshold; sum and max always count every pixel
+    stats = Instrument.reduce(image, threshold=.5)
+    assert (stats['centroid_x'], stats['centroid_y']) == (1., 1.)
+    assert (stats['sum'], stats['max']) == (10. + 81., 11.)
+
+
+def test_empty_frame():
+    stats = Instrument.reduce(np.zeros((0, 0)), binning=2)
+    assert (stats['sum'], stats['max'], stats['centroid_x'], stats['sigma_y']) == (0., 0., 0., 0.)
+    assert len(stats['preview']) == 0
+
+
+async def read(pv):
+    """Read ``pv`` as a CA client would, through its getter."""
+    metadata, values = await pv.read(ChannelType.DOUBLE)
+    return list(values)
+
+
+@pytest.mark.parametrize('sim', [{'shape': (32, 32)}], indirect=True)
+def test_stat_pvs(sim, beamline, run_against):
+    sim.instruments['ptGreyInstrument'].frame = spot(shape=(32, 32), at=(10, 12), value=7)
+
+    async def test():
+        await beamline.Detectors.update()
+        instrument = beamline.Detectors.device('ptGreyInstrument')
+        await instrument.rois.write([8, 8, 4, 8, 0, 0, 2, 2])
+        await instrument.binning.write(8)
+        # With no frame yet, reading one stat fetches one, and publishes every stat for it
+        assert await read(instrument.frame_sum) == [7.]
+        assert instrument.frame_max.value == 7.
+        assert list(instrument.roi_sums.value) == [7., 0.]
+        assert (instrument.centroid_x.value, instrument.centroid_y.value) == (10., 12.)
+        assert (instrument.preview_x.value, instrument.preview_y.value) == (4, 4)
+        assert len(instrument.preview.value) == 16
+        assert await read(instrument.scalarread) == [7.]
+
+        # Settings apply from the next frame
+        await instrument.binning.write(2)
+        assert instrument.preview_x.value == 4
+        await instrument.acquisition.fetch()
+        assert (instrument.preview_x.value, instrument.preview_y.value) == (16, 16)
+        assert len(await read(instrument.preview)) == 256
+
+    run_against(test)
@@ -0,0 +1,232 @@
+import numpy as np
+import pytest
+
+from alsdac import _sansio
+
+
+def client(pipeline=True):
+    return _sansio.LVS(_sansio.Role.CLIENT, pipeline=pipeline)
+
+
+def feed(lvs, wire, chunk):
+    """Feed ``wire`` in ``chunk``-byte pieces, collecting every event that completes."""
+    events = []
+    for start in range(0, len(wire), chunk):
+        lvs.receive_bytes(wire[start:start + chunk])
+        while lvs.in_flight:
+            event = lvs.next_event()
+            if event is _sansio.NEED_DATA:
+                break
+            events.append(event)
+    return events
+
+
+def binary_frame(shape=(3, 5)):
+    frame = np.arange(np.prod(shape), dtype=np.int32).reshape(shape)
+    return frame, bytes(_sansio.GetInstrumentAcquired2DBinaryResponse.from_array(frame))
+
+
+@pytest.mark.parametrize('chunk', [1, 2, 3, 7, 1 << 16])
+def test_line_split(chunk):
+    lvs = client()
+    lvs.send(_sansio.GetMotorPosRequest('m1'))
+    events = feed(lvs, b'1.25\r\n', chunk)
+    assert [event.data for event in events] == [1.25]
+    assert lvs.bytes_consumed == 6
+
+
+@pytest.mark.parametrize('chunk', [1, 3, 5, 64, 1 << 16])
+def test_sized_binary_split(chunk):
+    frame, wire = binary_frame()
+    lvs = client()
+    lvs.send(_sansio.GetInstrumentAcquired2DBinaryRequest('cam'))
+    events = feed(lvs, wire, chunk)
+    assert len(events) == 1
+    np.testing.assert_array_equal(events[0].data, frame)
+
+
+def test_sized_binary_body_containing_terminators():
+    # The body is measured by the header, not scanned for the trailer
+    frame = np.full((2, 4), int.from_bytes(b'\r\n\r\n', 'big'), dtype=np.int32)
+    wire = bytes(_sansio.GetInstrumentAcquired2DBinaryResponse.from_array(frame))
+    lvs = client()
+    lvs.send(_sansio.GetInstrumentAcquired2DBinaryRequest('cam'))
+    events = feed(lvs, wire, 5)
+    np.testing.assert_array_equal(events[0].data, frame)
+
+
+@pytest.mark.parametrize('chunk', [1, 2, 4, 1 << 16])
+def test_sized_text_split(chunk):
+    wire = b'3 Points by 2 channels\r\n1\t2\t3\r\n4\t5\t6\r\n\r\n'
+    lvs = client()
+    lvs.send(_sansio.GetInstrumentAcquired2DRequest('cam'))
+    events = feed(lvs, wire, chunk)
+    assert len(events) == 1
+    assert events[0].data.tolist() == [[1, 2, 3], [4, 5, 6]]
+
+
+def test_sized_error_reply():
+    # An error comes back as a single line instead of a frame
+    lvs = client()
+    lvs.send(_sansio.GetInstrumentAcquired2DBinaryRequest('cam'))
+    events = feed(lvs, b'ERROR: no such instrument\r\n', 4)
+    assert events[0].str_payload == 'ERROR: no such instrument'
+    with pytest.raises(_sansio.ProtocolError):
+        events[0].shape
+
+
+@pytest.mark.parametrize('chunk', [1, 3, 11, 1 << 16])
+def test_pipelined(chunk):
+    frame, frame_wire = binary_frame((4, 4))
+    lvs = client()
+    lvs.send_many([_sansio.GetMotorPosRequest('m1'),
+                   _sansio.GetInstrumentAcquired2DBinaryRequest('cam'),
+                   _sansio.GetMotorPosRequest('m2'),
+                   _sansio.ListMotorsRequest()])
+    wire = b'1.5\r\n' + frame_wire + b'-2.5\r\n'
+    events = feed(lvs, wire, chunk)
+    # A LINES reply has no end marker: it ends where a receive ends on a CRLF
+    events += feed(lvs, b'm1\r\nm2\r\n', 1 << 16)
+    wire += b'm1\r\nm2\r\n'
+    assert [type(event) for event in events] == [_sansio.GetMotorPosResponse,
+                                                 _sansio.GetInstrumentAcquired2DBinaryResponse,
+                                                 _sansio.GetMotorPosResponse,
+                                                 _sansio.ListMotorsResponse]
+    assert events[0].data == 1.5
+    np.testing.assert_array_equal(events[1].data, frame)
+    assert events[2].data == -2.5
+    assert events[3].data == ['m1', 'm2']
+    assert lvs.bytes_consumed == len(wire)
+    assert lvs.state is _sansio.State.IDLE
+
+
+def test_pipelining_needs_pipeline():
+    lvs = client(pipeline=False)
+    lvs.send(_sansio.GetMotorPosRequest('m1'))
+    with pytest.raises(_sansio.ProtocolError):
+        lvs.send(_sansio.GetMotorPosRequest('m2'))
+
+
+def test_nothing_behind_unframed_reply():
+    lvs = client()
+    with pytest.raises(_sansio.ProtocolError):
+        lvs.send_many([_sansio.ListMotorsRequest(), _sansio.GetMotorPosRequest('m1')])
+    assert lvs.in_flight == 0
+
+
+def test_closed_mid_frame():
+    _, wire = binary_frame()
+    lvs = client()
+    lvs.send(_sansio.GetInstrumentAcquired2DBinaryRequest('cam'))
+    lvs.receive_bytes(wire[:-3])
+    assert lvs.next_event() is _sansio.NEED_DATA
+    lvs.receive_bytes(b'')
+    with pytest.raises(_sansio.ProtocolError):
+        lvs.next_event()
+
+
+def test_server_role():
+    server = _sansio.LVS(_sansio.Role.SERVER)
+    server.receive_bytes(b'GetMotorPos(m1)\r\nGetMo')
+    request = server.next_event()
+    assert isinstance(request, _sansio.GetMotorPosRequest)
+    assert request.args == ['m1']
+    assert server.next_event() is _sansio.NEED_DATA
+    assert server.send(_sansio.GetMotorPosResponse.from_components('1.0')) == b'1.0\r\n'
+
+
+@pytest.mark.parametrize('positions, regions', [
+    ([], []),
+    ([1.], [(1., 0., 1)]),
+    ([0., .5], [(0., .5, 2)]),
+    (np.arange(0, 10, .5), [(0., .5, 20)]),
+    ([0., 1., 2., 10., 12., 14.], [(0., 1., 3), (10., 2., 3)]),
+    ([0., 1., 2., 10.], [(0., 1., 3), (10., 0., 1)]),
+    ([5., 4., 3., 3.5, 4.], [(5., -1., 3), (3.5, .5, 2)]),
+])
+def test_breakpoint_regions(positions, regions):
+    encoded = _sansio.breakpoint_regions(positions)
+    assert encoded.shape == (len(regions), 3)
+    np.testing.assert_allclose(encoded, np.array(regions, dtype=float).reshape(-1, 3))
+    np.testing.assert_allclose(_sansio.breakpoint_positions(encoded), positions)
+
+
+def test_breakpoint_regions_absorb_rounding():
+    positions = np.linspace(-1., 1., 1001)  # steps that differ in the last bits
+    regions = _sansio.breakpoint_regions(positions)
+    assert len(regions) == 1
+    np.testing.assert_allclose(_sansio.breakpoint_positions(regions), positions, atol=1e-12)
+
+
+def test_set_breakpoint_regions_request():
+    positions = np.concatenate([np.arange(0., 1., .25), np.arange(5., 6., .5)])
+    request = _sansio.SetBreakpointRegionsRequest.from_positions('m1', positions)
+    assert bytes(request) == b'SetBreakpointRegions(m1, 0.0, 0.25, 4, 5.0, 0.5, 2)\r\n'
+
+    server = _sansio.LVS(_sansio.Role.SERVER)
+    server.receive_bytes(bytes(request))
+    received = server.next_event()
+    np.testing.assert_allclose(received.regions, [(0., .25, 4), (5., .5, 2)])
+    np.testing.assert_allclose(received.positions, positions)
+
+
+def test_move_all_motors_request():
+    request = _sansio.MoveAllMotorsRequest.from_positions([('m1', .5), ('m2', -1)])
+    assert bytes(request) == b'MoveAllMotors(m1, 0.5, m2, -1)\r\n'
+
+    server = _sansio.LVS(_sansio.Role.SERVER)
+    server.receive_bytes(bytes(request))
+    assert server.next_event().positions == {'m1': .5, 'm2': -1.}
+
+
+def flying_positions(positions):
+    return _sansio.GetFlyingPositionsResponse.from_array(np.asarray(positions, dtype=np.float32))
+
+
+def test_read_into():
+    positions = np.linspace(-3, 3, 11, dtype=np.float32)
+    # No header; native float32 then CRLF
+    assert bytes(flying_positions(positions)) == positions.tobytes() + b'\r\n'
+
+    lvs = client()
+    lvs.send(_sansio.GetFlyingPositionsRequest('m1'))
+    response, = feed(lvs, positions.tobytes() + b'\r\n', 1 << 16)
+    read = response.read_into()
+    assert read.dtype == np.float32
+    np.testing.assert_array_equal(read, positions)
+    np.testing.assert_array_equal(response.data, positions)
+
+
+def test_read_into_preallocated():
+    positions = np.arange(5, dtype=np.float32)
+    out = np.full(8, -1, dtype=np.float32)
+    read = flying_positions(positions).read_into(out)
+    assert np.shares_memory(read, out)
+    np.testing.assert_array_equal(out, [0, 1, 2, 3, 4, -1, -1, -1])
+
+    with pytest.raises(ValueError):
+        flying_positions(positions).read_into(np.empty(4, dtype=np.float32))
+
+
+def test_read_into_empty():
+    assert flying_positions([]).read_into().shape == (0,)
+
+
+@pytest.mark.parametrize('wire', [b'ERROR: no such motor\r\n', b'\x00\x00\x80\r\n'])
+def test_flying_positions_bad_reply(wire):
+    lvs = client()
+    lvs.send(_sansio.GetFlyingPositionsRequest('m1'))
+    response, = feed(lvs, wire, 1 << 16)
+    with pytest.raises(_sansio.ProtocolError):
+        response.read_into()
+
+
+@pytest.mark.parametrize('positions, wire', [
+    ([], b'DisableBreakpoints(m1)\r\n'),
+    ([2.], b'SetBreakpoints(m1, 2.0, 0.0, 1)\r\n'),
+    (np.arange(0., 1., .25), b'SetBreakpoints(m1, 0.0, 0.25, 4)\r\n'),
+    ([0., .25, 5.], b'SetBreakpointRegions(m1, 0.0, 0.25, 2, 5.0, 0.0, 1)\r\n'),
+])
+def test_set_breakpoints_request(positions, wire):
+    regions = _sansio.breakpoint_regions(positions)
+    assert bytes(_sansio.set_breakpoints_request('m1', regions)) == wire
@@ -0,0 +1,159 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+import trio
+
+from alsdac.shm import SHM_DIR, FrameRing, FrameRingReader
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRing(slots=3)
+    yield ring
+    ring.close()
+
+
+def frame(value, shape=(8, 6), dtype=np.uint16):
+    return np.full(shape, value, dtype=dtype)
+
+
+def test_publish_and_get(ring):
+    reader = FrameRingReader(ring.name)
+    assert reader.latest_id == 0
+
+    for frame_id in range(1, 5):
+        ring.publish(frame(frame_id), frame_id)
+
+    assert reader.latest_id == 4
+    frame_id, latest = reader.latest()
+    assert frame_id == 4
+    np.testing.assert_array_equal(latest, frame(4))
+    assert latest.dtype == np.uint16
+    assert not latest.flags.writeable
+    np.testing.assert_array_equal(reader.get(2), frame(2))
+
+
+def test_overwritten_frames(ring):
+    reader = FrameRingReader(ring.name)
+    for frame_id in range(1, 5):
+        ring.publish(frame(frame_id), frame_id)
+
+    # Slot 1 now holds frame 4
+    assert not reader.valid(1)
+    assert reader.valid(4)
+    with pytest.raises(KeyError):
+        reader.get(1)
+    with pytest.raises(KeyError):
+        reader.get(0)
+
+
+def test_copy_outlives_the_slot(ring):
+    reader = FrameRingReader(ring.name)
+    ring.publish(frame(1), 1)
+    view, copy = reader.get(1), reader.get(1, copy=True)
+    ring.publish(frame(4), 4)
+
+    np.testing.assert_array_equal(copy, frame(1))
+    np.testing.assert_array_equal(view, frame(4))
+    assert copy.flags.writeable
+
+
+def test_retire_on_bigger_frame(ring):
+    reader = FrameRingReader(ring.name)
+    ring.publish(frame(1), 1)
+    old = reader.get(1)
+
+    ring.publish(frame(2, shape=(32, 32), dtype=np.float64), 2)
+
+    assert not reader.valid(1)
+    frame_id, latest = reader.latest()
+    assert frame_id == 2
+    np.testing.assert_array_equal(latest, frame(2, shape=(32, 32)))
+    assert latest.dtype == np.float64
+    # Views of the retired block stay mapped
+    np.testing.assert_array_equal(old, frame(1))
+
+
+def test_missing_block_reads_empty():
+    ring = FrameRing(slots=2)
+    reader = FrameRingReader(ring.name)  # nothing published, so no block yet
+    assert reader.latest_id == 0
+    assert reader.wait(timeout=.01) is None
+
+    ring.publish(frame(1), 1)
+    assert reader.wait(timeout=1) == 1
+
+    ring.close()  # as when share_slots goes to 0
+    assert reader.latest_id == 0
+    assert not reader.valid(1)
+    with pytest.raises(KeyError):
+        reader.get(1)
+
+    # As when share_slots is set again: a new ring under the same name
+    ring = FrameRing(ring.name, slots=2)
+    ring.publish(frame(2), 2)
+    assert reader.latest_id == 2
+    np.testing.assert_array_equal(reader.get(2), frame(2))
+    ring.close()
+
+
+def test_too_many_dimensions(ring):
+    with pytest.raises(ValueError):
+        ring.publish(np.zeros((1,) * 5), 1)
+
+
+def test_closed_ring_publishes_nothing():
+    ring = FrameRing(slots=2)
+    ring.publish(frame(1), 1)
+    ring.close()
+    ring.publish(frame(2), 2)
+    assert not os.path.exists(os.path.join(SHM_DIR, ring.name))
+    assert FrameRingReader(ring.name).latest_id == 0
+
+
+def test_close_while_publishing():
+    # As when share_slots is cleared while a worker thread publishes the last frame
+    ring = FrameRing(slots=2)
+    big = frame(1, shape=(1024, 1024), dtype=np.float64)
+    published = threading.Event()
+    errors = []
+
+    def publish():
+        try:
+            for frame_id in range(1, 10000):
+                ring.publish(big, frame_id)
+                published.set()
+                if ring.closed:
+                    break
+        except Exception as ex:
+            errors.append(ex)
+
+    thread = threading.Thread(target=publish)
+    thread.start()
+    assert published.wait(5)
+    ring.close()
+    thread.join(10)
+    assert not errors
+    assert not os.path.exists(os.path.join(SHM_DIR, ring.name))
+
+
+@pytest.mark.parametrize('sim', [{'shape': (16, 16)}], indirect=True)
+def test_ioc_unlinks_rings_at_shutdown(sim, beamline, run_against):
+    names = []
+
+    async def test():
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(beamline.background)
+            await beamline.Detectors.update()
+            instrument = beamline.Detectors.device('ptGreyInstrument')
+            await instrument.share_slots.write(2)
+            await instrument.trigger.write([1])
+            names.append(instrument.shared.name)
+            assert FrameRingReader(instrument.shared.name).latest_id == 1
+            nursery.cancel_scope.cancel()
+        assert instrument.shared is None
+
+    run_against(test)
+    assert not os.path.exists(os.path.join(SHM_DIR, names[0]))
@@ -0,0 +1,117 @@
+"""alsdac.trio.AsyncClient against the simulator."""
+import pytest
+import trio
+
+import alsdac
+import alsdac.trio
+from alsdac import _sansio
+
+
+@pytest.mark.parametrize('sim', [{'latency': .05}], indirect=True)
+def test_gather_is_pipelined(sim, run_against):
+    cmds = [_sansio.GetMotorPosRequest('esp300axis1'), _sansio.GetMotorStatusRequest('esp300axis1')] * 10
+
+    async def test():
+        async with alsdac.trio.open_client() as client:
+            start = trio.current_time()
+            responses = await client.gather(*cmds)
+            # One write, so about one round trip rather than twenty
+            assert trio.current_time() - start < 5 * sim.latency
+            assert [type(response) for response in responses] == [_sansio.GetMotorPosResponse,
+                                                                  _sansio.GetMotorStatusResponse] * 10
+            assert [response.data for response in responses[:2]] == [0., True]
+            assert client.in_flight == 0
+
+    run_against(test)
+
+
+@pytest.mark.parametrize('sim', [{'motors': [f'm{i}' for i in range(8)], 'jitter': .01}], indirect=True)
+def test_tasks_share_a_client(sim, run_against):
+    for i, motor in enumerate(sim.motors.values()):
+        motor.move(float(i), 0.)
+    results = {}
+
+    async def read(client, name):
+        results[name] = [await alsdac.GetMotorPos_async(name, client) for _ in range(20)]
+
+    async def test():
+        async with alsdac.trio.open_client() as client:
+            async with trio.open_nursery() as nursery:
+                for name in sim.motors:
+                    nursery.start_soon(read, client, name)
+
+    run_against(test)
+    assert results == {f'm{i}': [float(i)] * 20 for i in range(8)}
+
+
+@pytest.mark.parametrize('sim', [{'motors': ['m1', 'm2'], 'latency': .1}], indirect=True)
+def test_cancelled_request(sim, run_against):
+    sim.motors['m2'].move(2., 0.)
+
+    async def test():
+        async with alsdac.trio.open_client() as client:
+            results = []
+
+            async def cancelled():
+                with trio.move_on_after(.02):
+                    results.append(await client.request(_sansio.GetMotorPosRequest('m1')))
+
+            async def waited():
+                await trio.sleep(.01)
+                results.append((await client.request(_sansio.GetMotorPosRequest('m2'))).data)
+
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(cancelled)
+                nursery.start_soon(waited)
+            # The cancelled request's response was read and dropped, not handed to the one behind it
+            assert results == [2.]
+            assert client.in_flight == 0
+            assert (await client.request(_sansio.GetMotorPosRequest('m2'))).data == 2.
+
+    run_against(test)
+
+
+def test_unframed_reply(run_against):
+    async def test():
+        async with alsdac.trio.open_client() as client:
+            listed = []
+
+            async def list_motors():
+                listed.extend(await client.gather(_sansio.GetMotorPosRequest('esp300axis1'),
+                                                  _sansio.ListMotorsRequest()))
+
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(list_motors)
+                while client.in_flight < 2:
+                    await trio.sleep(0)
+                # Nothing can be queued behind a reply without an end marker, so this waits for it
+                assert (await client.request(_sansio.GetMotorPosRequest('esp300axis2'))).data == 0.
+            assert listed[1].data == ['esp300axis1', 'esp300axis2']
+
+            with pytest.raises(_sansio.ProtocolError):
+                await client.gather(_sansio.ListMotorsRequest(), _sansio.GetMotorPosRequest('esp300axis1'))
+            assert client.in_flight == 0
+
+    run_against(test)
+
+
+def test_connection_closed():
+    async def hang_up(stream):
+        await stream.receive_some(1)
+        await stream.aclose()
+
+    async def test():
+        async with trio.open_nursery() as nursery:
+            listeners = await nursery.start(trio.serve_tcp, hang_up, 0)
+            port = listeners[0].socket.getsockname()[1]
+            async with alsdac.trio.open_client('127.0.0.1', port) as client:
+                # Cut off mid-request or mid-response, depending on how the hang-up lands
+                with pytest.raises((trio.BrokenResourceError, _sansio.ProtocolError)) as first:
+                    await client.request(_sansio.GetMotorPosRequest('esp300axis1'))
+                # ...and everything after it fails the same way
+                with pytest.raises(type(first.value)) as then:
+                    await client.request(_sansio.GetMotorPosRequest('esp300axis1'))
+                assert then.value is first.value
+            nursery.cancel_scope.cancel()
+
+    trio.run(test)
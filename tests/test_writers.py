@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from alsdac.writers import FrameWriter, NpyStack, open_stack
+
+
+def frames(count, shape=(4, 5), dtype=np.uint16):
+    return [np.full(shape, i, dtype=dtype) for i in range(count)]
+
+
+@pytest.mark.parametrize('count', [0, 1, 3, 4, 7])
+def test_npy_stack_round_trip(tmp_path, count):
+    path = tmp_path / 'stack.npy'
+    stack = NpyStack(path, (4, 5), np.uint16, block=3)
+    for frame in frames(count):
+        stack.append(frame)
+    stack.close()
+
+    stored = np.load(path, mmap_mode='r')
+    assert stored.shape == (count, 4, 5)
+    assert stored.dtype == np.uint16
+    np.testing.assert_array_equal(stored, np.array(frames(count)).reshape(count, 4, 5))
+
+
+def test_npy_stack_numpy_integer_block(tmp_path):
+    # The IOC passes its write_block PV value, a numpy integer
+    path = tmp_path / 'stack.npy'
+    stack = NpyStack(path, np.array([4, 5]), np.float32, block=np.int32(3))
+    for frame in frames(8, dtype=np.float32):
+        stack.append(frame)
+    stack.close()
+
+    assert np.load(path, mmap_mode='r').shape == (8, 4, 5)
+
+
+def test_open_stack_by_suffix(tmp_path):
+    stack = open_stack(tmp_path / 'stack.npy', (2, 2), np.int32, block=1)
+    assert isinstance(stack, NpyStack)
+    stack.close()
+
+
+def test_frame_writer(tmp_path):
+    path = tmp_path / 'frames.npy'
+    writer = FrameWriter(path, block=np.int32(3), depth=2, flush_period=.01)
+    for frame in frames(6):
+        writer.put(frame)
+    writer.close()
+
+    assert writer.written == 6
+    assert writer.error is None
+    np.testing.assert_array_equal(np.load(path, mmap_mode='r'), np.array(frames(6)))